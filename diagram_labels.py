@@ -0,0 +1,138 @@
+import ipaddress
+from collections import defaultdict
+import group_diagram_comments
+
+# Label building shared by the diagram backends.
+# Labels are capped so the size of a node, and the layout cost, stays flat
+# however many IPs or rules a path carries. The full lists can be written
+# to a sidecar file next to the diagram source with write_full_labels, it is
+# not a .txt file so diagram_renderer doesn't mistake it for diagram source.
+
+
+def summarize_ips(ip_list):
+    """
+    Collapse a list of IP strings into the smallest list of covering CIDRs.
+    Returns None if any entry is not an IP address or network.
+    """
+    try:
+        networks = [ipaddress.ip_network(str(ip), strict=False) for ip in ip_list]
+    except ValueError:
+        return None
+    try:
+        return [str(network) for network in ipaddress.collapse_addresses(networks)]
+    except TypeError:
+        # Mixed IPv4 and IPv6 can't be collapsed together
+        return None
+
+
+def format_ip_list(ip_list, max_display, summarize=True):
+    """
+    Format the IP list based on max_display parameter.
+    If list length <= max_display, show all IPs.
+    Otherwise summarize the IPs into CIDRs where that shortens the list, show at most
+    max_display entries (the first max_display-1 and the last one) and the total count.
+    """
+    if len(ip_list) <= max_display:
+        return '\n'.join(ip_list)
+
+    max_display = max(max_display, 1)
+    entries = ip_list
+    if summarize:
+        summary = summarize_ips(ip_list)
+        if summary and len(summary) < len(ip_list):
+            entries = summary
+
+    if len(entries) > max_display:
+        entries = entries[:max_display - 1] + [f"... +{len(entries) - max_display} more", entries[-1]]
+
+    return '\n'.join(entries + [f"({len(ip_list)} total)"])
+
+
+def format_ip_label(ips, max_display, summarize=True):
+    """Sort and format a node's IPs, a single value is shown as is."""
+    if isinstance(ips, list):
+        ips.sort()
+        return format_ip_list(ips, max_display, summarize)
+    return str(ips)
+
+
+def comments_label(comments, max_rules=None):
+    """Group rule/flow ids into a label, listing at most max_rules rules per firewall."""
+    if isinstance(comments, list):
+        return group_diagram_comments.group_data(comments, max_rules=max_rules)
+    return str(comments)
+
+
+def edge_flow_label(rule_flows, max_rules=None):
+    """
+    Label for an overlay link: the number of flows crossing it, then the flow count
+    for each rule, listing at most max_rules rules.
+    """
+    rule_items = sorted(rule_flows.items(), key=lambda item: (not item[0].isdigit(),
+                                                             int(item[0]) if item[0].isdigit() else 0, item[0]))
+    hidden = 0
+    if max_rules is not None and len(rule_items) > max_rules:
+        hidden = len(rule_items) - max_rules
+        rule_items = rule_items[:max_rules]
+
+    total = sum(rule_flows.values())
+    lines = [f"{total} flow{'s' if total != 1 else ''}"]
+    lines.extend(f"Rule {rule}: {count} flow{'s' if count != 1 else ''}" for rule, count in rule_items)
+    if hidden:
+        lines.append(f"+{hidden} more rules")
+    return '\n'.join(lines)
+
+
+def process_tuples(tuple_list):
+    """
+    Group tuples by their first two elements.
+    """
+    if not tuple_list or not isinstance(tuple_list[0], tuple):
+        return tuple_list
+
+    # Create a defaultdict to group tuples by their first two elements
+    grouped = defaultdict(list)
+
+    # Group tuples by their first two elements
+    for item in tuple_list:
+        key = (tuple(item[0]) if isinstance(item[0], list) else item[0],
+               tuple(item[1]) if isinstance(item[1], list) else item[1])
+        grouped[key].append(item[2])
+
+    # Combine the grouped items
+    result = []
+    for key, comments in grouped.items():
+        result.append((list(key[0]) if isinstance(key[0], tuple) else key[0],
+                       list(key[1]) if isinstance(key[1], tuple) else key[1],
+                       comments))
+
+    return result
+
+
+def write_full_labels(src_filename, flow, ip_data, diagram_type="multi"):
+    """
+    Write every source IP, destination IP and rule/flow id for a diagram to
+    <src_filename>.labels so nothing is lost when the diagram labels are capped.
+    """
+    if diagram_type == "single":
+        ip_tuples = [ip_data]
+    else:
+        ip_tuples = process_tuples(ip_data)
+
+    lines = [f"Path: {' --> '.join(flow)}", ""]
+    for idx, (src_ips, dst_ips, comments) in enumerate(ip_tuples):
+        src_ips = sorted(src_ips) if isinstance(src_ips, list) else [src_ips]
+        dst_ips = sorted(dst_ips) if isinstance(dst_ips, list) else [dst_ips]
+        comments = comments if isinstance(comments, list) else [comments]
+
+        lines.append(f"Group {idx + 1}")
+        lines.append(f"Sources ({len(src_ips)}):")
+        lines.extend(f"  {ip}" for ip in src_ips)
+        lines.append(f"Destinations ({len(dst_ips)}):")
+        lines.extend(f"  {ip}" for ip in dst_ips)
+        lines.append(f"Rules/flows ({len(comments)}):")
+        lines.extend(f"  {comment}" for comment in comments)
+        lines.append("")
+
+    with open(f"{src_filename}.labels", "w") as f:
+        f.write('\n'.join(lines))
@@ -1,26 +1,136 @@
+import hashlib
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import graphviz
 
+# Sources rendered in the last run are recorded in this file in the Rendered
+# directory, with a hash of their content, so only edited diagrams are rendered again.
+# Sources that failed to render are recorded as {"failed": hash} and not tried again until edited
+MANIFEST_FILE = ".render_manifest.json"
 
-def render_diagrams_in_directory(directory):
+
+def source_hash(dot_source):
+    return hashlib.sha256(dot_source.encode('utf-8')).hexdigest()
+
+
+def load_manifest(render_dir):
+    try:
+        with open(os.path.join(render_dir, MANIFEST_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(render_dir, manifest):
+    manifest_path = os.path.join(render_dir, MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def find_stale_sources(directory, render_dir, manifest, force=False):
+    """
+    Return (filename, dot_source, hash) for each .txt source whose image is missing or out of date.
+    A source older than its image is skipped on the modification times alone, a newer one is
+    only rendered if its content differs from the last render, so saving without changes is free.
+    A source that failed to render is skipped until its content changes.
+    """
+    stale = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".txt"):
+            continue
+
+        input_path = os.path.join(directory, filename)
+        image_path = os.path.join(render_dir, f"{os.path.splitext(filename)[0]}.png")
+        image_exists = os.path.exists(image_path)
+
+        if not force and image_exists and os.path.getmtime(image_path) >= os.path.getmtime(input_path):
+            continue
+
+        try:
+            with open(input_path, 'r') as f:
+                dot_source = f.read()
+        except OSError as e:
+            print(f"Error reading {filename}: {str(e)}")
+            continue
+
+        digest = source_hash(dot_source)
+        if not force and image_exists and manifest.get(filename) == digest:
+            continue
+        if not force and manifest.get(filename) == {"failed": digest}:
+            continue
+
+        stale.append((filename, dot_source, digest))
+    return stale
+
+
+def render_source(dot_source, output_path):
+    graph = graphviz.Source(dot_source)
+    graph.render(output_path, format='png', cleanup=True)
+
+
+def render_diagrams_in_directory(directory, max_workers=None, force=False):
+    """
+    Render the .txt diagram sources in a directory to PNGs in its Rendered subdirectory.
+    Only sources edited since they were last rendered are rendered again, unless force is set,
+    and the dot processes run concurrently, max_workers defaults to the number of CPUs.
+
+    Returns the list of sources that were rendered.
+    """
     render_dir = os.path.join(directory, "Rendered")
     os.makedirs(render_dir, exist_ok=True)
 
-    for filename in os.listdir(directory):
-        if filename.endswith(".txt"):
-            input_path = os.path.join(directory, filename)
-            output_filename = os.path.splitext(filename)[0]
-            output_path = os.path.join(render_dir, output_filename)
+    manifest = load_manifest(render_dir)
+    stale = find_stale_sources(directory, render_dir, manifest, force)
+    if not stale:
+        return []
+
+    def render(job):
+        filename, dot_source, digest = job
+        output_filename = os.path.splitext(filename)[0]
+        try:
+            render_source(dot_source, os.path.join(render_dir, output_filename))
+            print(f"Rendered: {output_filename}")
+            return filename, digest, True
+        except Exception as e:
+            print(f"Error rendering {filename}: {str(e)}")
+            return filename, digest, False
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        results = list(executor.map(render, stale))
+
+    rendered = []
+    for filename, digest, success in results:
+        if success:
+            manifest[filename] = digest
+            rendered.append(filename)
+        else:
+            # Not tried again until the source is edited, e.g. a layout file of the Pillow or matplotlib backends
+            manifest[filename] = {"failed": digest}
+    save_manifest(render_dir, manifest)
+
+    return rendered
 
-            try:
-                with open(input_path, 'r') as f:
-                    dot_source = f.read()
 
-                graph = graphviz.Source(dot_source)
-                graph.render(output_path, format='png', cleanup=True)
-                print(f"Rendered: {output_filename}")
-            except Exception as e:
-                print(f"Error rendering {filename}: {str(e)}")
+def watch_directory(directory, stop_event=None, interval=1.0, max_workers=None, on_render=None):
+    """
+    Render the diagrams in a directory, then keep re-rendering each source as soon as it is saved
+    until stop_event is set. The directory is polled every interval seconds, which only costs a
+    stat of each file while nothing changes. on_render is called with the list of sources rendered.
+    """
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        try:
+            rendered = render_diagrams_in_directory(directory, max_workers=max_workers)
+        except OSError as e:
+            print(f"Error watching {directory}: {str(e)}")
+            rendered = []
+        if rendered and on_render:
+            on_render(rendered)
+        stop_event.wait(interval)
 
 
 def render_diagram(diagram_src, output_image):
@@ -32,4 +142,4 @@ def render_diagram(diagram_src, output_image):
         graph.render(output_image.replace('.png', ''), format='png', cleanup=True)
         print(f"Rendered: {output_image}")
     except Exception as e:
-        print(f"Error rendering {diagram_src}: {str(e)}")
\ No newline at end of file
+        print(f"Error rendering {diagram_src}: {str(e)}")
@@ -0,0 +1,93 @@
+# Node styling shared by the diagram backends
+
+from diagram_labels import edge_flow_label
+
+# Graphviz shape names for each node type
+NODE_STYLE_MAP = {
+    'firewall': 'box',
+    'router': 'diamond',
+    'zone': 'ellipse',
+    'server': 'oval'
+}
+
+# Define color pairs for different node types
+NODE_COLOR_MAP = {
+    'firewall': ('#FF9933', '#994C00'),  # Orange fill, Dark orange border
+    'router': ('#66B3FF', '#004080'),  # Light blue, Dark blue
+    'zone': ('#90EE90', '#228B22'),  # Light green, Forest green
+    'server': ('#FFDAB9', '#CD853F')  # Peach puff, Peru
+}
+
+# Default color for nodes without a specific type
+DEFAULT_COLORS = ('#FF9933', '#994C00')  # Orange fill, Dark orange border
+
+# Color pairs (fillcolor, color) for the source/destination IP groups
+GROUP_COLOR_PAIRS = [
+    ('#66B3FF', '#004080'),  # Light blue, Dark blue
+    ('#FFDAB9', '#CD853F'),  # Peach puff, Peru
+    ('#87CEFA', '#4682B4'),  # Light sky blue, Steel blue
+    ('#AFEEEE', '#5F9EA0'),  # Pale turquoise, Cadet blue
+    ('#F0FFF0', '#228B22'),  # Honeydew, Forest green
+    ('#F0FFFF', '#00CED1'),  # Azure, Dark turquoise
+    ('#FAF0E6', '#D2691E')  # Linen, Chocolate
+]
+
+# Diagram background and flow edge colours
+BACKGROUND_COLOR = '#F0F8FF'  # Light blue background
+FLOW_EDGE_COLOR = '#994C00'
+UNUSED_EDGE_COLOR = '#B0B0B0'  # Topology links no requested flow crosses in the overlay diagrams
+
+
+def edge_width(flow_count, max_flow_count, min_width=1, max_width=6):
+    """Line width for an overlay link, scaled on the number of flows crossing it."""
+    if not flow_count or not max_flow_count:
+        return min_width
+    return min_width + (max_width - min_width) * flow_count / max_flow_count
+
+
+def overlay_edge_flows(G, edge_flows, max_comment_rules=None, min_width=2, max_width=8, whole_widths=False):
+    """
+    Label and weight each link of a networkx topology on the flows crossing it, {(node1, node2): {rule: flows}}
+    with the nodes sorted, for the overlay diagrams. Unused links are greyed out. whole_widths rounds
+    the widths for backends that only draw whole pixel lines.
+    """
+    max_flow_count = max((sum(rule_flows.values()) for rule_flows in edge_flows.values()), default=0)
+    for node1, node2, data in G.edges(data=True):
+        rule_flows = edge_flows.get(tuple(sorted((node1, node2))))
+        if rule_flows:
+            width = edge_width(sum(rule_flows.values()), max_flow_count, min_width=min_width, max_width=max_width)
+            data.update(label=edge_flow_label(rule_flows, max_comment_rules), color=FLOW_EDGE_COLOR,
+                        width=round(width) if whole_widths else width)
+        else:
+            data.update(color=UNUSED_EDGE_COLOR, width=1)
+
+
+def create_node_label(node_id, node_type_map=None, node_name_map=None):
+    """
+    Create a node label based on mappings.
+    """
+    node_type_caption = ""
+
+    # Apply node type mapping if available
+    if node_type_map and node_id in node_type_map:
+        node_type = node_type_map[node_id]
+        node_type_caption = node_type.capitalize()
+
+    # Get node name if available
+    node_name_caption = node_name_map.get(node_id) if node_name_map else None
+
+    # Prepare the caption
+    if node_name_caption:
+        # Use node_name_caption as primary name
+        if node_type_caption:
+            node_caption = f"{node_name_caption}\n({node_type_caption})"
+        else:
+            node_caption = node_name_caption
+    else:
+        # Fall back to node_id if no node_name_caption is available
+        if node_type_caption:
+            node_caption = f"{node_id}\n({node_type_caption})"
+        else:
+            node_caption = node_id
+
+    return node_caption
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import tempfile
+from PIL import Image
+
+# Prepares the diagram images for embedding in the Diagrams sheet.
+# Each image is resampled to fit within a maximum size and re-encoded as a palette PNG,
+# which suits the flat colours of the diagrams, and identical images are embedded once.
+# The prepared images are written to files that openpyxl reads one at a time when the
+# workbook is saved, so no decoded image is kept in memory.
+
+
+def file_hash(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def downscale_image(image_file, output_file, max_size):
+    """Resample an image to fit within max_size x max_size pixels and save it as a compact PNG."""
+    with Image.open(image_file) as img:
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # Flatten any transparency onto white rather than letting it turn black
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, 'white')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        else:
+            img = img.convert('RGB')
+        if max_size and max(img.size) > max_size:
+            img.thumbnail((max_size, max_size), Image.LANCZOS)
+        img = img.quantize(colors=256)
+
+        # Write to a temporary file and move it into place so concurrent runs never see a partial image
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(output_file), suffix='.tmp')
+        os.close(fd)
+        try:
+            img.save(tmp_file, format='PNG', optimize=True)
+            os.replace(tmp_file, output_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def prepare_images(image_files, cache_dir, max_size=1600):
+    """
+    Return the images to embed in place of image_files, keeping their order.
+    Images with the same content are only returned once, and each is replaced by a
+    downscaled copy kept in cache_dir keyed on its content and max_size, so it is only
+    prepared again when the diagram changes. Images that can't be read are embedded as they are.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    prepared = []
+    seen = set()
+    for image_file in image_files:
+        try:
+            digest = file_hash(image_file)
+        except OSError as e:
+            print(f"Error reading {image_file}: {str(e)}")
+            continue
+        if digest in seen:
+            continue
+        seen.add(digest)
+
+        embedded_file = os.path.join(cache_dir, f"{digest}_{max_size}.png")
+        if not os.path.exists(embedded_file):
+            try:
+                downscale_image(image_file, embedded_file, max_size)
+            except (OSError, ValueError) as e:
+                print(f"Error downscaling {image_file}: {str(e)}")
+                prepared.append(image_file)
+                continue
+        prepared.append(embedded_file)
+
+    return prepared
@@ -0,0 +1,107 @@
+import csv
+import json
+
+# Machine readable exports of the output rows, selected with the output_formats Excel option.
+# The rows are written one at a time so large runs don't build the whole file in memory.
+# CSV keeps each field as the text shown in the Excel form, JSONL and Parquet split the
+# multi-line IP and path fields into lists of lines and keep the others, e.g. rule_id and
+# gateway, as single strings so they can be filtered on directly.
+
+# Fields written as lists of lines in JSONL and Parquet
+LIST_FIELDS = {'source_ips', 'destination_ips', 'paths'}
+
+# Rows per Parquet row group
+PARQUET_BATCH_SIZE = 10000
+
+
+def field_names(field_mapping):
+    """Field names in the order of the row fields."""
+    return [name for name, _ in sorted(field_mapping.items(), key=lambda item: item[1])]
+
+
+def split_lines(value):
+    return str(value).split('\n') if value not in (None, '') else []
+
+
+def field_value(name, value):
+    if name in LIST_FIELDS:
+        return split_lines(value)
+    return '' if value is None else str(value)
+
+
+def write_csv(rows, field_mapping, filename):
+    names = field_names(field_mapping)
+    with open(filename, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for row in rows:
+            writer.writerow([row[field_mapping[name]] for name in names])
+
+
+def write_jsonl(rows, field_mapping, filename):
+    names = field_names(field_mapping)
+    with open(filename, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps({name: field_value(name, row[field_mapping[name]]) for name in names}))
+            f.write('\n')
+
+
+def write_parquet(rows, field_mapping, filename):
+    # pyarrow is optional, it is only needed for this export
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    names = field_names(field_mapping)
+    schema = pa.schema([(name, pa.list_(pa.string()) if name in LIST_FIELDS else pa.string()) for name in names])
+
+    def write_batch(writer, batch):
+        writer.write_batch(pa.record_batch([[field_value(name, row[field_mapping[name]]) for row in batch]
+                                            for name in names], schema=schema))
+
+    with pq.ParquetWriter(filename, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == PARQUET_BATCH_SIZE:
+                write_batch(writer, batch)
+                batch = []
+        if batch:
+            write_batch(writer, batch)
+
+
+EXPORTERS = {
+    'csv': (write_csv, '.csv'),
+    'jsonl': (write_jsonl, '.jsonl'),
+    'parquet': (write_parquet, '.parquet'),
+}
+
+
+def parse_formats(formats):
+    """Split a comma separated list of output formats, checking each is known."""
+    formats = [f.strip().lower() for f in formats.split(',') if f.strip()]
+    for f in formats:
+        if f != 'excel' and f not in EXPORTERS:
+            raise ValueError(f"Unknown output format '{f}', choose from excel, {', '.join(EXPORTERS)}")
+    return formats
+
+
+def export_rows(rows, field_mapping, formats, base_filename):
+    """
+    Write the rows in each of the machine readable formats to base_filename plus the format's extension.
+    Excel is written separately by write_excel_from_tmpl and skipped here.
+    Returns the list of files written.
+    """
+    files = []
+    for output_format in formats:
+        if output_format not in EXPORTERS:
+            continue
+        exporter, extension = EXPORTERS[output_format]
+        filename = f"{base_filename}{extension}"
+        try:
+            exporter(rows, field_mapping, filename)
+        except ImportError as e:
+            print(f"Skipping {output_format} export, {str(e)}")
+            continue
+        print(f"Exported: {filename}")
+        files.append(filename)
+    return files
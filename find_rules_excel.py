@@ -2,6 +2,31 @@ import openpyxl
 import re
 from typing import Dict, List, Tuple, Optional
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+
+# Cell patterns used to detect the rule columns, compiled once
+IP_PATTERN = re.compile(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}(?:/[0-9]{1,3}|_[0-9]{1,3})?\b')
+SERVICES = ['HTTP', 'HTTPS', 'DNS', 'FTP', 'SMTP', 'POP3', 'IMAP', 'SSH', 'TELNET', 'RDP']
+PROTOCOLS = ['TCP', 'UDP', 'ICMP', 'IP']
+# Any service or protocol name anywhere in the cell, ignoring case
+SERVICE_PATTERN = re.compile('|'.join(re.escape(name) for name in SERVICES + PROTOCOLS), re.IGNORECASE)
+
+# Define header variations to look for
+HEADER_VARIATIONS = {
+    'source_ips': ['source', 'sources', 'src', 'source ip', 'source ips'],
+    'dest_ips': ['destination', 'destinations', 'dst', 'dest', 'destination ip', 'destination ips'],
+    'services': ['port', 'ports', 'service', 'services', 'protocol', 'protocols'],
+    'comments': ['comment', 'comments', 'description', 'descriptions', 'notes']
+}
+
+# Automatic detection stops reading rows once the column picked for every field has
+# held at least STABLE_SHARE of the rules found, at two checks STABLE_CHECK_INTERVAL rules
+# apart, after at least MIN_SAMPLE_RULES rules
+MIN_SAMPLE_RULES = 200
+STABLE_CHECK_INTERVAL = 100
+STABLE_SHARE = 0.8
 
 
 def find_header_row(sheet, header_variations: Dict[str, List[str]]) -> Tuple[Optional[Dict[str, str]], int]:
@@ -9,20 +34,18 @@ def find_header_row(sheet, header_variations: Dict[str, List[str]]) -> Tuple[Opt
     Searches for header row matching specified variations.
     Returns tuple of (column_mapping, header_row) or (None, -1) if not found.
     """
-    max_row = min(sheet.max_row, 20)  # Only check first 20 rows for headers
-    max_column = sheet.max_column
-
     # Create sets of variations for each field for faster lookup
     variation_sets = {
         field: set(variations + [var.lower() for var in variations])
         for field, variations in header_variations.items()
     }
 
-    for row in range(1, max_row + 1):
+    # Only check first 20 rows for headers
+    for row, values in enumerate(sheet.iter_rows(min_row=1, max_row=20, values_only=True), start=1):
         found_columns = {}
 
-        for col in range(1, max_column + 1):
-            cell_value = str(sheet.cell(row, col).value).strip().lower()
+        for col, value in enumerate(values, start=1):
+            cell_value = str(value).strip().lower()
             if not cell_value or cell_value == 'none':
                 continue
 
@@ -38,88 +61,101 @@ def find_header_row(sheet, header_variations: Dict[str, List[str]]) -> Tuple[Opt
     return None, -1
 
 
-def analyze_excel_workbook(file_path: str) -> Dict[str, Dict[str, str]]:
-    workbook = openpyxl.load_workbook(file_path, data_only=True)
-    result = {}
-
-    # Define header variations to look for
-    header_variations = {
-        'source_ips': ['source', 'sources', 'src', 'source ip', 'source ips'],
-        'dest_ips': ['destination', 'destinations', 'dst', 'dest', 'destination ip', 'destination ips'],
-        'services': ['port', 'ports', 'service', 'services', 'protocol', 'protocols'],
-        'comments': ['comment', 'comments', 'description', 'descriptions', 'notes']
-    }
-
-    for sheet_name in workbook.sheetnames:
+def analyze_workbook_sheet(file_path: str, sheet_name: str) -> Optional[Dict[str, str]]:
+    """Find the rule columns of one sheet, opening the workbook read only so rows are streamed from the file."""
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
         sheet = workbook[sheet_name]
 
         # First try to find headers
-        column_mapping, header_row = find_header_row(sheet, header_variations)
+        column_mapping, header_row = find_header_row(sheet, HEADER_VARIATIONS)
 
         if column_mapping:
             # If headers found, add the start row (one after header)
             column_mapping['start_row'] = str(header_row + 1)
-            result[sheet_name] = column_mapping
-        else:
-            # Fall back to automatic detection
-            sheet_data = analyze_sheet(sheet)
-            if sheet_data:
-                result[sheet_name] = sheet_data
+            return column_mapping
 
-    return result
+        # Fall back to automatic detection
+        return analyze_sheet(sheet) or None
+    finally:
+        workbook.close()
 
 
-def analyze_sheet(sheet) -> Dict[str, str]:
-    max_row = sheet.max_row
-    max_column = sheet.max_column
+def analyze_excel_workbook(file_path: str, max_workers: Optional[int] = None) -> Dict[str, Dict[str, str]]:
+    """Find the rule columns of every sheet, analysing the sheets in parallel processes."""
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    sheet_names = workbook.sheetnames
+    workbook.close()
+
+    if len(sheet_names) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            sheets_data = list(executor.map(analyze_workbook_sheet, repeat(file_path), sheet_names))
+    else:
+        sheets_data = [analyze_workbook_sheet(file_path, sheet_name) for sheet_name in sheet_names]
 
-    ip_pattern = re.compile(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}(?:/[0-9]{1,3}|_[0-9]{1,3})?\b')
-    services = ['HTTP', 'HTTPS', 'DNS', 'FTP', 'SMTP', 'POP3', 'IMAP', 'SSH', 'TELNET', 'RDP']
-    protocols = ['TCP', 'UDP', 'ICMP', 'IP']
+    return {sheet_name: sheet_data for sheet_name, sheet_data in zip(sheet_names, sheets_data) if sheet_data}
 
-    potential_rules = []
 
-    for row in range(1, max_row + 1):
-        rule = analyze_row(sheet, row, max_column, ip_pattern, services, protocols)
-        if rule:
-            potential_rules.append(rule)
+def most_common_columns(field_counts: Dict[str, Counter]) -> Dict[str, str]:
+    return {field: counts.most_common(1)[0][0] for field, counts in field_counts.items()}
 
-    if not potential_rules:
+
+def columns_stable(field_counts: Dict[str, Counter], rule_count: int) -> bool:
+    return all(counts.most_common(1)[0][1] >= STABLE_SHARE * rule_count for counts in field_counts.values())
+
+
+def analyze_sheet(sheet) -> Dict[str, str]:
+    fields = ('source_ips', 'dest_ips', 'services', 'comments')
+    field_counts = {field: Counter() for field in fields}
+    rule_count = 0
+    start_row = None
+    last_columns = None
+
+    for row, values in enumerate(sheet.iter_rows(values_only=True), start=1):
+        rule = analyze_row(values, row)
+        if not rule:
+            continue
+
+        if start_row is None:
+            start_row = row
+        rule_count += 1
+        for field in fields:
+            field_counts[field][rule[field]] += 1
+
+        # Stop early once the column for every field has settled
+        if rule_count >= MIN_SAMPLE_RULES and rule_count % STABLE_CHECK_INTERVAL == 0:
+            columns = most_common_columns(field_counts)
+            if columns == last_columns and columns_stable(field_counts, rule_count):
+                break
+            last_columns = columns
+
+    if not rule_count:
         return {}
 
     # Find the most common column for each field
-    field_columns = {
-        'source_ips': Counter(rule['source_ips'] for rule in potential_rules).most_common(1)[0][0],
-        'dest_ips': Counter(rule['dest_ips'] for rule in potential_rules).most_common(1)[0][0],
-        'services': Counter(rule['services'] for rule in potential_rules).most_common(1)[0][0],
-        'comments': Counter(rule['comments'] for rule in potential_rules).most_common(1)[0][0]
-    }
+    field_columns = most_common_columns(field_counts)
 
     # Find the start row
-    start_row = min(rule['row'] for rule in potential_rules)
-
     field_columns['start_row'] = str(start_row)
     return field_columns
 
 
-def analyze_row(sheet, row: int, max_column: int, ip_pattern, services: List[str], protocols: List[str]) -> Dict[
-    str, str]:
+def analyze_row(values, row: int) -> Optional[Dict[str, str]]:
     source_ips = None
     dest_ips = None
     ports_or_services = None
     comments = None
 
-    for col in range(1, max_column + 1):
-        cell_value = str(sheet.cell(row, col).value).strip()
+    for col, value in enumerate(values, start=1):
+        cell_value = str(value).strip()
         if not cell_value or cell_value == 'None':
             continue
 
-        if not source_ips and ip_pattern.search(cell_value):
+        if not source_ips and IP_PATTERN.search(cell_value):
             source_ips = openpyxl.utils.get_column_letter(col)
-        elif not dest_ips and ip_pattern.search(cell_value):
+        elif not dest_ips and IP_PATTERN.search(cell_value):
             dest_ips = openpyxl.utils.get_column_letter(col)
-        elif not ports_or_services and (any(service.lower() in cell_value.lower() for service in services) or
-                                        any(protocol.lower() in cell_value.lower() for protocol in protocols)):
+        elif not ports_or_services and SERVICE_PATTERN.search(cell_value):
             ports_or_services = openpyxl.utils.get_column_letter(col)
         elif not comments and len(cell_value.split()) > 0:
             comments = openpyxl.utils.get_column_letter(col)
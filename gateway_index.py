@@ -0,0 +1,223 @@
+import argparse
+import glob
+import gzip
+import json
+import os
+from collections import defaultdict
+
+# A reverse index from install on gateway, path segment and topology to the rules and flows of a run,
+# written by generate_output to gateway_index/<output name>.json.gz so a firewall team can find the
+# rules landing on their gateway without searching the workbooks.
+#
+# Each flow of a rule installed on a gateway is one record. The rule IDs, paths and source and
+# destination groups repeat a lot, so each is kept once in a string table and the records and
+# postings are lists of numbers into it. Indexes of any number of runs can be loaded together or
+# merged into one file.
+#
+# Run with: python gateway_index.py gateway FW1 | segment FW1 FW2 | topology COR  INDEX [INDEX ...]
+# or:       python gateway_index.py merge -o merged.json.gz INDEX [INDEX ...]
+# An INDEX can be a file or a directory of them, e.g. the gateway_index directory of a customer.
+
+INDEX_DIRECTORY = "gateway_index"
+INDEX_SUFFIX = ".json.gz"
+FORMAT_VERSION = 1
+
+# Fields of a record, all but flow are numbers in the string table
+RECORD_FIELDS = ('run', 'rule_id', 'flow', 'topology', 'gateway', 'path', 'src', 'dst')
+
+PATH_SEPARATOR = ' --> '
+
+
+def path_segments(path):
+    """The links of a path "A --> B --> C" as (A, B) and (B, C)."""
+    nodes = path.split(PATH_SEPARATOR)
+    return list(zip(nodes, nodes[1:]))
+
+
+def segment_key(a, b):
+    # The same link whichever way the flow crosses it
+    return PATH_SEPARATOR.join(sorted((a, b)))
+
+
+def record_key(record):
+    run, rule_id, flow, _, gateway, path, _, _ = record
+    return run, rule_id, flow, gateway, path
+
+
+class GatewayIndex:
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.records = []
+        # (run, rule_id, flow, gateway, path) of each record, so merging a run twice doesn't add it twice
+        self.record_keys = set()
+        self.gateways = defaultdict(list)
+        self.segments = defaultdict(list)
+        self.topologies = defaultdict(list)
+
+    def intern(self, text):
+        if text not in self.string_ids:
+            self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return self.string_ids[text]
+
+    def add_record(self, run, rule_id, flow, topology, gateway, path, src, dst):
+        record = (self.intern(run), self.intern(rule_id), flow, self.intern(topology),
+                  self.intern(gateway), self.intern(path), self.intern(src), self.intern(dst))
+        key = record_key(record)
+        if key in self.record_keys:
+            return
+        self.record_keys.add(key)
+        record_id = len(self.records)
+        self.records.append(record)
+        self.gateways[gateway].append(record_id)
+        self.topologies[topology].append(record_id)
+        for key in {segment_key(a, b) for a, b in path_segments(path)}:
+            self.segments[key].append(record_id)
+
+    def add_run(self, run, rules_diagrams, node_types=None):
+        """
+        Add the flows of a run from generate_output's rules_diagrams, {path: [(src, dst, "N:TOPOLOGY:GATEWAY, flow F")]}.
+        Gateways that are not firewalls in node_types, {topology: {node: type}}, are left out as they are in the rows.
+        """
+        node_types = node_types or {}
+        for path, path_rules in rules_diagrams.items():
+            path_text = PATH_SEPARATOR.join(path)
+            for src, dst, label in path_rules:
+                rule_id, _, flow = label.partition(', flow ')
+                _, topology, gateway = rule_id.split(':', 2)
+                if node_types.get(topology, {}).get(gateway, 'firewall') != 'firewall':
+                    continue
+                self.add_record(run, rule_id, int(flow), topology, gateway, path_text,
+                                ', '.join(src), ', '.join(dst))
+
+    def merge(self, other):
+        """Add the records of another index, leaving out the ones already in this index."""
+        for record in other.records:
+            fields = [other.strings[value] if name != 'flow' else value
+                      for name, value in zip(RECORD_FIELDS, record)]
+            self.add_record(*fields)
+
+    def record(self, record_id):
+        return {name: self.strings[value] if name != 'flow' else value
+                for name, value in zip(RECORD_FIELDS, self.records[record_id])}
+
+    def lookup(self, postings, topology=None, run=None):
+        records = [self.record(record_id) for record_id in postings]
+        return [record for record in records
+                if (topology is None or record['topology'] == topology) and (run is None or record['run'] == run)]
+
+    def by_gateway(self, gateway, topology=None, run=None):
+        """The flows of the rules installed on a gateway."""
+        return self.lookup(self.gateways.get(gateway, []), topology, run)
+
+    def by_segment(self, a, b, topology=None, run=None):
+        """The flows whose path crosses the link between two nodes, in either direction."""
+        return self.lookup(self.segments.get(segment_key(a, b), []), topology, run)
+
+    def by_topology(self, topology, run=None):
+        return self.lookup(self.topologies.get(topology, []), run=run)
+
+    def runs(self):
+        return sorted({self.strings[record[0]] for record in self.records})
+
+    def save(self, filename):
+        data = {
+            'version': FORMAT_VERSION,
+            'strings': self.strings,
+            'records': self.records,
+            'gateways': self.gateways,
+            'segments': self.segments,
+            'topologies': self.topologies,
+        }
+        with gzip.open(filename, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, filename):
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != FORMAT_VERSION:
+            raise ValueError(f"{filename} is not a version {FORMAT_VERSION} gateway index")
+
+        index = cls()
+        index.strings = data['strings']
+        index.string_ids = {text: string_id for string_id, text in enumerate(index.strings)}
+        index.records = [tuple(record) for record in data['records']]
+        index.record_keys = {record_key(record) for record in index.records}
+        for name in ('gateways', 'segments', 'topologies'):
+            getattr(index, name).update(data[name])
+        return index
+
+
+def index_files(paths):
+    """The index files named, with each directory replaced by the index files in it."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, f"*{INDEX_SUFFIX}"))))
+        else:
+            files.append(path)
+    return files
+
+
+def load_indexes(paths):
+    """Load and merge the indexes, a single index is used as it is."""
+    files = index_files(paths)
+    if len(files) == 1:
+        return GatewayIndex.load(files[0])
+    index = GatewayIndex()
+    for filename in files:
+        index.merge(GatewayIndex.load(filename))
+    return index
+
+
+def format_records(records):
+    lines = []
+    for record in records:
+        lines.append(f"{record['run']}\t{record['rule_id']}, flow {record['flow']}\t{record['path']}\t"
+                     f"{record['src']} -> {record['dst']}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the rules and flows on a gateway, link or topology.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gateway_parser = commands.add_parser('gateway', help="Flows installed on a gateway")
+    gateway_parser.add_argument('gateway')
+
+    segment_parser = commands.add_parser('segment', help="Flows crossing the link between two nodes")
+    segment_parser.add_argument('a')
+    segment_parser.add_argument('b')
+
+    topology_parser = commands.add_parser('topology', help="Flows in a topology")
+    topology_parser.add_argument('name')
+
+    for command_parser in (gateway_parser, segment_parser, topology_parser):
+        command_parser.add_argument('--run', help="Only this run, the output name of generate_output")
+    for command_parser in (gateway_parser, segment_parser):
+        command_parser.add_argument('--topology')
+
+    merge_parser = commands.add_parser('merge', help="Merge the indexes into one file")
+    merge_parser.add_argument('-o', '--output', required=True)
+
+    for command_parser in (gateway_parser, segment_parser, topology_parser, merge_parser):
+        command_parser.add_argument('indexes', nargs='+', help="Index files, or directories of them")
+
+    args = parser.parse_args()
+    index = load_indexes(args.indexes)
+
+    if args.command == 'gateway':
+        print(format_records(index.by_gateway(args.gateway, args.topology, args.run)))
+    elif args.command == 'segment':
+        print(format_records(index.by_segment(args.a, args.b, args.topology, args.run)))
+    elif args.command == 'topology':
+        print(format_records(index.by_topology(args.name, args.run)))
+    elif args.command == 'merge':
+        index.save(args.output)
+        print(f"Merged {len(index.records)} flows of {len(index.runs())} runs into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
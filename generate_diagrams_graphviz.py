@@ -1,125 +1,41 @@
 from graphviz import Digraph, Source
-from collections import defaultdict
-import group_diagram_comments
-
-# Set up node type shapes
-NODE_STYLE_MAP = {
-    'firewall': 'box',
-    'router': 'diamond',
-    'zone': 'ellipse',
-    'server': 'oval'
-}
-
-# Define node style map
-NODE_STYLE_MAP = {
-    'firewall': 'box',
-    'router': 'diamond',
-    'zone': 'ellipse',
-    'server': 'oval'
-}
-
-# Define color pairs for different node types
-NODE_COLOR_MAP = {
-    'firewall': ('#FF9933', '#994C00'),  # Orange fill, Dark orange border
-    'router': ('#66B3FF', '#004080'),  # Light blue, Dark blue
-    'zone': ('#90EE90', '#228B22'),  # Light green, Forest green
-    'server': ('#FFDAB9', '#CD853F')  # Peach puff, Peru
-}
-
-# Default color for nodes without a specific type
-DEFAULT_COLORS = ('#FF9933', '#994C00')  # Orange fill, Dark orange border
-
-def format_ip_list(ip_list, max_display):
-    """
-    Format the IP list based on max_display parameter.
-    If list length <= max_display, show all IPs.
-    Otherwise, show first max_display-1 IPs and the last IP.
-    """
-    if len(ip_list) <= max_display:
-        return '\n'.join(ip_list)
-    else:
-        displayed_ips = ip_list[:max_display - 1] + ['...', ip_list[-1]]
-        return '\n'.join(displayed_ips)
-
-
-def process_tuples(tuple_list):
-    """
-    Group tuples by their first two elements.
-    """
-    if not tuple_list or not isinstance(tuple_list[0], tuple):
-        return tuple_list
-
-    # Create a defaultdict to group tuples by their first two elements
-    grouped = defaultdict(list)
-
-    # Group tuples by their first two elements
-    for item in tuple_list:
-        key = (tuple(item[0]) if isinstance(item[0], list) else item[0],
-               tuple(item[1]) if isinstance(item[1], list) else item[1])
-        grouped[key].append(item[2])
-
-    # Combine the grouped items
-    result = []
-    for key, comments in grouped.items():
-        result.append((list(key[0]) if isinstance(key[0], tuple) else key[0],
-                       list(key[1]) if isinstance(key[1], tuple) else key[1],
-                       comments))
-
-    return result
-
-
-def create_network_diagram(
+import graphviz
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import render_cache
+from job_progress import check_cancelled, run_jobs
+from diagram_labels import format_ip_label, comments_label, edge_flow_label, process_tuples
+from diagram_styles import (NODE_STYLE_MAP, NODE_COLOR_MAP, DEFAULT_COLORS, GROUP_COLOR_PAIRS,
+                            FLOW_EDGE_COLOR, UNUSED_EDGE_COLOR, edge_width)
+
+
+def build_network_diagram(
         flow,
         ip_data,
-        image_filename,
-        src_filename,
         diagram_type="multi",  # Options: "multi", "single"
         node_comments=False,  # Controls comment display for both diagram types
         max_ips_display=5,
         node_type_map=None,
-        node_name_map=None
+        node_name_map=None,
+        max_comment_rules=None
 ):
     """
-    Unified function to create network flow diagrams.
+    Build the Digraph for a network flow diagram without rendering it.
 
-    Parameters:
-    -----------
-    flow : list
-        List of network nodes (e.g., firewalls) in the flow
-    ip_data : list or tuple
-        For diagram_type="multi": List of tuples (src_ips, dst_ips, comments)
-        For diagram_type="single": Tuple of (src_ips, dst_ips, comments)
-    image_filename : str
-        Base filename for the output diagram image
-    src_filename : str
-        Base filename for the source file
-    diagram_type : str, optional
-        "multi" for multiple source/destination IP groups
-        "single" for a single source/destination group
-    node_comments : bool, optional
-        Controls comment display differently based on diagram_type:
-        - For single diagrams: controls whether comments appear as diagram title/label (never inside nodes)
-        - For multi diagrams: controls whether comments appear inside the nodes
-    max_ips_display : int, optional
-        Maximum number of IPs to display for each node
-    node_type_map : dict, optional
-        Mapping of node names to their types for shape determination
-    node_name_map : dict, optional
-        Mapping of node IDs to display names
+    Takes the same parameters as create_network_diagram, minus the output file names.
 
     Returns:
     --------
-    str or None
-        Path to the generated diagram file, or None if rendering failed
+    graphviz.Digraph
+        The diagram ready to be rendered or written out as DOT source
     """
     # Create the Digraph object
     dot = Digraph(comment='Network Flow Diagram')
     dot.attr(rankdir='LR')  # Left to Right layout
     dot.attr(bgcolor='#F0F8FF')  # Light blue background
 
-    # Default color for nodes without a specific type
-    DEFAULT_COLORS = ('#FF9933', '#994C00')  # Orange fill, Dark orange border
-
     # Handle different diagram types
     if diagram_type == "single":
         # Convert single tuple to expected format
@@ -130,10 +46,9 @@ def create_network_diagram(
             if comments and node_comments:
                 if isinstance(comments, list):
                     comments_str = '\n// '.join(comments)
-                    label_str = group_diagram_comments.group_data(comments)
                 else:
                     comments_str = str(comments)
-                    label_str = str(comments)
+                label_str = comments_label(comments, max_comment_rules)
                 dot.attr(comment=comments_str)
                 dot.attr(label=label_str, labelloc='t', fontsize='12')
 
@@ -191,45 +106,18 @@ def create_network_diagram(
     for i in range(len(flow) - 1):
         dot.edge(flow[i], flow[i + 1], color='#994C00')
 
-    # Define different color pairs (fillcolor, color) for multiple groups
-    color_pairs = [
-        ('#66B3FF', '#004080'),  # Light blue, Dark blue
-        ('#FFDAB9', '#CD853F'),  # Peach puff, Peru
-        ('#87CEFA', '#4682B4'),  # Light sky blue, Steel blue
-        ('#AFEEEE', '#5F9EA0'),  # Pale turquoise, Cadet blue
-        ('#F0FFF0', '#228B22'),  # Honeydew, Forest green
-        ('#F0FFFF', '#00CED1'),  # Azure, Dark turquoise
-        ('#FAF0E6', '#D2691E')  # Linen, Chocolate
-    ]
-
     # Create nodes for each source/destination IP group
     for idx, (src_ip, dst_ip, comments) in enumerate(ip_tuples):
         # Get color pair for this iteration
-        fillcolor, color = color_pairs[idx % len(color_pairs)]
+        fillcolor, color = GROUP_COLOR_PAIRS[idx % len(GROUP_COLOR_PAIRS)]
 
-        # Sort IP lists for consistent display
-        if isinstance(src_ip, list):
-            src_ip.sort()
-        if isinstance(dst_ip, list):
-            dst_ip.sort()
-
-        # Format the IP labels
-        if isinstance(src_ip, list):
-            src_label = format_ip_list(src_ip, max_ips_display)
-        else:
-            src_label = str(src_ip)
-
-        if isinstance(dst_ip, list):
-            dst_label = format_ip_list(dst_ip, max_ips_display)
-        else:
-            dst_label = str(dst_ip)
+        # Format the IP labels, sorted for consistent display and capped at max_ips_display
+        src_label = format_ip_label(src_ip, max_ips_display)
+        dst_label = format_ip_label(dst_ip, max_ips_display)
 
         # Add node comments if enabled (but only for multi diagrams)
         if node_comments and comments and diagram_type == "multi":
-            if isinstance(comments, list):
-                comments_text = group_diagram_comments.group_data(comments)
-            else:
-                comments_text = str(comments)
+            comments_text = comments_label(comments, max_comment_rules)
             prefix = f"{comments_text}\\n"
         else:
             prefix = ""
@@ -247,12 +135,69 @@ def create_network_diagram(
         dot.edge(src_node, flow[0], label='src', color=color)
         dot.edge(flow[-1], dst_node, label='dst', color=color)
 
+    return dot
+
+
+def create_network_diagram(
+        flow,
+        ip_data,
+        image_filename,
+        src_filename,
+        diagram_type="multi",  # Options: "multi", "single"
+        node_comments=False,  # Controls comment display for both diagram types
+        max_ips_display=5,
+        node_type_map=None,
+        node_name_map=None,
+        max_comment_rules=None,
+        cache_dir=None
+):
+    """
+    Unified function to create network flow diagrams.
+
+    Parameters:
+    -----------
+    flow : list
+        List of network nodes (e.g., firewalls) in the flow
+    ip_data : list or tuple
+        For diagram_type="multi": List of tuples (src_ips, dst_ips, comments)
+        For diagram_type="single": Tuple of (src_ips, dst_ips, comments)
+    image_filename : str
+        Base filename for the output diagram image
+    src_filename : str
+        Base filename for the source file
+    diagram_type : str, optional
+        "multi" for multiple source/destination IP groups
+        "single" for a single source/destination group
+    node_comments : bool, optional
+        Controls comment display differently based on diagram_type:
+        - For single diagrams: controls whether comments appear as diagram title/label (never inside nodes)
+        - For multi diagrams: controls whether comments appear inside the nodes
+    max_ips_display : int, optional
+        Maximum number of IPs to display for each node, longer lists are summarized
+    node_type_map : dict, optional
+        Mapping of node names to their types for shape determination
+    node_name_map : dict, optional
+        Mapping of node IDs to display names
+    max_comment_rules : int, optional
+        Maximum number of rules listed per firewall in the comment labels
+    cache_dir : str, optional
+        Directory of previously rendered images keyed by source hash
+
+    Returns:
+    --------
+    str or None
+        Path to the generated diagram file, or None if rendering failed
+    """
+    dot = build_network_diagram(flow, ip_data,
+                                diagram_type=diagram_type,
+                                node_comments=node_comments,
+                                max_ips_display=max_ips_display,
+                                node_type_map=node_type_map,
+                                node_name_map=node_name_map,
+                                max_comment_rules=max_comment_rules)
+
     # Render the diagram
-    try:
-        diagram_file = dot.render(image_filename, view=False, cleanup=True, format="png")
-    except Exception as e:
-        print(f"Error rendering diagram: {e}")
-        diagram_file = None
+    diagram_file = render_source(dot.source, image_filename, cache_dir=cache_dir)
 
     # Write the source to a file
     with open(src_filename + '.txt', "w") as f:
@@ -261,7 +206,182 @@ def create_network_diagram(
     return diagram_file
 
 
-def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_name_map=None):
+def render_source(dot_source, image_filename, image_format="png", cache_dir=None):
+    """
+    Render DOT source to image_filename with the extension for image_format appended.
+    Each call runs its own dot process so calls can safely run concurrently
+    as long as the image file names differ.
+
+    If cache_dir is given and the same source has been rendered before,
+    the cached image is copied into place instead of running dot.
+
+    Returns the path to the rendered image, or None if rendering failed.
+    """
+    image_file = f"{image_filename}.{image_format}"
+    if render_cache.fetch(cache_dir, dot_source, image_format, image_file):
+        return image_file
+
+    try:
+        diagram_file = Source(dot_source).render(image_filename, view=False, cleanup=True, format=image_format)
+    except Exception as e:
+        print(f"Error rendering diagram: {e}")
+        return None
+
+    render_cache.store(cache_dir, dot_source, image_format, diagram_file)
+    return diagram_file
+
+
+def render_sources(render_jobs, max_workers=None, cache_dir=None, progress=None, cancel_event=None):
+    """
+    Render a list of (dot_source, image_filename) jobs through a bounded pool of dot processes.
+
+    progress and cancel_event are passed to job_progress.run_jobs, progress is called as each render
+    finishes and no more renders are started once cancel_event is set.
+
+    Returns the rendered image paths (or None for failures) in the same order as render_jobs.
+    """
+    if not render_jobs:
+        return []
+
+    max_workers = min(max_workers or os.cpu_count() or 1, len(render_jobs))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Results come back in submission order regardless of which render finishes first
+        return run_jobs(lambda job: render_source(*job, cache_dir=cache_dir), render_jobs, executor,
+                        max_workers, progress, cancel_event)
+
+
+def batch_output_filename(batch_filename, graph_index, image_format="png"):
+    """
+    Name dot -O gives the image for each graph in a multi-graph file:
+    the first graph is <file>.<format>, later graphs are <file>.<n>.<format> counting from 2.
+    """
+    if graph_index == 0:
+        return f"{batch_filename}.{image_format}"
+    return f"{batch_filename}.{graph_index + 1}.{image_format}"
+
+
+def render_sources_batch(render_jobs, image_format="png", max_workers=None, cache_dir=None, progress=None,
+                         cancel_event=None):
+    """
+    Render a list of (dot_source, image_filename) jobs with a single dot invocation.
+
+    All sources not already in the cache are written into one multi-graph DOT file
+    and rendered together, then each output is moved to its expected image file name.
+    Any graph the batch fails to produce is rendered individually instead. progress is called
+    once the batch is done and as each retry finishes, cancel_event is checked before each.
+
+    Returns the rendered image paths (or None for failures) in the same order as render_jobs.
+    """
+    results = [None] * len(render_jobs)
+    pending = []
+    for index, (dot_source, image_filename) in enumerate(render_jobs):
+        image_file = f"{image_filename}.{image_format}"
+        if render_cache.fetch(cache_dir, dot_source, image_format, image_file):
+            results[index] = image_file
+        else:
+            pending.append(index)
+
+    if not pending:
+        if progress:
+            progress(len(render_jobs), len(render_jobs))
+        return results
+
+    check_cancelled(cancel_event)
+    # Keep the batch file alongside the images so the outputs can be moved rather than copied
+    batch_dir = os.path.dirname(os.path.abspath(render_jobs[pending[0]][1]))
+    with tempfile.TemporaryDirectory(dir=batch_dir) as tmp_dir:
+        batch_filename = os.path.join(tmp_dir, "batch.gv")
+        with open(batch_filename, "w") as f:
+            f.write("\n".join(render_jobs[index][0] for index in pending))
+
+        try:
+            graphviz.render("dot", image_format, batch_filename)
+        except Exception as e:
+            print(f"Error rendering diagram batch: {e}")
+
+        for graph_index, index in enumerate(pending):
+            dot_source, image_filename = render_jobs[index]
+            batch_output = batch_output_filename(batch_filename, graph_index, image_format)
+            if os.path.exists(batch_output):
+                image_file = f"{image_filename}.{image_format}"
+                shutil.move(batch_output, image_file)
+                render_cache.store(cache_dir, dot_source, image_format, image_file)
+                results[index] = image_file
+
+    # Fall back to rendering one at a time for anything the batch didn't produce
+    failed = [index for index in pending if results[index] is None]
+    if progress:
+        progress(len(render_jobs) - len(failed), len(render_jobs))
+    if failed:
+        check_cancelled(cancel_event)
+        retry_progress = (lambda done, _: progress(len(render_jobs) - len(failed) + done, len(render_jobs))) \
+            if progress else None
+        retried = render_sources([render_jobs[index] for index in failed], max_workers=max_workers,
+                                 cache_dir=cache_dir, progress=retry_progress, cancel_event=cancel_event)
+        for index, diagram_file in zip(failed, retried):
+            results[index] = diagram_file
+
+    return results
+
+
+def create_network_diagrams(diagrams, max_workers=None, cache_dir=None, render_mode="parallel", dpi=None,
+                            progress=None, cancel_event=None):
+    """
+    Create many network flow diagrams.
+
+    All DOT sources are generated and written to their source files first,
+    then the images are rendered together.
+
+    Parameters:
+    -----------
+    diagrams : list of dict
+        Keyword arguments for create_network_diagram, one dict per diagram
+    max_workers : int, optional
+        Maximum number of dot processes to run at once, defaults to the CPU count
+    cache_dir : str, optional
+        Directory of previously rendered images keyed by source hash,
+        diagrams whose source is already cached are not rendered again
+    render_mode : str, optional
+        "parallel" renders each diagram with its own dot process through a bounded pool,
+        "batch" renders all the diagrams with a single dot process
+    dpi : int, optional
+        Accepted for compatibility with the matplotlib backend, not used
+    progress : callable, optional
+        Called with (done, total) as the diagrams are rendered
+    cancel_event : threading.Event, optional
+        When set no more diagrams are rendered and ProcessingCancelled is raised
+        once the ones already rendering finish
+
+    Returns:
+    --------
+    list
+        Path to each generated diagram file (or None if rendering failed),
+        in the same order as diagrams
+    """
+    render_jobs = []
+    for params in diagrams:
+        params = dict(params)
+        image_filename = params.pop('image_filename')
+        src_filename = params.pop('src_filename')
+        dot = build_network_diagram(**params)
+
+        with open(src_filename + '.txt', "w") as f:
+            f.write(dot.source)
+
+        render_jobs.append((dot.source, image_filename))
+
+    if render_mode == "batch":
+        return render_sources_batch(render_jobs, max_workers=max_workers, cache_dir=cache_dir, progress=progress,
+                                    cancel_event=cancel_event)
+    elif render_mode == "parallel":
+        return render_sources(render_jobs, max_workers=max_workers, cache_dir=cache_dir, progress=progress,
+                              cancel_event=cancel_event)
+    else:
+        raise ValueError("render_mode must be either 'parallel' or 'batch'")
+
+
+def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_name_map=None,
+                         edge_flows=None, max_comment_rules=None):
     """
     Convert Mermaid flowchart syntax to DOT format for Graphviz
 
@@ -270,6 +390,10 @@ def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_nam
         title (str, optional): Title to be displayed on the graph. Defaults to None.
         node_type_map (dict, optional): Mapping of node names to their types for shape determination
         node_name_map (dict, optional): Mapping of node IDs to display names
+        edge_flows (dict, optional): Flow counts per rule for each link keyed on the sorted node pair,
+            from helpers.get_overlay_data. When given the requested flows are overlaid on the topology,
+            links are labelled with their rules and drawn wider the more flows cross them.
+        max_comment_rules (int, optional): Maximum number of rules listed on an overlay link
 
     Returns:
         str: Converted flowchart in DOT format
@@ -352,23 +476,42 @@ def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_nam
 
     # Add connections
     dot_output.append('    // Define bidirectional connections')
+    max_flow_count = max((sum(rule_flows.values()) for rule_flows in edge_flows.values()),
+                         default=0) if edge_flows else 0
     for node1, node2 in connections:
         node1_formatted = node1.replace('-', '_')
         node2_formatted = node2.replace('-', '_')
-        dot_output.append(f'    {node1_formatted} -> {node2_formatted} [dir=both, color="#994C00"];')
+        if edge_flows is None:
+            dot_output.append(f'    {node1_formatted} -> {node2_formatted} [dir=both, color="{FLOW_EDGE_COLOR}"];')
+            continue
+
+        rule_flows = edge_flows.get(tuple(sorted((node1, node2))))
+        if rule_flows:
+            label = edge_flow_label(rule_flows, max_comment_rules).replace('"', '\\"').replace('\n', '\\n')
+            dot_output.append(
+                f'    {node1_formatted} -> {node2_formatted} [dir=both, color="{FLOW_EDGE_COLOR}", '
+                f'penwidth={edge_width(sum(rule_flows.values()), max_flow_count):.1f}, label="{label}", fontsize=10];')
+        else:
+            dot_output.append(
+                f'    {node1_formatted} -> {node2_formatted} [dir=both, color="{UNUSED_EDGE_COLOR}", style=dashed];')
 
     dot_output.append('}')
 
     return '\n'.join(dot_output)
 
 
-def render_diagram(diagram_src, output_image):
+def render_diagram(diagram_src, output_image, cache_dir=None, dpi=None):
     try:
         with open(diagram_src, 'r') as f:
             dot_source = f.read()
 
+        if render_cache.fetch(cache_dir, dot_source, 'png', output_image):
+            print(f"Rendered (cached): {output_image}")
+            return
+
         graph = Source(dot_source)
         graph.render(output_image.replace('.png', ''), format='png', cleanup=True)
+        render_cache.store(cache_dir, dot_source, 'png', output_image)
         print(f"Rendered: {output_image}")
     except Exception as e:
         print(f"Error rendering {diagram_src}: {str(e)}")
\ No newline at end of file
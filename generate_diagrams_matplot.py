@@ -1,9 +1,16 @@
 import networkx as nx
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-from collections import defaultdict
+# Draw through the object oriented Figure API on the Agg canvas, never pyplot,
+# so rendering holds no global state and works headless and in worker processes
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
 import os
-import random
+from diagram_styles import (NODE_COLOR_MAP, DEFAULT_COLORS, GROUP_COLOR_PAIRS, FLOW_EDGE_COLOR,
+                            create_node_label, overlay_edge_flows)
+from diagram_labels import format_ip_label, comments_label, process_tuples
+from job_progress import run_jobs
 
 # Define node style maps (unchanged from original)
 NODE_STYLE_MAP = {
@@ -13,98 +20,6 @@ NODE_STYLE_MAP = {
     'server': 'o'  # circle (closest to oval)
 }
 
-# Define color pairs for different node types (unchanged from original)
-NODE_COLOR_MAP = {
-    'firewall': ('#FF9933', '#994C00'),  # Orange fill, Dark orange border
-    'router': ('#66B3FF', '#004080'),  # Light blue, Dark blue
-    'zone': ('#90EE90', '#228B22'),  # Light green, Forest green
-    'server': ('#FFDAB9', '#CD853F')  # Peach puff, Peru
-}
-
-# Default color for nodes without a specific type
-DEFAULT_COLORS = ('#FF9933', '#994C00')  # Orange fill, Dark orange border
-
-# Color pairs for multiple groups
-GROUP_COLOR_PAIRS = [
-    ('#66B3FF', '#004080'),  # Light blue, Dark blue
-    ('#FFDAB9', '#CD853F'),  # Peach puff, Peru
-    ('#87CEFA', '#4682B4'),  # Light sky blue, Steel blue
-    ('#AFEEEE', '#5F9EA0'),  # Pale turquoise, Cadet blue
-    ('#F0FFF0', '#228B22'),  # Honeydew, Forest green
-    ('#F0FFFF', '#00CED1'),  # Azure, Dark turquoise
-    ('#FAF0E6', '#D2691E')  # Linen, Chocolate
-]
-
-
-def format_ip_list(ip_list, max_display):
-    """
-    Format the IP list based on max_display parameter.
-    If list length <= max_display, show all IPs.
-    Otherwise, show first max_display-1 IPs and the last IP.
-    """
-    if len(ip_list) <= max_display:
-        return '\n'.join(ip_list)
-    else:
-        displayed_ips = ip_list[:max_display - 1] + ['...', ip_list[-1]]
-        return '\n'.join(displayed_ips)
-
-
-def process_tuples(tuple_list):
-    """
-    Group tuples by their first two elements.
-    """
-    if not tuple_list or not isinstance(tuple_list[0], tuple):
-        return tuple_list
-
-    # Create a defaultdict to group tuples by their first two elements
-    grouped = defaultdict(list)
-
-    # Group tuples by their first two elements
-    for item in tuple_list:
-        key = (tuple(item[0]) if isinstance(item[0], list) else item[0],
-               tuple(item[1]) if isinstance(item[1], list) else item[1])
-        grouped[key].append(item[2])
-
-    # Combine the grouped items
-    result = []
-    for key, comments in grouped.items():
-        result.append((list(key[0]) if isinstance(key[0], tuple) else key[0],
-                       list(key[1]) if isinstance(key[1], tuple) else key[1],
-                       comments))
-
-    return result
-
-
-def create_node_label(node_id, node_type_map=None, node_name_map=None):
-    """
-    Create a node label based on mappings.
-    """
-    node_type_caption = ""
-
-    # Apply node type mapping if available
-    if node_type_map and node_id in node_type_map:
-        node_type = node_type_map[node_id]
-        node_type_caption = node_type.capitalize()
-
-    # Get node name if available
-    node_name_caption = node_name_map.get(node_id) if node_name_map else None
-
-    # Prepare the caption
-    if node_name_caption:
-        # Use node_name_caption as primary name
-        if node_type_caption:
-            node_caption = f"{node_name_caption}\n({node_type_caption})"
-        else:
-            node_caption = node_name_caption
-    else:
-        # Fall back to node_id if no node_name_caption is available
-        if node_type_caption:
-            node_caption = f"{node_id}\n({node_type_caption})"
-        else:
-            node_caption = node_id
-
-    return node_caption
-
 
 def create_network_diagram(
         flow,
@@ -115,7 +30,9 @@ def create_network_diagram(
         node_comments=False,  # Controls comment display for both diagram types
         max_ips_display=5,
         node_type_map=None,
-        node_name_map=None
+        node_name_map=None,
+        max_comment_rules=None,
+        dpi=300
 ):
     """
     Unified function to create network flow diagrams using NetworkX and Matplotlib.
@@ -137,11 +54,15 @@ def create_network_diagram(
     node_comments : bool, optional
         Controls comment display differently based on diagram_type
     max_ips_display : int, optional
-        Maximum number of IPs to display for each node
+        Maximum number of IPs to display for each node, longer lists are summarized
     node_type_map : dict, optional
         Mapping of node names to their types for shape determination
     node_name_map : dict, optional
         Mapping of node IDs to display names
+    max_comment_rules : int, optional
+        Maximum number of rules listed per firewall in the comment labels
+    dpi : int, optional
+        Resolution of the saved image
 
     Returns:
     --------
@@ -171,8 +92,9 @@ def create_network_diagram(
         raise ValueError("diagram_type must be either 'multi' or 'single'")
 
     # Create figure and axis
-    plt.figure(figsize=(14, 8))
-    ax = plt.gca()
+    fig = Figure(figsize=(14, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
     # Add flow nodes to the graph
     for i, node_id in enumerate(flow):
@@ -207,30 +129,13 @@ def create_network_diagram(
         # Get color pair for this iteration
         fillcolor, edgecolor = GROUP_COLOR_PAIRS[idx % len(GROUP_COLOR_PAIRS)]
 
-        # Sort IP lists for consistent display
-        if isinstance(src_ip, list):
-            src_ip.sort()
-        if isinstance(dst_ip, list):
-            dst_ip.sort()
-
-        # Format the IP labels
-        if isinstance(src_ip, list):
-            src_label = format_ip_list(src_ip, max_ips_display)
-        else:
-            src_label = str(src_ip)
-
-        if isinstance(dst_ip, list):
-            dst_label = format_ip_list(dst_ip, max_ips_display)
-        else:
-            dst_label = str(dst_ip)
+        # Format the IP labels, sorted for consistent display and capped at max_ips_display
+        src_label = format_ip_label(src_ip, max_ips_display)
+        dst_label = format_ip_label(dst_ip, max_ips_display)
 
         # Add node comments if enabled (but only for multi diagrams)
         if node_comments and comments and diagram_type == "multi":
-            if isinstance(comments, list):
-                # In a real implementation, you would include group_diagram_comments.group_data here
-                comments_text = " / ".join(comments)
-            else:
-                comments_text = str(comments)
+            comments_text = comments_label(comments, max_comment_rules).strip()
 
             src_label = f"{comments_text}\n{src_label}"
             dst_label = f"{comments_text}\n{dst_label}"
@@ -269,13 +174,8 @@ def create_network_diagram(
 
     # Add title for single diagram type
     if diagram_type == "single" and node_comments and ip_tuples[0][2]:
-        comments = ip_tuples[0][2]
-        if isinstance(comments, list):
-            # In a real implementation, you would include group_diagram_comments.group_data here
-            title = " / ".join(comments)
-        else:
-            title = str(comments)
-        plt.title(title, fontsize=12)
+        title = comments_label(ip_tuples[0][2], max_comment_rules).strip()
+        ax.set_title(title, fontsize=12)
 
     # Draw the network diagram
     try:
@@ -296,7 +196,8 @@ def create_network_diagram(
                 node_color=G.nodes[node]['fillcolor'],
                 edgecolors=G.nodes[node]['edgecolor'],
                 node_size=3000,
-                alpha=0.8
+                alpha=0.8,
+                ax=ax
             )
 
         # Draw IP group nodes
@@ -308,7 +209,8 @@ def create_network_diagram(
                 node_color=G.nodes[node]['fillcolor'],
                 edgecolors=G.nodes[node]['edgecolor'],
                 node_size=5000,
-                alpha=0.8
+                alpha=0.8,
+                ax=ax
             )
 
         # Draw edges
@@ -321,7 +223,8 @@ def create_network_diagram(
             width=2,
             edge_color='#994C00',
             arrows=True,
-            arrowstyle='->'
+            arrowstyle='->',
+            ax=ax
         )
 
         # Draw IP connection edges with different colors
@@ -332,12 +235,13 @@ def create_network_diagram(
             width=1.5,
             edge_color=edge_colors,
             arrows=True,
-            arrowstyle='->'
+            arrowstyle='->',
+            ax=ax
         )
 
         # Draw edge labels
         edge_labels = {(u, v): data.get('label', '') for u, v, data in G.edges(data=True) if 'label' in data}
-        nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_size=10)
+        nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_size=10, ax=ax)
 
         # Draw node labels
         node_labels = {node: data.get('label', node) for node, data in G.nodes(data=True)}
@@ -346,17 +250,17 @@ def create_network_diagram(
         for node_type, nodes in [('flow', flow_nodes), ('ip', ip_nodes)]:
             labels = {n: node_labels[n] for n in nodes}
             font_size = 10 if node_type == 'flow' else 8
-            nx.draw_networkx_labels(G, pos, labels=labels, font_size=font_size, font_weight='bold')
+            nx.draw_networkx_labels(G, pos, labels=labels, font_size=font_size, font_weight='bold', ax=ax)
 
         # Set background color
         ax.set_facecolor('#F0F8FF')  # Light blue background
 
         # Remove axes
-        plt.axis('off')
+        ax.axis('off')
 
         # Adjust layout and save
-        plt.tight_layout()
-        plt.savefig(f"{image_filename}.png", dpi=300, bbox_inches='tight')
+        fig.tight_layout()
+        fig.savefig(f"{image_filename}.png", dpi=dpi, bbox_inches='tight')
         diagram_file = f"{image_filename}.png"
 
         # Write the graph structure to a file
@@ -369,16 +273,51 @@ def create_network_diagram(
             for u, v, data in G.edges(data=True):
                 f.write(f"  {u} -> {v}: {data}\n")
 
-        plt.close()
         return diagram_file
 
     except Exception as e:
         print(f"Error rendering diagram: {e}")
-        plt.close()
         return None
 
 
-def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_name_map=None):
+def _create_network_diagram_from_params(params):
+    # Module level so it can be sent to worker processes
+    return create_network_diagram(**params)
+
+
+def create_network_diagrams(diagrams, max_workers=None, cache_dir=None, render_mode=None, dpi=300, progress=None,
+                            cancel_event=None):
+    """
+    Create many network flow diagrams, drawing them in a pool of worker processes.
+
+    Matches the interface of the Graphviz backend, diagrams is a list of keyword
+    argument dicts for create_network_diagram. cache_dir and render_mode are
+    accepted for compatibility and ignored.
+
+    Args:
+        diagrams (list): Keyword arguments for create_network_diagram, one dict per diagram
+        max_workers (int, optional): Number of worker processes, defaults to the CPU count
+        dpi (int, optional): Resolution of the saved images
+        progress (callable, optional): Called with (done, total) as the diagrams are drawn
+        cancel_event (threading.Event, optional): When set no more diagrams are drawn and ProcessingCancelled
+            is raised once the ones already drawing finish
+
+    Returns:
+        list: Path to each generated diagram file (or None), in the same order as diagrams
+    """
+    diagrams = [dict(params, dpi=dpi) for params in diagrams]
+    if len(diagrams) <= 1 or max_workers == 1:
+        return run_jobs(_create_network_diagram_from_params, diagrams, progress=progress, cancel_event=cancel_event)
+
+    max_workers = min(max_workers or os.cpu_count() or 1, len(diagrams))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # Results come back in submission order regardless of which drawing finishes first
+        return run_jobs(_create_network_diagram_from_params, diagrams, executor, max_workers, progress,
+                        cancel_event)
+
+
+def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_name_map=None,
+                         edge_flows=None, max_comment_rules=None):
     """
     Convert Mermaid flowchart syntax to NetworkX graph
 
@@ -387,6 +326,9 @@ def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_nam
         title (str, optional): Title to be displayed on the graph. Defaults to None.
         node_type_map (dict, optional): Mapping of node names to their types for shape determination
         node_name_map (dict, optional): Mapping of node IDs to display names
+        edge_flows (dict, optional): Flow counts per rule for each link keyed on the sorted node pair,
+            the requested flows are overlaid on the topology when given
+        max_comment_rules (int, optional): Maximum number of rules listed on an overlay link
 
     Returns:
         nx.Graph: NetworkX graph representing the flowchart
@@ -435,29 +377,68 @@ def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_nam
         G.nodes[node]['edgecolor'] = edgecolor
         G.nodes[node]['label'] = label
 
+    # Label and weight each link on the requested flows crossing it, unused links are greyed out
+    if edge_flows is not None:
+        overlay_edge_flows(G, edge_flows, max_comment_rules)
+
     # Set graph attributes
     G.graph['title'] = title
 
     return G
 
 
-def render_diagram(G, output_filename):
+def graph_hash(G):
+    """Hash of the nodes and edges of a topology graph, independent of the order they were added in."""
+    nodes = sorted(str(node) for node in G.nodes)
+    edges = sorted(tuple(sorted((str(u), str(v)))) for u, v in G.edges)
+    return hashlib.sha256(json.dumps([nodes, edges]).encode('utf-8')).hexdigest()
+
+
+def topology_layout(G, cache_dir=None):
+    """
+    Spring layout positions for a topology graph.
+    With a cache_dir the layout is saved keyed on the graph hash and reused on
+    later runs, so the overview is not laid out again and stays the same between runs.
+    """
+    layout_file = os.path.join(cache_dir, f"layout_{graph_hash(G)}.json") if cache_dir else None
+
+    if layout_file and os.path.exists(layout_file):
+        try:
+            with open(layout_file, 'r') as f:
+                return {node: tuple(xy) for node, xy in json.load(f).items()}
+        except (OSError, ValueError) as e:
+            print(f"Error reading layout {layout_file}: {e}")
+
+    pos = nx.spring_layout(G, seed=42)
+
+    if layout_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(layout_file, 'w') as f:
+            json.dump({node: [float(x), float(y)] for node, (x, y) in pos.items()}, f)
+
+    return pos
+
+
+def render_diagram(G, output_filename, cache_dir=None, dpi=300):
     """
     Draw a NetworkX graph as a network diagram using Matplotlib
 
     Args:
         G (nx.Graph): NetworkX graph to draw
-        output_filename (str): Base filename for output image
+        output_filename (str): Filename for the output image
+        cache_dir (str, optional): Directory the computed topology layouts are kept in
+        dpi (int, optional): Resolution of the saved image
 
     Returns:
         str: Path to the generated image file
     """
     # Create figure and axis
-    plt.figure(figsize=(12, 8))
-    ax = plt.gca()
+    fig = Figure(figsize=(12, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
-    # Set positions (using spring layout)
-    pos = nx.spring_layout(G, seed=42)
+    # Set positions (using spring layout, reused from the cache when the topology hasn't changed)
+    pos = topology_layout(G, cache_dir)
 
     # Draw nodes
     for node, data in G.nodes(data=True):
@@ -468,34 +449,41 @@ def render_diagram(G, output_filename):
             node_color=data.get('fillcolor', DEFAULT_COLORS[0]),
             edgecolors=data.get('edgecolor', DEFAULT_COLORS[1]),
             node_size=3000,
-            alpha=0.8
+            alpha=0.8,
+            ax=ax
         )
 
-    # Draw edges (bidirectional)
+    # Draw edges (bidirectional), overlay diagrams carry a colour and width per edge
+    edges = list(G.edges(data=True))
     nx.draw_networkx_edges(
         G, pos,
-        width=2,
-        edge_color='#994C00',
-        arrows=False  # No arrows for undirected
+        edgelist=[(u, v) for u, v, _ in edges],
+        width=[data.get('width', 2) for *_, data in edges],
+        edge_color=[data.get('color', FLOW_EDGE_COLOR) for *_, data in edges],
+        arrows=False,  # No arrows for undirected
+        ax=ax
     )
 
+    edge_labels = {(u, v): data['label'] for u, v, data in edges if data.get('label')}
+    if edge_labels:
+        nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_size=7, ax=ax)
+
     # Draw node labels
     node_labels = {node: data.get('label', node) for node, data in G.nodes(data=True)}
-    nx.draw_networkx_labels(G, pos, labels=node_labels, font_size=10, font_weight='bold')
+    nx.draw_networkx_labels(G, pos, labels=node_labels, font_size=10, font_weight='bold', ax=ax)
 
     # Add title if available
     if 'title' in G.graph and G.graph['title']:
-        plt.title(G.graph['title'], fontsize=14)
+        ax.set_title(G.graph['title'], fontsize=14)
 
     # Set background color
     ax.set_facecolor('#F0F8FF')  # Light blue background
 
     # Remove axes
-    plt.axis('off')
+    ax.axis('off')
 
     # Adjust layout and save
-    plt.tight_layout()
-    plt.savefig(f"{output_filename}", dpi=300, bbox_inches='tight')
+    fig.tight_layout()
+    fig.savefig(f"{output_filename}", dpi=dpi, bbox_inches='tight')
 
-    plt.close()
-    return f"{output_filename}.png"
\ No newline at end of file
+    return output_filename
@@ -0,0 +1,474 @@
+from collections import defaultdict, deque
+import networkx as nx
+from PIL import Image, ImageDraw, ImageFont
+from diagram_labels import format_ip_label, comments_label, process_tuples
+from job_progress import run_jobs
+from diagram_styles import (NODE_STYLE_MAP, NODE_COLOR_MAP, DEFAULT_COLORS, GROUP_COLOR_PAIRS,
+                            BACKGROUND_COLOR, FLOW_EDGE_COLOR, create_node_label, overlay_edge_flows)
+
+# Spacing used by the fixed layouts, in pixels
+MARGIN = 30
+COLUMN_GAP = 90
+ROW_GAP = 20
+NODE_PADDING = (16, 10)
+TEXT_SPACING = 4
+ARROW_SIZE = 9
+
+
+def _load_font(size):
+    # load_default only takes a size on newer Pillow releases
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+FONT = _load_font(14)
+SMALL_FONT = _load_font(12)
+TITLE_FONT = _load_font(16)
+
+# Scratch surface used to measure text before the final image size is known
+_MEASURE = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+
+def text_size(text, font=FONT):
+    left, top, right, bottom = _MEASURE.multiline_textbbox((0, 0), text, font=font, spacing=TEXT_SPACING)
+    return right - left, bottom - top
+
+
+def node_size(label, shape, font=FONT):
+    """Size of the bounding box needed to draw a node of this shape around the label."""
+    width, height = text_size(label, font)
+    width += NODE_PADDING[0] * 2
+    height += NODE_PADDING[1] * 2
+    if shape == 'diamond':
+        return int(width * 1.6), int(height * 1.6)
+    if shape in ('ellipse', 'oval'):
+        return int(width * 1.3), int(height * 1.3)
+    return width, height
+
+
+def draw_text(draw, center, text, font=FONT, fill='black'):
+    left, top, right, bottom = draw.multiline_textbbox((0, 0), text, font=font, spacing=TEXT_SPACING)
+    x = center[0] - (right - left) / 2 - left
+    y = center[1] - (bottom - top) / 2 - top
+    draw.multiline_text((x, y), text, font=font, fill=fill, spacing=TEXT_SPACING, align='center')
+
+
+def draw_node(draw, center, size, shape, label, fillcolor, color, font=FONT):
+    cx, cy = center
+    width, height = size
+    box = (cx - width / 2, cy - height / 2, cx + width / 2, cy + height / 2)
+    if shape == 'diamond':
+        draw.polygon([(cx, box[1]), (box[2], cy), (cx, box[3]), (box[0], cy)], fill=fillcolor, outline=color)
+    elif shape in ('ellipse', 'oval'):
+        draw.ellipse(box, fill=fillcolor, outline=color, width=2)
+    else:
+        draw.rectangle(box, fill=fillcolor, outline=color, width=2)
+    draw_text(draw, center, label, font)
+
+
+def _arrow_head(draw, start, end, color):
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length = max((dx ** 2 + dy ** 2) ** 0.5, 1)
+    ux, uy = dx / length, dy / length
+    base = (end[0] - ux * ARROW_SIZE, end[1] - uy * ARROW_SIZE)
+    draw.polygon([end,
+                  (base[0] - uy * ARROW_SIZE / 2, base[1] + ux * ARROW_SIZE / 2),
+                  (base[0] + uy * ARROW_SIZE / 2, base[1] - ux * ARROW_SIZE / 2)], fill=color)
+
+
+def draw_edge(draw, start, end, color, label=None, both_ends=False, width=2):
+    draw.line([start, end], fill=color, width=width)
+    _arrow_head(draw, start, end, color)
+    if both_ends:
+        _arrow_head(draw, end, start, color)
+    if label:
+        mid = ((start[0] + end[0]) / 2, (start[1] + end[1]) / 2 - 10)
+        draw_text(draw, mid, label, SMALL_FONT, fill=color)
+
+
+def _flow_node_style(node, node_type_map, node_name_map):
+    node_type = node_type_map.get(node) if node_type_map else None
+    shape = NODE_STYLE_MAP.get(node_type, 'box')
+    fillcolor, color = NODE_COLOR_MAP.get(node_type, DEFAULT_COLORS)
+    return create_node_label(node, node_type_map, node_name_map), shape, fillcolor, color
+
+
+def _stack(sizes, center_y):
+    """Vertical centres for a column of nodes stacked around center_y."""
+    total = sum(h for _, h in sizes) + ROW_GAP * (len(sizes) - 1)
+    y = center_y - total / 2
+    centres = []
+    for _, h in sizes:
+        centres.append(y + h / 2)
+        y += h + ROW_GAP
+    return centres
+
+
+def create_network_diagram(
+        flow,
+        ip_data,
+        image_filename,
+        src_filename,
+        diagram_type="multi",  # Options: "multi", "single"
+        node_comments=False,  # Controls comment display for both diagram types
+        max_ips_display=5,
+        node_type_map=None,
+        node_name_map=None,
+        max_comment_rules=None,
+        cache_dir=None
+):
+    """
+    Unified function to create network flow diagrams drawn directly with Pillow.
+
+    Path diagrams are always a left to right chain of flow nodes with the source
+    groups fanned off the first node and the destination groups off the last,
+    so the layout is computed directly rather than by a graph layout engine.
+
+    Parameters:
+    -----------
+    flow : list
+        List of network nodes (e.g., firewalls) in the flow
+    ip_data : list or tuple
+        For diagram_type="multi": List of tuples (src_ips, dst_ips, comments)
+        For diagram_type="single": Tuple of (src_ips, dst_ips, comments)
+    image_filename : str
+        Base filename for the output diagram image
+    src_filename : str
+        Base filename for the source file
+    diagram_type : str, optional
+        "multi" for multiple source/destination IP groups
+        "single" for a single source/destination group
+    node_comments : bool, optional
+        Controls comment display differently based on diagram_type:
+        - For single diagrams: controls whether comments appear as the diagram title
+        - For multi diagrams: controls whether comments appear inside the nodes
+    max_ips_display : int, optional
+        Maximum number of IPs to display for each node, longer lists are summarized
+    node_type_map : dict, optional
+        Mapping of node names to their types for shape determination
+    node_name_map : dict, optional
+        Mapping of node IDs to display names
+    max_comment_rules : int, optional
+        Maximum number of rules listed per firewall in the comment labels
+    cache_dir : str, optional
+        Accepted for compatibility with the Graphviz backend, not used
+
+    Returns:
+    --------
+    str or None
+        Path to the generated diagram file, or None if rendering failed
+    """
+    title = None
+
+    if diagram_type == "single":
+        if isinstance(ip_data, tuple) and len(ip_data) == 3:
+            src_ips, dst_ips, comments = ip_data
+            if comments and node_comments:
+                title = comments_label(comments, max_comment_rules).strip()
+            ip_tuples = [([ip for ip in src_ips], [ip for ip in dst_ips], comments)]
+        else:
+            raise ValueError("For 'single' diagram_type, ip_data must be a tuple of (src_ips, dst_ips, comments)")
+
+    elif diagram_type == "multi":
+        ip_tuples = ip_data
+        if ip_tuples and isinstance(ip_tuples[0], tuple) and len(ip_tuples[0]) == 3:
+            ip_tuples = process_tuples(ip_tuples)
+        else:
+            raise ValueError("For 'multi' diagram_type, ip_data must be a list of (src_ips, dst_ips, comments) tuples")
+    else:
+        raise ValueError("diagram_type must be either 'multi' or 'single'")
+
+    # Labels and colours for every node
+    flow_nodes = [_flow_node_style(fw, node_type_map, node_name_map) for fw in flow]
+    src_nodes = []
+    dst_nodes = []
+    for idx, (src_ip, dst_ip, comments) in enumerate(ip_tuples):
+        fillcolor, color = GROUP_COLOR_PAIRS[idx % len(GROUP_COLOR_PAIRS)]
+
+        src_label = format_ip_label(src_ip, max_ips_display)
+        dst_label = format_ip_label(dst_ip, max_ips_display)
+
+        if node_comments and comments and diagram_type == "multi":
+            comments_text = comments_label(comments, max_comment_rules).strip()
+            src_label = f"{comments_text}\n{src_label}"
+            dst_label = f"{comments_text}\n{dst_label}"
+
+        src_nodes.append((src_label, 'ellipse', fillcolor, color))
+        dst_nodes.append((dst_label, 'ellipse', fillcolor, color))
+
+    # Fixed layout: a column of sources, one column per flow node, then a column of destinations
+    flow_sizes = [node_size(label, shape) for label, shape, *_ in flow_nodes]
+    src_sizes = [node_size(label, shape, SMALL_FONT) for label, shape, *_ in src_nodes]
+    dst_sizes = [node_size(label, shape, SMALL_FONT) for label, shape, *_ in dst_nodes]
+
+    column_widths = ([max((w for w, _ in src_sizes), default=0)] +
+                     [w for w, _ in flow_sizes] +
+                     [max((w for w, _ in dst_sizes), default=0)])
+
+    def stack_height(sizes):
+        return sum(h for _, h in sizes) + ROW_GAP * max(len(sizes) - 1, 0)
+
+    content_height = max(stack_height(src_sizes), stack_height(dst_sizes),
+                         max((h for _, h in flow_sizes), default=0))
+    title_height = text_size(title, TITLE_FONT)[1] + ROW_GAP if title else 0
+
+    width = int(MARGIN * 2 + sum(column_widths) + COLUMN_GAP * (len(column_widths) - 1))
+    height = int(MARGIN * 2 + title_height + content_height)
+    center_y = MARGIN + title_height + content_height / 2
+
+    column_centres = []
+    x = MARGIN
+    for column_width in column_widths:
+        column_centres.append(x + column_width / 2)
+        x += column_width + COLUMN_GAP
+
+    flow_positions = [(column_centres[i + 1], center_y) for i in range(len(flow))]
+    src_positions = [(column_centres[0], y) for y in _stack(src_sizes, center_y)]
+    dst_positions = [(column_centres[-1], y) for y in _stack(dst_sizes, center_y)]
+
+    def right_of(position, size):
+        return position[0] + size[0] / 2, position[1]
+
+    def left_of(position, size):
+        return position[0] - size[0] / 2, position[1]
+
+    try:
+        image = Image.new('RGB', (width, height), BACKGROUND_COLOR)
+        draw = ImageDraw.Draw(image)
+
+        if title:
+            draw_text(draw, (width / 2, MARGIN + title_height / 2), title, TITLE_FONT)
+
+        # Edges first so nodes are drawn over the line ends
+        for i in range(len(flow) - 1):
+            draw_edge(draw, right_of(flow_positions[i], flow_sizes[i]),
+                      left_of(flow_positions[i + 1], flow_sizes[i + 1]), FLOW_EDGE_COLOR)
+
+        for idx in range(len(src_nodes)):
+            color = src_nodes[idx][3]
+            draw_edge(draw, right_of(src_positions[idx], src_sizes[idx]),
+                      left_of(flow_positions[0], flow_sizes[0]), color, label='src')
+            draw_edge(draw, right_of(flow_positions[-1], flow_sizes[-1]),
+                      left_of(dst_positions[idx], dst_sizes[idx]), color, label='dst')
+
+        for (label, shape, fillcolor, color), position, size in zip(flow_nodes, flow_positions, flow_sizes):
+            draw_node(draw, position, size, shape, label, fillcolor, color)
+
+        for nodes, positions, sizes in ((src_nodes, src_positions, src_sizes),
+                                        (dst_nodes, dst_positions, dst_sizes)):
+            for (label, shape, fillcolor, color), position, size in zip(nodes, positions, sizes):
+                draw_node(draw, position, size, shape, label, fillcolor, color, SMALL_FONT)
+
+        diagram_file = f"{image_filename}.png"
+        image.save(diagram_file, format='PNG', optimize=True)
+    except Exception as e:
+        print(f"Error rendering diagram: {e}")
+        diagram_file = None
+
+    # Write the layout to a file
+    with open(f"{src_filename}.txt", "w") as f:
+        f.write(f"Pillow layout for {image_filename}\n")
+        if title:
+            f.write(f"Title: {title}\n")
+        f.write("Flow nodes:\n")
+        for fw, (label, shape, *_), position in zip(flow, flow_nodes, flow_positions):
+            f.write(f"  {fw}: {shape} at {position} {label!r}\n")
+        for idx, ((src_label, *_), (dst_label, *_)) in enumerate(zip(src_nodes, dst_nodes)):
+            f.write(f"  src_{idx} -> {flow[0]}: {src_label!r}\n")
+            f.write(f"  {flow[-1]} -> dst_{idx}: {dst_label!r}\n")
+
+    return diagram_file
+
+
+def create_network_diagrams(diagrams, max_workers=None, cache_dir=None, render_mode=None, dpi=None, progress=None,
+                            cancel_event=None):
+    """
+    Create many network flow diagrams.
+
+    Matches the interface of the Graphviz backend, diagrams is a list of keyword
+    argument dicts for create_network_diagram. Drawing is in-process and cheap so
+    the diagrams are drawn one at a time, max_workers, cache_dir, render_mode
+    and dpi are accepted for compatibility and ignored. progress is called with
+    (done, total) after each diagram and ProcessingCancelled is raised before the
+    next one once cancel_event is set.
+
+    Returns:
+        list: Path to each generated diagram file (or None), in the same order as diagrams
+    """
+    return run_jobs(lambda params: create_network_diagram(**params), diagrams, progress=progress,
+                    cancel_event=cancel_event)
+
+
+def convert_from_mermaid(mermaid_input, title=None, node_type_map=None, node_name_map=None,
+                         edge_flows=None, max_comment_rules=None):
+    """
+    Convert Mermaid flowchart syntax to a NetworkX graph carrying the node styling
+
+    Args:
+        mermaid_input (str): Input string in Mermaid flowchart format
+        title (str, optional): Title to be displayed on the graph. Defaults to None.
+        node_type_map (dict, optional): Mapping of node names to their types for shape determination
+        node_name_map (dict, optional): Mapping of node IDs to display names
+        edge_flows (dict, optional): Flow counts per rule for each link keyed on the sorted node pair,
+            the requested flows are overlaid on the topology when given
+        max_comment_rules (int, optional): Maximum number of rules listed on an overlay link
+
+    Returns:
+        nx.Graph: NetworkX graph representing the flowchart
+    """
+    G = nx.Graph()
+
+    lines = [line.strip() for line in mermaid_input.split('\n') if line.strip()]
+
+    # Skip the first line (flowchart LR)
+    for line in lines[1:]:
+        parts = line.split('<-->')
+        if len(parts) == 2:
+            G.add_edge(parts[0].strip(), parts[1].strip())
+
+    for node in G.nodes:
+        label, shape, fillcolor, color = _flow_node_style(node, node_type_map, node_name_map)
+        G.nodes[node].update(label=label, shape=shape, fillcolor=fillcolor, edgecolor=color)
+
+    if edge_flows is not None:
+        overlay_edge_flows(G, edge_flows, max_comment_rules, whole_widths=True)
+
+    G.graph['title'] = title
+    return G
+
+
+def layered_layout(G):
+    """
+    Place nodes in columns by breadth first distance from the best connected node.
+    Nodes in each column are ordered by the average row of their neighbours in the
+    previous column to keep edge crossings down. Disconnected parts are laid out
+    one after another.
+
+    Returns a list of columns, each a list of nodes from top to bottom.
+    """
+    columns = []
+    remaining = set(G.nodes)
+    while remaining:
+        root = max(sorted(remaining), key=G.degree)
+        depth = {root: 0}
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            for neighbour in sorted(G.neighbors(node)):
+                if neighbour not in depth:
+                    depth[neighbour] = depth[node] + 1
+                    queue.append(neighbour)
+        remaining -= depth.keys()
+
+        component_columns = defaultdict(list)
+        for node, d in depth.items():
+            component_columns[d].append(node)
+
+        row_of = {}
+        for d in range(len(component_columns)):
+            def barycentre(node):
+                rows = [row_of[n] for n in G.neighbors(node) if n in row_of and depth[n] == d - 1]
+                return (sum(rows) / len(rows) if rows else 0, node)
+
+            column = sorted(component_columns[d], key=barycentre)
+            for row, node in enumerate(column):
+                row_of[node] = row
+            columns.append(column)
+
+    return columns
+
+
+def render_diagram(G, output_image, cache_dir=None, dpi=None):
+    """
+    Draw a topology graph from convert_from_mermaid with a layered layout
+
+    Args:
+        G (nx.Graph): NetworkX graph to draw
+        output_image (str): Filename for the output image
+        cache_dir (str, optional): Accepted for compatibility with the Graphviz backend, not used
+        dpi (int, optional): Accepted for compatibility with the matplotlib backend, not used
+
+    Returns:
+        str: Path to the generated image file, or None if rendering failed
+    """
+    try:
+        columns = layered_layout(G)
+        sizes = {node: node_size(data.get('label', node), data.get('shape', 'box'))
+                 for node, data in G.nodes(data=True)}
+
+        title = G.graph.get('title')
+        title_height = text_size(title, TITLE_FONT)[1] + ROW_GAP if title else 0
+
+        column_of = {node: index for index, column in enumerate(columns) for node in column}
+
+        # Overlay link labels sit beside the node at the far end of the link, so each
+        # node's row is made tall enough for the labels of the links arriving at it
+        label_owners = {}
+        row_sizes = dict(sizes)
+        for node1, node2, label in G.edges(data='label'):
+            if not label:
+                continue
+            owner = node2 if column_of[node2] > column_of[node1] else node1
+            label_owners[(node1, node2)] = owner
+            label_height = text_size(label, SMALL_FONT)[1]
+            row_sizes[owner] = (row_sizes[owner][0], max(row_sizes[owner][1], label_height))
+
+        column_widths = [max(sizes[node][0] for node in column) for column in columns]
+        # Leave room between the columns for the widest overlay link label
+        column_gap = max([COLUMN_GAP] + [text_size(label, SMALL_FONT)[0] + ROW_GAP * 2
+                                         for *_, label in G.edges(data='label') if label])
+        content_height = max((sum(row_sizes[node][1] for node in column) + ROW_GAP * (len(column) - 1)
+                              for column in columns), default=0)
+
+        width = int(MARGIN * 2 + sum(column_widths) + column_gap * max(len(columns) - 1, 0))
+        height = int(MARGIN * 2 + title_height + content_height)
+        center_y = MARGIN + title_height + content_height / 2
+
+        positions = {}
+        x = MARGIN
+        for column, column_width in zip(columns, column_widths):
+            for node, y in zip(column, _stack([row_sizes[node] for node in column], center_y)):
+                positions[node] = (x + column_width / 2, y)
+            x += column_width + column_gap
+
+        image = Image.new('RGB', (max(width, 1), max(height, 1)), BACKGROUND_COLOR)
+        draw = ImageDraw.Draw(image)
+
+        if title:
+            draw_text(draw, (width / 2, MARGIN + title_height / 2), title, TITLE_FONT)
+
+        for node1, node2, data in G.edges(data=True):
+            (x1, y1), (x2, y2) = positions[node1], positions[node2]
+            # Leave the line at the side of each node facing the other one
+            if x1 == x2:
+                start = (x1, y1 + sizes[node1][1] / 2 * (1 if y2 > y1 else -1))
+                end = (x2, y2 - sizes[node2][1] / 2 * (1 if y2 > y1 else -1))
+            else:
+                direction = 1 if x2 > x1 else -1
+                start = (x1 + sizes[node1][0] / 2 * direction, y1)
+                end = (x2 - sizes[node2][0] / 2 * direction, y2)
+            draw_edge(draw, start, end, data.get('color', FLOW_EDGE_COLOR), both_ends=True,
+                      width=data.get('width', 2))
+
+        for (node1, node2), owner in label_owners.items():
+            data = G.edges[node1, node2]
+            label_width, label_height = text_size(data['label'], SMALL_FONT)
+            x, y = positions[owner]
+            label_x = x - sizes[owner][0] / 2 - ARROW_SIZE - label_width / 2
+            # Blank out the links behind the label so it stays readable
+            draw.rectangle((label_x - label_width / 2 - 2, y - label_height / 2 - 2,
+                            label_x + label_width / 2 + 2, y + label_height / 2 + 2), fill=BACKGROUND_COLOR)
+            draw_text(draw, (label_x, y), data['label'], SMALL_FONT, fill=data.get('color', FLOW_EDGE_COLOR))
+
+        for node, data in G.nodes(data=True):
+            draw_node(draw, positions[node], sizes[node], data.get('shape', 'box'), data.get('label', node),
+                      data.get('fillcolor', DEFAULT_COLORS[0]), data.get('edgecolor', DEFAULT_COLORS[1]))
+
+        image.save(output_image, format='PNG', optimize=True)
+        print(f"Rendered: {output_image}")
+        return output_image
+    except Exception as e:
+        print(f"Error rendering {output_image}: {str(e)}")
+        return None
@@ -1,11 +1,12 @@
 from collections import defaultdict
 from datetime import datetime
+import importlib
 import json
 from os.path import join
+import shutil
 import yaml
 import os
 
-from firewalldiagram import FirewallDiagram
 from subnetfirewallmapper import SubnetFirewallMapper
 from findips import find_ip_addresses
 from configmanager import ConfigManager
@@ -13,13 +14,15 @@ from combine_diagrams import combine_tuple_fields
 
 import group_rules
 import data_transform_funcs
-import write_excel_from_tmpl
-import generate_diagrams_graphviz as generate_diagrams
-#import generate_diagrams_matplot as generate_diagrams
 import ip_headings
 import filter_include_flows
 import filter_excluded_flows
 import helpers
+import export_rows
+import diagram_labels
+import gateway_index
+import rule_overlap
+from job_progress import ProcessingCancelled, check_cancelled
 
 
 def create_subdirectories(base_dir):
@@ -27,7 +30,10 @@ def create_subdirectories(base_dir):
         "diagram_images",
         "diagram_source_files",
         "excel_fw_forms",
-        "json_rule_dumps"
+        "json_rule_dumps",
+        "rule_exports",
+        "diagram_cache",
+        "gateway_index"
     ]
 
     for subdirectory in subdirectories:
@@ -39,6 +45,28 @@ def create_subdirectories(base_dir):
             print(f"Subdirectory already exists: {full_path}")
 
 
+# Modules that can draw the diagrams, selected with the diagram_backend Excel option
+DIAGRAM_BACKENDS = {
+    'graphviz': 'generate_diagrams_graphviz',
+    'matplot': 'generate_diagrams_matplot',
+    'pillow': 'generate_diagrams_pillow',
+}
+
+
+def load_diagram_backend(backend=None):
+    """
+    Import the diagram module for the backend name.
+    With no backend given use Graphviz if it is installed, otherwise fall back to Pillow.
+    """
+    if not backend:
+        backend = 'graphviz' if shutil.which('dot') else 'pillow'
+
+    if backend not in DIAGRAM_BACKENDS:
+        raise ValueError(f"Unknown diagram backend '{backend}', expected one of: {', '.join(DIAGRAM_BACKENDS)}")
+
+    return importlib.import_module(DIAGRAM_BACKENDS[backend])
+
+
 def datetime_for_filename():
     return datetime.now().strftime("%d_%b_%y_%H-%M-%S")
 
@@ -51,28 +79,287 @@ def src_dst_permutations(src_ips, dst_ips):
             yield src_ip, dst_ip
 
 
-def generate_output(cust_rules, config_mgr, file_prefix=None):
+def dump_rules_as_read(cust, rules, filename):
+    """
+    Yield each rule after appending it to a JSON file in the same {cust: [rules]} form as
+    the dump of a list of rules, so it can be reloaded the same way.
+    The file is closed off when the generator is closed early too, so a cancelled or failed run
+    leaves valid JSON of the rules read so far.
+    """
+    with open(filename, 'w') as f:
+        f.write(f'{{\n    {json.dumps(cust)}: [')
+        try:
+            for index, rule in enumerate(rules):
+                f.write(f'{"," if index else ""}\n        {json.dumps(rule)}')
+                yield rule
+        finally:
+            f.write('\n    ]\n}')
+
+
+def shard_diagram_files(shard, shard_by, diagram_files, diagram_index, topology_nodes):
+    """
+    Pick the diagram images for a shard workbook, keeping their order.
+    A topology shard gets that topology's diagrams, a gateway shard the paths through
+    the gateway and the overviews of the topologies it is in.
+    """
+    shard_files = []
+    for diagram_file in diagram_files:
+        topology, path = diagram_index.get(diagram_file, (None, None))
+        if shard_by == 'topology':
+            # A path with rules from more than one topology goes with each topology that has all its nodes
+            if topology == shard or (topology is None and path and set(path) <= topology_nodes.get(shard, set())):
+                shard_files.append(diagram_file)
+        elif path:
+            if shard in path:
+                shard_files.append(diagram_file)
+        elif shard in topology_nodes.get(topology, set()):
+            shard_files.append(diagram_file)
+    return shard_files
+
+
+def load_topology(fw_subnets_file, routes_file=None, topology_file=None):
+    """
+    Load one topology from its subnets YAML, optional route dump and diagram files.
+    Returns (diagram, mapper, include_flows, exclude_flows).
+    """
+    # networkx is only imported once the topologies are needed
+    from firewalldiagram import FirewallDiagram
+
+    # Create the firewall diagram
+    diagram = FirewallDiagram(topology_file) if topology_file else None
+
+    # Create the subnet firewall mapper
+    mapper = SubnetFirewallMapper(fw_subnets_file, routes_file) if fw_subnets_file else None
+
+    with open(fw_subnets_file, 'r') as f:
+        yaml_data = yaml.safe_load(f)
+
+    return diagram, mapper, yaml_data.get('include_flows', None), yaml_data.get('exclude_flows', None)
+
+
+def load_topologies(config_mgr, cust):
+    """
+    Load the subnet firewall mapper and firewall diagram of each topology for a customer.
+    Returns (topologies, node_types, node_names, include_flows, exclude_flows), each keyed on the
+    topology name, with topologies as {topology: (diagram, mapper)}.
+    """
+    topologies = {}
+    topology_inc_flows = {}
+    topology_exc_flows = {}
+    topology_node_types = {}
+    topology_node_names = {}
+    # Iterate through all subsections for the customer
+    for subsection in config_mgr.get_customer_subsections(cust):
+        topology_dict = config_mgr.get_topology(cust, subsection)
+
+        fw_subnets_file = topology_dict.get('subnets')
+        routes_file = topology_dict.get('routes')
+        topology_file = topology_dict.get('topology')
+
+        diagram, mapper, topology_inc_flows[subsection], topology_exc_flows[subsection] = \
+            load_topology(fw_subnets_file or None, routes_file or None, topology_file or None)
+        topology_node_types[subsection] = mapper.node_types
+        topology_node_names[subsection] = mapper.node_names
+
+        # Add the topologies to the dictionary using the subsection as the key
+        topologies[subsection] = (diagram, mapper)
+
+    return topologies, topology_node_types, topology_node_names, topology_inc_flows, topology_exc_flows
+
+
+def shortest_flow(diagram, src_fw, dst_fw, path_cache=None):
+    """
+    The shortest path in the topology between two firewalls.
+    path_cache is an optional dict that keeps the path for each pair of firewalls,
+    for callers that resolve many rules against the same diagram.
+    """
+    if path_cache is not None and (src_fw, dst_fw) in path_cache:
+        return path_cache[(src_fw, dst_fw)]
+    flow = min(diagram.find_flows_with_firewalls(src_fw, dst_fw), key=len)
+    if path_cache is not None:
+        path_cache[(src_fw, dst_fw)] = flow
+    return flow
+
+
+def find_flows(src_ip, dst_ip, topologies, missing_ips_in_topologies, path_cache=None):
+    """
+    Find the firewalls for a source and destination IP in each topology and the shortest path between them.
+    Returns a list of ((src_ip, dst_ip), topology, path), IPs not found in a topology are added to
+    missing_ips_in_topologies. path_cache is a dict of path caches per topology, see shortest_flow.
+    """
+    flows = []
+    #  For each Topology for this customer find the firewalls and firewall flows for this permutation
+    for topology_name, (diagram, mapper) in topologies.items():
+
+        src_fw = mapper.find_matching_firewall(src_ip)
+        dst_fw = mapper.find_matching_firewall(dst_ip)
+
+        if not src_fw and not dst_fw:
+            #print(f"No firewalls found for both {src_ip} and {dst_ip} in {topology_name}")
+            missing_ips_in_topologies[topology_name].update([src_ip, dst_ip])
+            continue
+        if not src_fw:
+            #print(f"No firewall found for {src_ip} in {topology_name}")
+            missing_ips_in_topologies[topology_name].add(src_ip)
+            continue
+        if not dst_fw:
+            #print(f"No firewall found for {dst_ip} in {topology_name}")
+            missing_ips_in_topologies[topology_name].add(dst_ip)
+            continue
+
+        #  Pick the minimum length flow i.e. the shortest path in the topology
+        flow = shortest_flow(diagram, src_fw, dst_fw, path_cache.setdefault(topology_name, {})
+                             if path_cache is not None else None)
+        flows.append(((src_ip, dst_ip), topology_name, flow))
+
+    return flows
+
+
+def resolve_rule(original_rule_id, rule, topologies, topology_node_types, topology_inc_flows, topology_exc_flows,
+                 inc_flow_count, missing_ips_in_topologies, rules_diagrams=None, path_cache=None, flows=None):
+    """
+    Work out the firewalls and paths for one rule [source, destination, services, comments] and format its
+    output rows, one per topology and install on gateway.
+
+    IPs not found in a topology are added to missing_ips_in_topologies, and the flows of each path
+    are added to rules_diagrams if it is given. The path_cache is passed to shortest_flow.
+    If flows is given the rule's flows [((src_ip, dst_ip), topology, path)] are added to it once filtered.
+    Returns (rows, skipped_rows), skipped_rows being the rows for gateways that are not firewalls.
+    """
+    rows = []
+    skipped_rows = []
+
+    # Initialise a dictionary for the mapping of IP addresses to the original content of the rule for that IP
+    src_ip_full_text_mapping = {}
+    dst_ip_full_text_mapping = {}
+    src, dst, port, comment = rule
+
+    # Add headings back in later
+    src_headings = ip_headings.map_ip_to_heading(src)
+    dst_headings = ip_headings.map_ip_to_heading(dst)
+
+    # swap back in newline to comments
+    comment = comment.replace('; ', '\n')
+    #   Find the IP addresses for the source and destination
+    src_ips, src_text_map = find_ip_addresses(src)
+    dst_ips, dst_text_map = find_ip_addresses(dst)
+    src_ip_full_text_mapping.update(src_text_map)
+    dst_ip_full_text_mapping.update(dst_text_map)
+
+    #   Get the permutations of the source and destination IP's
+    rule_src_dst_permutations = []
+    for src_ip, dst_ip in src_dst_permutations(src_ips, dst_ips):
+        #  For each permutation of source to destination IP
+        #  Get the source and destination IP firewalls
+        rule_src_dst_permutations.extend(find_flows(src_ip, dst_ip, topologies, missing_ips_in_topologies,
+                                                    path_cache))
+
+    # Expand out from the path determined for this permutation all the gateways
+    # that require this rule to be installed on
+    # this will allow regrouping based on the installed on gateway
+    rule_src_dst_permutations = filter_include_flows.filter_ip_data(rule_src_dst_permutations, topology_inc_flows)
+    rule_src_dst_permutations = filter_excluded_flows.filter_ip_data(rule_src_dst_permutations, topology_exc_flows)
+    if flows is not None:
+        flows.extend(rule_src_dst_permutations)
+    rule_src_dst_permutations = data_transform_funcs.transform_network_data(rule_src_dst_permutations)
+
+    # Group the permutations/combinations on the topology and the install on firewall
+    # Subgroup by flow/path.
+    # Each item under the grouping of install on a topology will have
+    # its own path and the source and destination IPs for that path
+    new_rule = group_rules.group_and_collapse(rule_src_dst_permutations)
+
+    # For each grouping of install on and topology concatenate and format all rows under it
+    # which are made up of the different paths/flows
+    # add in a flow count ID to allow the user to print this out
+    # if they want to know the individual flows within the rule
+    # Add back in group headings and host descriptions
+    # Add in all the flows grouped on path to create the diagrams and to avoid duplicating the same diagram.
+    # The rule IDs and flows will be added to the endpoints for the grouped path/flow.
+    # This will allow the user to map back endpoints on the diagram to flows in the rule set
+    for topology_install_on, paths in new_rule.items():
+        src_list = []
+        dst_list = []
+        paths_list = []
+        topology, install_on = topology_install_on
+        new_rule_id = f"{str(original_rule_id)}:{topology}:{install_on}"
+        flow_count = 1
+        for path, (src, dst, *_) in paths.items():
+            if rules_diagrams is not None:
+                rules_diagrams[path].append((src, dst, f"{new_rule_id}, flow {flow_count}"))
+            path_joined = str(flow_count) + ': ' + ' --> '.join(path)
+            src_list.extend([(x, flow_count) for x in src])
+            dst_list.extend([(x, flow_count) for x in dst])
+            paths_list.append(path_joined)
+            flow_count += 1
+        # Swap back in the original text entered by the user
+        src_list = [(src_ip_full_text_mapping.get(ip, ip), fc) for ip, fc in src_list]
+        dst_list = [(dst_ip_full_text_mapping.get(ip, ip), fc) for ip, fc in dst_list]
+
+        src_headings_ip = defaultdict(list)
+        dst_headings_ip = defaultdict(list)
+
+        for ip, _ in src_list:
+            src_headings_ip[src_headings[ip]].append(ip)
+
+        for ip, _ in dst_list:
+            dst_headings_ip[dst_headings[ip]].append(ip)
+
+        if inc_flow_count:
+            src_str = data_transform_funcs.format_ips(src_list)
+            dst_str = data_transform_funcs.format_ips(dst_list)
+        else:
+            src_str = data_transform_funcs.format_ips_headings(src_headings_ip)
+            dst_str = data_transform_funcs.format_ips_headings(dst_headings_ip)
+
+        paths_str = '\n'.join(paths_list)
+        row = (src_str, dst_str, port, comment, new_rule_id, paths_str, install_on)
+        if topology_node_types[topology].get(install_on, 'firewall') == 'firewall':
+            rows.append(row)
+        else:
+            skipped_rows.append(row)
+
+    return rows, skipped_rows
+
+
+def generate_output(cust_rules, config_mgr, file_prefix=None, progress=None, cancel_event=None):
+    """
+    Work out the firewalls and paths for the rules of one customer and write the diagrams, workbook and exports.
+
+    progress, if given, is called with (stage, done, total) as the work goes on, stage is one of
+    'rules', 'diagrams', 'exports' or 'workbook' and total is None when it is not known.
+    cancel_event is a threading.Event, when it is set ProcessingCancelled is raised
+    at the next rule or stage, or once the diagrams being drawn finish, so the run stops cleanly.
+    """
+    def report(stage, done, total=None):
+        if progress:
+            progress(stage, done, total)
+
     #  Get the 1st key of the cust_rules dictionary and
     #  generate an exception if there is more than one, we only want one customer
     if len(cust_rules) > 1:
-        raise Exception("Only one customer can be processed at a time")
+        raise Exception("Only one customer can be processed at a time, use generate_outputs for several")
     else:
         cust = list(cust_rules.keys())[0]
 
+    # The rules can be a list or any iterable, e.g. read_rules_excel.iter_excel_rules,
+    # an iterable is consumed once while the rules are processed
     rules = cust_rules[cust]
-    rules = [[item.replace('_x000D_', '') for item in sublist] for sublist in rules]
 
     # create the output directory if it doesn't exist
     create_subdirectories(config_mgr.get_output_directory(cust))
 
     # Save cust_rules to a json file so the user can reload this later if they need to
-    out_dict = {cust: rules}
-    with open(join(config_mgr.get_output_directory(cust), "json_rule_dumps", f'{cust}_{datetime_for_filename()}.json'), 'w') as f:
-        json.dump(out_dict, f, indent=4)
-
-    # Get the topology file paths for each topology for this customer
-    # And initialise the subnet firewall Mapper and diagram objects
-    topologies = {}
+    json_dump_file = join(config_mgr.get_output_directory(cust), "json_rule_dumps", f'{cust}_{datetime_for_filename()}.json')
+    if isinstance(rules, list):
+        rules = [[item.replace('_x000D_', '') for item in sublist] for sublist in rules]
+        out_dict = {cust: rules}
+        with open(json_dump_file, 'w') as f:
+            json.dump(out_dict, f, indent=4)
+    else:
+        # Streamed rules are saved as they are read rather than held in memory
+        rules = dump_rules_as_read(cust, ([item.replace('_x000D_', '') for item in sublist] for sublist in rules),
+                                   json_dump_file)
 
     # Maintain a list of IP addresses that were not found in the topology and returned them to the user
     missing_ips_in_topologies = defaultdict(set)
@@ -116,155 +403,171 @@ def generate_output(cust_rules, config_mgr, file_prefix=None):
     except ValueError:
         diagram_max_ips = 3
 
-    topology_inc_flows = {}
-    topology_exc_flows = {}
-    topology_node_types = {}
-    topology_node_names = {}
-    # Iterate through all subsections for the customer
-    for subsection in config_mgr.get_customer_subsections(cust):
-        topology_dict = config_mgr.get_topology(cust, subsection)
+    #  Rules listed per firewall in a diagram comment label, the rest are counted
+    diagram_max_comment_rules = excel_headers.pop('diagram_max_comment_rules', '10')
+    try:
+        diagram_max_comment_rules = int(diagram_max_comment_rules)
+    except ValueError:
+        diagram_max_comment_rules = 10
 
-        fw_subnets_file = topology_dict.get('subnets')
-        routes_file = topology_dict.get('routes')
-        topology_file = topology_dict.get('topology')
+    #  Write the full, uncapped IP and rule lists for each diagram next to its source file
+    diagram_full_labels = excel_headers.pop('diagram_full_labels', 'no')
+    if diagram_full_labels.lower() == 'no':
+        diagram_full_labels = False
+    else:
+        diagram_full_labels = True
 
-        fw_subnets_file = fw_subnets_file if fw_subnets_file else None
-        routes_file = routes_file if routes_file else None
-        topology_file = topology_file if topology_file else None
+    #  Comma separated output formats: excel, csv, jsonl and parquet
+    #  The diagrams are only drawn when excel is one of them
+    output_formats = export_rows.parse_formats(excel_headers.pop('output_formats', 'excel'))
 
-        # Create the firewall diagram
-        diagram = FirewallDiagram(topology_file) if topology_file else None
+    #  Split the output into a workbook per "topology" or install on "gateway" with an index workbook,
+    #  "none" writes a single workbook
+    output_shards = excel_headers.pop('output_shards', 'none').lower()
+    if output_shards not in ('none', 'topology', 'gateway'):
+        raise ValueError("output_shards must be either 'none', 'topology' or 'gateway'")
 
-        # Create the subnet firewall mapper
-        mapper = SubnetFirewallMapper(fw_subnets_file, routes_file) if fw_subnets_file else None
-        topology_node_types[subsection] = mapper.node_types
-        topology_node_names[subsection] = mapper.node_names
+    #  Number of shard workbooks written at once, defaults to the number of CPUs
+    output_shard_workers = excel_headers.pop('output_shard_workers', '')
+    try:
+        output_shard_workers = int(output_shard_workers)
+    except ValueError:
+        output_shard_workers = None
 
-        with open(fw_subnets_file, 'r') as f:
-            yaml_data = yaml.safe_load(f)
-            topology_exc_flows[subsection] = yaml_data.get('exclude_flows', None)
-            topology_inc_flows[subsection] = yaml_data.get('include_flows', None)
+    #  Largest width or height in pixels of the diagrams embedded in the workbook, 0 keeps the full size
+    diagram_embed_max_size = excel_headers.pop('diagram_embed_max_size', '1600')
+    try:
+        diagram_embed_max_size = int(diagram_embed_max_size)
+    except ValueError:
+        diagram_embed_max_size = 1600
 
-        # Add the topologies to the dictionary using the subsection as the key
-        topologies[subsection] = (diagram, mapper)
+    #  Number of diagrams rendered at once, defaults to the number of CPUs
+    diagram_render_workers = excel_headers.pop('diagram_render_workers', '')
+    try:
+        diagram_render_workers = int(diagram_render_workers)
+    except ValueError:
+        diagram_render_workers = None
+
+    #  Render diagrams in "parallel" (one dot process each) or as a single "batch"
+    diagram_render_mode = excel_headers.pop('diagram_render_mode', 'parallel').lower()
+
+    #  Resolution of the images drawn by the matplotlib backend
+    diagram_dpi = excel_headers.pop('diagram_dpi', '300')
+    try:
+        diagram_dpi = int(diagram_dpi)
+    except ValueError:
+        diagram_dpi = 300
+
+    #  Draw a diagram per path ("path") or overlay all the flows on one diagram per topology ("overlay")
+    diagram_mode = excel_headers.pop('diagram_mode', 'path').lower()
+    if diagram_mode not in ('path', 'overlay'):
+        raise ValueError("diagram_mode must be either 'path' or 'overlay'")
+
+    #  Record the rules, flows and paths of this run in the run store in the output directory
+    use_run_store = excel_headers.pop('run_store', 'no')
+    if use_run_store.lower() == 'no':
+        use_run_store = False
+    else:
+        use_run_store = True
+
+    #  Write the index of the rules and flows on each gateway, link and topology
+    write_gateway_index = excel_headers.pop('gateway_index', 'yes')
+    if write_gateway_index.lower() == 'no':
+        write_gateway_index = False
+    else:
+        write_gateway_index = True
+
+    #  Report the rules that duplicate, are shadowed by or overlap earlier rules on the same gateway
+    overlap_analysis = excel_headers.pop('overlap_analysis', 'yes')
+    if overlap_analysis.lower() == 'no':
+        overlap_analysis = False
+    else:
+        overlap_analysis = True
+
+    #  Number of earlier runs in the run store the rules are also compared with
+    overlap_previous_runs = excel_headers.pop('overlap_previous_runs', '0')
+    try:
+        overlap_previous_runs = int(overlap_previous_runs)
+    except ValueError:
+        overlap_previous_runs = 0
+
+    #  Diagram backend: graphviz, matplot or pillow, blank picks graphviz if it is installed
+    generate_diagrams = load_diagram_backend(excel_headers.pop('diagram_backend', '').lower())
+
+    topologies, topology_node_types, topology_node_names, topology_inc_flows, topology_exc_flows = \
+        load_topologies(config_mgr, cust)
 
     rows_to_output = []
     rules_diagrams = defaultdict(list)
+    # Shortest path for each pair of firewalls in each topology, shared by all the rules
+    path_cache = {}
+    rule_total = len(rules) if isinstance(rules, list) else None
+    original_rule_id = 0
+
+    # The findings go in their own sheet of the workbook
+    overlaps = rule_overlap.RuleOverlaps(topology_node_types) \
+        if overlap_analysis and 'excel' in output_formats else None
+
+    run_store = None
+    if use_run_store:
+        # sqlite3 is only needed when the run is recorded
+        import run_store as run_store_module
+        run_store = run_store_module.RunStore(join(config_mgr.get_output_directory(cust),
+                                                   run_store_module.STORE_FILE))
+        run_id = run_store.start_run(cust, json_dump_file, file_prefix)
 
-    #   Find the IP addresses for the rules
-    for original_rule_id, rule in enumerate(rules, start=1):
-        # Initialise a dictionary for the mapping of IP addresses to the original content of the rule for that IP
-        src_ip_full_text_mapping = {}
-        dst_ip_full_text_mapping = {}
-        src, dst, port, comment = rule
-
-        # Add headings back in later
-        src_headings = ip_headings.map_ip_to_heading(src)
-        dst_headings = ip_headings.map_ip_to_heading(dst)
-
-        # swap back in newline to comments
-        comment = comment.replace('; ', '\n')
-        #   Find the IP addresses for the source and destination
-        src_ips, src_text_map = find_ip_addresses(src)
-        dst_ips, dst_text_map = find_ip_addresses(dst)
-        src_ip_full_text_mapping.update(src_text_map)
-        dst_ip_full_text_mapping.update(dst_text_map)
-
-        #   Get the permutations of the source and destination IP's
-        rule_src_dst_permutations = []
-        for src_ip, dst_ip in src_dst_permutations(src_ips, dst_ips):
-            #  For each permutation of source to destination IP
-            #  Get the source and destination IP firewalls
-
-            #  For each Topology for this customer find the firewalls and firewall flows for this permutation
-            for topology_name, (diagram, mapper) in topologies.items():
-
-                src_fw = mapper.find_matching_firewall(src_ip)
-                dst_fw = mapper.find_matching_firewall(dst_ip)
-
-                if not src_fw and not dst_fw:
-                    #print(f"No firewalls found for both {src_ip} and {dst_ip} in {topology_name}")
-                    missing_ips_in_topologies[topology_name].update([src_ip, dst_ip])
-                    continue
-                if not src_fw:
-                    #print(f"No firewall found for {src_ip} in {topology_name}")
-                    missing_ips_in_topologies[topology_name].add(src_ip)
-                    continue
-                if not dst_fw:
-                    #print(f"No firewall found for {dst_ip} in {topology_name}")
-                    missing_ips_in_topologies[topology_name].add(dst_ip)
-                    continue
-
-                flow = diagram.find_flows_with_firewalls(src_fw, dst_fw)
-                #  Pick the minimum length flow i.e. the shortest path in the topology
-                flow = min(flow, key=len)
-                rule_src_dst_permutations.append(((src_ip, dst_ip), topology_name, flow))
-
-        # Expand out from the path determined for this permutation all the gateways
-        # that require this rule to be installed on
-        # this will allow regrouping based on the installed on gateway
-        rule_src_dst_permutations = filter_include_flows.filter_ip_data(rule_src_dst_permutations, topology_inc_flows)
-        rule_src_dst_permutations = filter_excluded_flows.filter_ip_data(rule_src_dst_permutations, topology_exc_flows)
-        rule_src_dst_permutations = data_transform_funcs.transform_network_data(rule_src_dst_permutations)
-
-        # Group the permutations/combinations on the topology and the install on firewall
-        # Subgroup by flow/path.
-        # Each item under the grouping of install on a topology will have
-        # its own path and the source and destination IPs for that path
-        new_rule = group_rules.group_and_collapse(rule_src_dst_permutations)
-
-        # For each grouping of install on and topology concatenate and format all rows under it
-        # which are made up of the different paths/flows
-        # add in a flow count ID to allow the user to print this out
-        # if they want to know the individual flows within the rule
-        # Add back in group headings and host descriptions
-        # Add in all the flows grouped on path to create the diagrams and to avoid duplicating the same diagram.
-        # The rule IDs and flows will be added to the endpoints for the grouped path/flow.
-        # This will allow the user to map back endpoints on the diagram to flows in the rule set
-        for topology_install_on, paths in new_rule.items():
-            src_list = []
-            dst_list = []
-            paths_list = []
-            topology, install_on = topology_install_on
-            new_rule_id = f"{str(original_rule_id)}:{topology}:{install_on}"
-            flow_count = 1
-            for path, (src, dst, *_) in paths.items():
-                rules_diagrams[path].append((src, dst, f"{new_rule_id}, flow {flow_count}"))
-                path_joined = str(flow_count) + ': ' + ' --> '.join(path)
-                src_list.extend([(x, flow_count) for x in src])
-                dst_list.extend([(x, flow_count) for x in dst])
-                paths_list.append(path_joined)
-                flow_count += 1
-            # Swap back in the original text entered by the user
-            src_list = [(src_ip_full_text_mapping.get(ip, ip), fc) for ip, fc in src_list]
-            dst_list = [(dst_ip_full_text_mapping.get(ip, ip), fc) for ip, fc in dst_list]
-
-            src_headings_ip = defaultdict(list)
-            dst_headings_ip = defaultdict(list)
-
-            for ip, _ in src_list:
-                src_headings_ip[src_headings[ip]].append(ip)
-
-            for ip, _ in dst_list:
-                dst_headings_ip[dst_headings[ip]].append(ip)
-
-            if inc_flow_count:
-                src_str = data_transform_funcs.format_ips(src_list)
-                dst_str = data_transform_funcs.format_ips(dst_list)
-            else:
-                src_str = data_transform_funcs.format_ips_headings(src_headings_ip)
-                dst_str = data_transform_funcs.format_ips_headings(dst_headings_ip)
-
-            paths_str = '\n'.join(paths_list)
-            if topology_node_types[topology_name].get(install_on, 'firewall') == 'firewall':
-                rows_to_output.append((src_str, dst_str, port, comment, new_rule_id, paths_str, install_on))
-            else:
-                print("Skipping",(src_str, dst_str, port, comment, new_rule_id, paths_str, install_on))
+    try:
+        #   Find the IP addresses for the rules
+        for original_rule_id, rule in enumerate(rules, start=1):
+            check_cancelled(cancel_event)
+            report('rules', original_rule_id - 1, rule_total)
+            rule_flows = [] if run_store or overlaps else None
+            rows, skipped_rows = resolve_rule(original_rule_id, rule, topologies, topology_node_types,
+                                              topology_inc_flows, topology_exc_flows, inc_flow_count,
+                                              missing_ips_in_topologies, rules_diagrams, path_cache, rule_flows)
+            rows_to_output.extend(rows)
+            for row in skipped_rows:
+                print("Skipping", row)
+            if run_store:
+                run_store.add_rule(run_id, original_rule_id, rule, rows, rule_flows, topology_node_types)
+            if overlaps:
+                overlaps.add_rule(original_rule_id, rule, rule_flows)
+
+        check_cancelled(cancel_event)
+        if overlaps and run_store and overlap_previous_runs > 0:
+            overlaps.add_stored_flows(run_store.install_on_flows(
+                run_store.previous_runs(cust, run_id, overlap_previous_runs)))
+        if run_store:
+            # A cancelled or failed run is rolled back when the store is closed without finishing it
+            run_store.finish_run(run_id, original_rule_id)
+    finally:
+        if run_store:
+            run_store.close()
+        if not isinstance(rules, list):
+            # Closes off the JSON dump of streamed rules when the loop stops early
+            rules.close()
+    report('rules', original_rule_id, rule_total)
+
+    table_sheets = {}
+    if overlaps:
+        overlap_rows = overlaps.findings()
+        print(f"Found {len(overlap_rows)} duplicate, shadowed or overlapping rules")
+        # Workbooks without findings stay as they were
+        if overlap_rows:
+            table_sheets[rule_overlap.SHEET_TITLE] = (rule_overlap.HEADERS, overlap_rows)
+
+    # Rendered images are cached on a hash of their source so unchanged diagrams are not rendered again
+    diagram_cache_dir = join(config_mgr.get_output_directory(cust), "diagram_cache")
 
     diagram_files = []
-    for path, path_rules, topology_func, diagram_type in helpers.get_diagram_data(
-            rules_diagrams, detailed_diagrams, combine_tuple_fields
-    ):
+    diagrams_to_render = []
+    # The topology and path each diagram image shows, used to pick the images for each shard workbook
+    diagram_index = {}
+    diagram_topologies = []
+    # In overlay mode the flows are drawn on the topology diagrams below instead
+    path_diagram_data = helpers.get_diagram_data(rules_diagrams, detailed_diagrams, combine_tuple_fields) \
+        if diagram_mode == 'path' and 'excel' in output_formats else []
+    for path, path_rules, topology_func, diagram_type in path_diagram_data:
         path_rules_topology = topology_func(path_rules)
         node_type_map = topology_node_types.get(path_rules_topology, None)
         node_name_map = topology_node_names.get(path_rules_topology, None)
@@ -282,36 +585,71 @@ def generate_output(cust_rules, config_mgr, file_prefix=None):
             "node_type_map": node_type_map,
             "node_name_map": node_name_map,
             "diagram_type": diagram_type,
+            "max_ips_display": diagram_max_ips,
+            "max_comment_rules": diagram_max_comment_rules,
         }
 
-        # Add max_ips_display only for detailed_diagrams
-        if detailed_diagrams:
-            diagram_params["max_ips_display"] = diagram_max_ips
-
-        diagram_file = generate_diagrams.create_network_diagram(**diagram_params)
-
+        if diagram_full_labels:
+            diagram_labels.write_full_labels(diagram_src_file_name, path, path_rules, diagram_type)
+
+        diagrams_to_render.append(diagram_params)
+        diagram_topologies.append(path_rules_topology)
+
+    # Generate all the diagram sources first then render them together,
+    # the rendered files come back in the same order the diagrams were added
+    diagram_total = len(diagrams_to_render) + (len(topologies) if 'excel' in output_formats else 0)
+    report('diagrams', 0, diagram_total)
+    rendered_files = generate_diagrams.create_network_diagrams(diagrams_to_render,
+                                                               max_workers=diagram_render_workers,
+                                                               cache_dir=diagram_cache_dir,
+                                                               render_mode=diagram_render_mode,
+                                                               dpi=diagram_dpi,
+                                                               progress=lambda done, _: report('diagrams', done,
+                                                                                               diagram_total),
+                                                               cancel_event=cancel_event)
+    for diagram_file, diagram_params, path_rules_topology in zip(rendered_files, diagrams_to_render,
+                                                                 diagram_topologies):
         if diagram_file:
             diagram_files.append(join(config_mgr.get_output_directory(cust), diagram_file))
+            diagram_index[diagram_files[-1]] = (path_rules_topology, diagram_params["flow"])
+
+    report('diagrams', len(diagrams_to_render), diagram_total)
+
+    overlay_data = helpers.get_overlay_data(rules_diagrams) if diagram_mode == 'overlay' else {}
 
-    for topology, v in topologies.items():
+    for topology_number, (topology, v) in enumerate(topologies.items() if 'excel' in output_formats else [],
+                                                    start=1):
+        check_cancelled(cancel_event)
         diagram, *_ = v
         node_type_map = topology_node_types.get(topology, None)
         node_name_map = topology_node_names.get(topology, None)
         diag_file_1_src = join(config_mgr.get_output_directory(cust), "diagram_source_files", f"{cust}_{topology}_1.txt")
         diag_file_1_image = join(config_mgr.get_output_directory(cust), "diagram_images", f"{cust}_{topology}_1.png")
 
-        mermaid_converted = generate_diagrams.convert_from_mermaid(diagram.diagram_text,
-                                                                  title=f"{cust} {topology} Topology",
-                                                                  node_type_map=node_type_map,
-                                                                  node_name_map=node_name_map)
+        if diagram_mode == 'overlay':
+            mermaid_converted = generate_diagrams.convert_from_mermaid(diagram.diagram_text,
+                                                                      title=f"{cust} {topology} Requested Flows",
+                                                                      node_type_map=node_type_map,
+                                                                      node_name_map=node_name_map,
+                                                                      edge_flows=overlay_data.get(topology, {}),
+                                                                      max_comment_rules=diagram_max_comment_rules)
+        else:
+            mermaid_converted = generate_diagrams.convert_from_mermaid(diagram.diagram_text,
+                                                                      title=f"{cust} {topology} Topology",
+                                                                      node_type_map=node_type_map,
+                                                                      node_name_map=node_name_map)
+        diagram_index[diag_file_1_image] = (topology, None)
         if type(mermaid_converted) == str:
             with open(diag_file_1_src, 'w') as f:
                 f.write(mermaid_converted)
             diagram_files.insert(0, diag_file_1_image)
-            generate_diagrams.render_diagram(diag_file_1_src, diag_file_1_image)
+            generate_diagrams.render_diagram(diag_file_1_src, diag_file_1_image, cache_dir=diagram_cache_dir,
+                                             dpi=diagram_dpi)
         else:
             diagram_files.insert(0, diag_file_1_image)
-            generate_diagrams.render_diagram(mermaid_converted, diag_file_1_image)
+            generate_diagrams.render_diagram(mermaid_converted, diag_file_1_image, cache_dir=diagram_cache_dir,
+                                             dpi=diagram_dpi)
+        report('diagrams', len(diagrams_to_render) + topology_number, diagram_total)
 
 
 
@@ -326,6 +664,8 @@ def generate_output(cust_rules, config_mgr, file_prefix=None):
         'paths': 5
     }
 
+    check_cancelled(cancel_event)
+
     if rows_to_output:
         if group_gateways:
             # Group together any rows that have the same source, destination, port and comments but
@@ -335,11 +675,49 @@ def generate_output(cust_rules, config_mgr, file_prefix=None):
             file_prefix = f"_{file_prefix}"
         else:
             file_prefix = ""
-        xlsx_file = join(config_mgr.get_output_directory(cust), "excel_fw_forms", f"FW_Req_{cust}{file_prefix}_{datetime_for_filename()}.xlsx")
-        write_excel_from_tmpl.write_to_excel(rows_to_output, excel_headers, field_mapping,
-                       filename=xlsx_file,
-                       image_files=diagram_files,
-                       template=config_mgr.get_template_file(cust))
+        output_name = f"FW_Req_{cust}{file_prefix}_{datetime_for_filename()}"
+        report('exports', 0, 1)
+        export_rows.export_rows(rows_to_output, field_mapping, output_formats,
+                                join(config_mgr.get_output_directory(cust), "rule_exports", output_name))
+        report('exports', 1, 1)
+
+        if write_gateway_index:
+            index = gateway_index.GatewayIndex()
+            index.add_run(output_name, rules_diagrams, topology_node_types)
+            index.save(join(config_mgr.get_output_directory(cust), gateway_index.INDEX_DIRECTORY,
+                            f"{output_name}{gateway_index.INDEX_SUFFIX}"))
+
+        if 'excel' in output_formats:
+            check_cancelled(cancel_event)
+            report('workbook', 0, 1)
+            # openpyxl and Pillow are only imported when a workbook is written
+            import embed_images
+            import write_excel_from_tmpl
+
+            # Downscaled copies of the diagrams are kept with the rendered image cache
+            embed_cache_dir = join(diagram_cache_dir, "embedded")
+            xlsx_file = join(config_mgr.get_output_directory(cust), "excel_fw_forms", f"{output_name}.xlsx")
+            if output_shards == 'none':
+                write_excel_from_tmpl.write_to_excel(rows_to_output, excel_headers, field_mapping,
+                               filename=xlsx_file,
+                               image_files=embed_images.prepare_images(diagram_files, embed_cache_dir,
+                                                                       diagram_embed_max_size),
+                               template=config_mgr.get_template_file(cust),
+                               table_sheets=table_sheets)
+            else:
+                shards = group_rules.shard_rows(rows_to_output, output_shards)
+                topology_nodes = {topology: set(diagram.graph.nodes) for topology, (diagram, _) in topologies.items()}
+                shard_images = {shard: embed_images.prepare_images(
+                    shard_diagram_files(shard, output_shards, diagram_files, diagram_index, topology_nodes),
+                    embed_cache_dir, diagram_embed_max_size)
+                    for shard in shards}
+                write_excel_from_tmpl.write_sharded_excel(shards, excel_headers, field_mapping, output_shards,
+                                                          filename=xlsx_file,
+                                                          shard_images=shard_images,
+                                                          template=config_mgr.get_template_file(cust),
+                                                          max_workers=output_shard_workers,
+                                                          table_sheets=table_sheets)
+            report('workbook', 1, 1)
 
     # Create a string of missing IPs for each topology
     # This will be output to the user if there are any missing IPs
@@ -348,6 +726,57 @@ def generate_output(cust_rules, config_mgr, file_prefix=None):
     return missing_ips_str
 
 
+def _generate_customer_group(config_file, cust_rules, file_prefix):
+    # Runs in a worker process, so each group of customers has its own copy of every module's state
+    config_mgr = ConfigManager(config_file)
+    results = {}
+    for cust, rules in cust_rules.items():
+        try:
+            results[cust] = {'missing_ips': generate_output({cust: rules}, config_mgr, file_prefix), 'error': None}
+        except Exception as e:
+            print(f"Error processing {cust}: {str(e)}")
+            results[cust] = {'missing_ips': '', 'error': str(e)}
+    return results
+
+
+def generate_outputs(cust_rules, config_mgr, file_prefix=None, max_workers=None):
+    """
+    Process the rules of several customers, {customer: rules}, at the same time in separate processes.
+    Each customer's topologies are loaded once by its own generate_output. Customers sharing an output
+    directory are processed one after the other by the same process, as they would write diagrams of
+    the same name. The rules must be lists to be sent to the processes, other iterables are read into lists.
+
+    Returns {customer: {'missing_ips': generate_output's missing IP report, 'error': None or the error}},
+    a customer that fails doesn't stop the others.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    results = {}
+    groups = defaultdict(dict)
+    for cust, rules in cust_rules.items():
+        if cust not in config_mgr.get_customers():
+            results[cust] = {'missing_ips': '', 'error': f"Customer {cust} not found in {config_mgr.file_path}"}
+            continue
+        groups[config_mgr.get_output_directory(cust)][cust] = rules if isinstance(rules, list) else list(rules)
+
+    if groups:
+        max_workers = min(max_workers or os.cpu_count() or 1, len(groups))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_generate_customer_group, config_mgr.file_path, group, file_prefix)
+                       for group in groups.values()]
+            for future, group in zip(futures, groups.values()):
+                try:
+                    results.update(future.result())
+                except Exception as e:
+                    # The worker process itself failed
+                    for cust in group:
+                        print(f"Error processing {cust}: {str(e)}")
+                        results[cust] = {'missing_ips': '', 'error': str(e)}
+
+    # In the order the customers were given
+    return {cust: results[cust] for cust in cust_rules}
+
+
 if __name__ == "__main__":
     config_mgr = ConfigManager('config.ini')
     TEST_DATA = r"Sample_data/TEST_Data.json"
@@ -1,6 +1,13 @@
 from collections import defaultdict
 
-def group_data(data):
+
+def sort_flow_numbers(flows):
+    # Flows are strings like 'flow 3', sort on the number so labels are the same on every run
+    numbers = [x.split()[-1] for x in flows]
+    return sorted(numbers, key=lambda n: (not n.isdigit(), int(n) if n.isdigit() else 0, n))
+
+
+def group_data(data, max_rules=None):
     # Dictionary to store grouped data
     grouped_data = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
 
@@ -15,20 +22,23 @@ def group_data(data):
         grouped_data[topology][firewall][rule_id].add(firewall_flow)
 
     #  Convert to a printable string with indenting and carriage returns
-    printable_data = ""
+    #  The parts are collected in a list and joined once so the cost stays linear in the number of rules
+    #  If max_rules is set only that many rules are listed per firewall followed by a count of the rest
+    lines = []
     for topology, firewall_data in grouped_data.items():
-        printable_data += f"Topolgoy: {topology}\n"
+        lines.append(f"Topolgoy: {topology}")
         for firewall, rules in firewall_data.items():
-            printable_data += f"{firewall}: ["
-            for n, rule_flows in enumerate(rules.items()):
-                rule, flows = rule_flows
-                printable_data += f" Rule: {rule}, Flow: {', '.join([x.split()[-1] for x in flows])}"
-                if n < len(rules) - 1:
-                    printable_data += " | "  # Add a separator if it's not the last rule
-                else:
-                    printable_data += "]"  # Close the rule list
-            printable_data += "\n"  # Add a newline after each firewall
-        printable_data += "\n"
-
-    return printable_data
+            rule_items = list(rules.items())
+            if max_rules is not None and len(rule_items) > max_rules:
+                hidden = len(rule_items) - max_rules
+                rule_items = rule_items[:max_rules]
+            else:
+                hidden = 0
+            rule_strs = [f" Rule: {rule}, Flow: {', '.join(sort_flow_numbers(flows))}"
+                         for rule, flows in rule_items]
+            if hidden:
+                rule_strs.append(f"+{hidden} more rules")
+            lines.append(f"{firewall}: [{' | '.join(rule_strs)}]")
+        lines.append("")
 
+    return "\n".join(lines) + "\n" if lines else ""
@@ -41,4 +41,26 @@ def group_and_collapse(data):
 
         final_result[main_key][sub_key] = (collapsed_first, collapsed_second, second, set(third), fourth)
 
-    return dict(final_result)
\ No newline at end of file
+    return dict(final_result)
+
+def shard_rows(data, shard_by):
+    """
+    Split the output rows into shards by 'topology', taken from the rule id, or by install on 'gateway'.
+    A row for several concatenated gateways is added to the shard of each of them.
+    Returns {shard: rows} in shard name order, rows keep their original order.
+    """
+    shards = defaultdict(list)
+    for item in data:
+        if shard_by == 'topology':
+            # Rule ids look like '1:COR:FW1', the topology is the second field
+            fields = item[4].split(':')
+            keys = [fields[1] if len(fields) >= 2 else 'Unknown']
+        elif shard_by == 'gateway':
+            keys = dict.fromkeys(item[6].split('\n'))
+        else:
+            raise ValueError("shard_by must be either 'topology' or 'gateway'")
+
+        for key in keys:
+            shards[key].append(item)
+
+    return {key: shards[key] for key in sorted(shards)}
@@ -1,3 +1,6 @@
+from collections import defaultdict
+
+
 def get_topology(result_list):
     extracted_values = set()
 
@@ -42,4 +45,26 @@ def get_diagram_data(rules_diagrams, detailed_diagrams, combine_func):
     else:
         # For combined diagrams, apply the combine function first
         for path, path_rules in combine_func(rules_diagrams):
-            yield path, path_rules, get_topology_single, "single"
\ No newline at end of file
+            yield path, path_rules, get_topology_single, "single"
+
+def get_overlay_data(rules_diagrams):
+    """
+    Count the requested flows crossing each link of each topology for the overlay diagrams.
+    A flow is listed under every gateway it is installed on, so flows are counted once per
+    original rule and source/destination group rather than once per gateway.
+    Returns {topology: {(node1, node2): {rule number: flow count}}} with each link's nodes in sorted order.
+    """
+    flows = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
+    for path, path_rules in rules_diagrams.items():
+        for src, dst, comment in path_rules:
+            # Comments look like '1:COR:FW1, flow 1', the original rule number and topology are the first fields
+            fields = comment.split(':')
+            if len(fields) < 2:
+                continue
+            rule_number, topology = fields[0], fields[1]
+            for node1, node2 in zip(path, path[1:]):
+                flows[topology][tuple(sorted((node1, node2)))][rule_number].add((frozenset(src), frozenset(dst)))
+
+    return {topology: {edge: {rule_number: len(flow_set) for rule_number, flow_set in rules.items()}
+                       for edge, rules in edges.items()}
+            for topology, edges in flows.items()}
@@ -0,0 +1,260 @@
+import argparse
+import json
+from collections import defaultdict
+
+import networkx as nx
+
+import filter_excluded_flows
+import filter_include_flows
+import generate_xls_diagrams
+from configmanager import ConfigManager
+from findips import find_ip_addresses
+
+# Reports the rules whose install on gateways or paths change between two versions of a topology,
+# e.g. after adding a link to the diagram, moving a subnet in the YAML or loading a new route dump.
+# Everything is worked out against the old version, and only the IPs overlapping a prefix whose
+# firewall changed and the firewall pairs whose path could be affected by a link change are
+# looked up again in the new version.
+#
+# When a pair has several shortest paths of the same length generate_output takes the first one
+# found, which depends on the order of each node's links in the topology file. So a pair is also
+# looked up again when a link within its old path's length of both firewalls was added or removed,
+# or when the links of a node on its old path are in a different order, e.g. in a reordered file.
+#
+# Run with: python impact_diff.py CUSTOMER TOPOLOGY rules.json --old-subnets old_subnets.txt
+# Any of --old/--new-subnets, -routes and -topology not given are the files in the config.
+
+
+class TopologyVersion:
+    """One version of a topology with the shortest path between each pair of firewalls kept once found."""
+
+    def __init__(self, fw_subnets_file, routes_file=None, topology_file=None):
+        self.diagram, self.mapper, self.include_flows, self.exclude_flows = \
+            generate_xls_diagrams.load_topology(fw_subnets_file, routes_file, topology_file)
+        self.node_types = self.mapper.node_types
+        self.edges = {frozenset(edge) for edge in self.diagram.graph.edges}
+        self.path_cache = {}
+
+    def path(self, src_fw, dst_fw):
+        """The shortest path between two firewalls as a tuple, or None if there isn't one."""
+        try:
+            return tuple(generate_xls_diagrams.shortest_flow(self.diagram, src_fw, dst_fw, self.path_cache))
+        except (nx.NodeNotFound, ValueError):
+            return None
+
+    def install_on(self, path):
+        return [node for node in path if self.node_types.get(node, 'firewall') == 'firewall']
+
+
+class TopologyChange:
+    """The differences between two versions of a topology, used to decide what has to be looked up again."""
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+        old_map = old.mapper.subnet_firewall_map
+        new_map = new.mapper.subnet_firewall_map
+        self.changed_prefixes = [prefix for prefix in set(old_map) | set(new_map)
+                                 if old_map.get(prefix) != new_map.get(prefix)]
+        self.added_edges = [tuple(edge) for edge in new.edges - old.edges if len(edge) == 2]
+        self.removed_edges = old.edges - new.edges
+        self.reordered_nodes = {node for node in old.diagram.graph if node in new.diagram.graph
+                                and common_order(old.diagram.graph, new.diagram.graph, node)
+                                != common_order(new.diagram.graph, old.diagram.graph, node)}
+
+        self._firewalls = {}
+        self._pairs = {}
+        self._distances = {}
+        self.ips_recomputed = 0
+        self.pairs_recomputed = 0
+
+    def firewalls(self, ip):
+        """(old firewall, new firewall) for an IP, only looked up again if it overlaps a changed prefix."""
+        if ip not in self._firewalls:
+            old_fw = self.old.mapper.find_matching_firewall(ip)
+            if any(ip.network.overlaps(prefix) for prefix in self.changed_prefixes):
+                self.ips_recomputed += 1
+                new_fw = self.new.mapper.find_matching_firewall(ip)
+            else:
+                new_fw = old_fw
+            self._firewalls[ip] = (old_fw, new_fw)
+        return self._firewalls[ip]
+
+    def distances(self, version, node):
+        """Hops from a node to each node it reaches in a version."""
+        if (version, node) not in self._distances:
+            graph = version.diagram.graph
+            self._distances[(version, node)] = nx.single_source_shortest_path_length(graph, node) \
+                if node in graph else {}
+        return self._distances[(version, node)]
+
+    def edge_near(self, version, edge, src_fw, dst_fw, hops):
+        """Whether either end of a link is within hops of both firewalls in a version."""
+        return all(any(self.distances(version, fw).get(node, hops + 1) <= hops for node in edge)
+                   for fw in (src_fw, dst_fw))
+
+    def pair_affected(self, src_fw, dst_fw, old_path):
+        """
+        Whether the path between two firewalls could be different in the new version: the old path
+        uses a node or link that was removed, a link within the old path's length of both firewalls
+        was added or removed, which could give a shorter path or change which of several paths of the
+        same length is taken, or the links of a node on the old path are in a different order.
+        """
+        if old_path is None:
+            return bool(self.added_edges)
+        if any(node not in self.new.diagram.graph for node in old_path):
+            return True
+        if {frozenset(edge) for edge in zip(old_path, old_path[1:])} & self.removed_edges:
+            return True
+        if self.reordered_nodes.intersection(old_path):
+            return True
+
+        hops = len(old_path) - 1
+        return any(self.edge_near(self.new, edge, src_fw, dst_fw, hops) for edge in self.added_edges) or \
+            any(self.edge_near(self.old, edge, src_fw, dst_fw, hops) for edge in self.removed_edges)
+
+    def new_path(self, src_fw, dst_fw):
+        """The path between two firewalls in the new version, taken from the old version if it can't have changed."""
+        if (src_fw, dst_fw) not in self._pairs:
+            old_path = self.old.path(src_fw, dst_fw)
+            if self.pair_affected(src_fw, dst_fw, old_path):
+                self.pairs_recomputed += 1
+                self._pairs[(src_fw, dst_fw)] = self.new.path(src_fw, dst_fw)
+            else:
+                self._pairs[(src_fw, dst_fw)] = old_path
+        return self._pairs[(src_fw, dst_fw)]
+
+
+def common_order(graph, other, node):
+    """The links of a node in a graph that are also in the other graph, in the graph's order."""
+    return [neighbour for neighbour in graph.adj[node] if other.has_edge(node, neighbour)]
+
+
+def rule_gateways(flows, version, topology):
+    """{install on gateway: set of paths} for a rule's flows [((src_ip, dst_ip), topology, path)] in a version."""
+    flows = filter_include_flows.filter_ip_data(flows, {topology: version.include_flows})
+    flows = filter_excluded_flows.filter_ip_data(flows, {topology: version.exclude_flows})
+    gateways = defaultdict(set)
+    for _, _, path in flows:
+        for gateway in version.install_on(path):
+            gateways[gateway].add(' --> '.join(path))
+    return gateways
+
+
+def rule_impact(rule_id, rule, change, topology):
+    """The changes to a rule's install on gateways, paths and missing IPs, or None if it is not affected."""
+    src, dst = rule[0], rule[1]
+    src_ips, _ = find_ip_addresses(src)
+    dst_ips, _ = find_ip_addresses(dst)
+
+    old_flows, new_flows = [], []
+    old_missing, new_missing = set(), set()
+    for src_ip, dst_ip in generate_xls_diagrams.src_dst_permutations(src_ips, dst_ips):
+        (old_src_fw, new_src_fw), (old_dst_fw, new_dst_fw) = change.firewalls(src_ip), change.firewalls(dst_ip)
+
+        for src_fw, dst_fw, flows, missing, path_for in (
+                (old_src_fw, old_dst_fw, old_flows, old_missing, change.old.path),
+                (new_src_fw, new_dst_fw, new_flows, new_missing, change.new_path)):
+            if not src_fw or not dst_fw:
+                missing.update(str(ip) for ip, fw in ((src_ip, src_fw), (dst_ip, dst_fw)) if not fw)
+                continue
+            path = path_for(src_fw, dst_fw)
+            if path:
+                flows.append(((src_ip, dst_ip), topology, path))
+
+    old_gateways = rule_gateways(old_flows, change.old, topology)
+    new_gateways = rule_gateways(new_flows, change.new, topology)
+    if old_gateways == new_gateways and old_missing == new_missing:
+        return None
+
+    return {
+        'rule': rule_id,
+        'comment': rule[3].replace('; ', '\n').split('\n')[0] if len(rule) > 3 else '',
+        'added_gateways': {gateway: sorted(new_gateways[gateway]) for gateway in new_gateways
+                           if gateway not in old_gateways},
+        'removed_gateways': {gateway: sorted(old_gateways[gateway]) for gateway in old_gateways
+                             if gateway not in new_gateways},
+        'changed_paths': {gateway: {'removed': sorted(old_gateways[gateway] - new_gateways[gateway]),
+                                    'added': sorted(new_gateways[gateway] - old_gateways[gateway])}
+                          for gateway in old_gateways
+                          if gateway in new_gateways and old_gateways[gateway] != new_gateways[gateway]},
+        'now_missing': sorted(new_missing - old_missing),
+        'no_longer_missing': sorted(old_missing - new_missing),
+    }
+
+
+def topology_impact(rules, old, new, topology):
+    """Returns (the TopologyChange, the impact of each affected rule) for a list of rules."""
+    change = TopologyChange(old, new)
+    impacts = []
+    for rule_id, rule in enumerate(rules, start=1):
+        impact = rule_impact(rule_id, rule, change, topology)
+        if impact:
+            impacts.append(impact)
+    return change, impacts
+
+
+def format_impact(impacts, change, topology, rule_count):
+    lines = [f"Topology {topology}: {len(change.changed_prefixes)} prefixes changed, "
+             f"{len(change.added_edges)} links added, {len(change.removed_edges)} links removed",
+             f"Looked up again: {change.ips_recomputed} of {len(change._firewalls)} IPs, "
+             f"{change.pairs_recomputed} of {len(change._pairs)} firewall pairs",
+             f"{len(change.reordered_nodes)} nodes with reordered links, pairs with several shortest paths "
+             f"near a change are looked up again so the path taken is the one generate_output takes",
+             f"{len(impacts)} of {rule_count} rules affected"]
+    for impact in impacts:
+        lines.append("")
+        lines.append(f"Rule {impact['rule']}: {impact['comment']}")
+        for gateway, paths in impact['added_gateways'].items():
+            lines.append(f"  + install on {gateway}: {'; '.join(paths)}")
+        for gateway, paths in impact['removed_gateways'].items():
+            lines.append(f"  - install on {gateway}: {'; '.join(paths)}")
+        for gateway, paths in impact['changed_paths'].items():
+            lines.append(f"  ~ {gateway}:")
+            lines.extend(f"      - {path}" for path in paths['removed'])
+            lines.extend(f"      + {path}" for path in paths['added'])
+        if impact['now_missing']:
+            lines.append(f"  now missing: {', '.join(impact['now_missing'])}")
+        if impact['no_longer_missing']:
+            lines.append(f"  no longer missing: {', '.join(impact['no_longer_missing'])}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the rules affected by a change to a topology.")
+    parser.add_argument('customer')
+    parser.add_argument('topology')
+    parser.add_argument('rules', help="JSON rule dump, as saved in json_rule_dumps")
+    parser.add_argument('--config', default='config.ini')
+    for version in ('old', 'new'):
+        for kind in ('subnets', 'routes', 'topology'):
+            parser.add_argument(f'--{version}-{kind}', help=f"{kind} file of the {version} version")
+    parser.add_argument('--json', help="Also write the affected rules to this JSON file")
+    args = parser.parse_args()
+
+    config_mgr = ConfigManager(args.config)
+    topology_dict = config_mgr.get_topology(args.customer, args.topology)
+    if topology_dict is None:
+        parser.error(f"Topology {args.topology} not found for {args.customer} in {args.config}")
+
+    versions = {}
+    for version in ('old', 'new'):
+        files = {kind: getattr(args, f'{version}_{kind}') or topology_dict.get(kind) or None
+                 for kind in ('subnets', 'routes', 'topology')}
+        versions[version] = TopologyVersion(files['subnets'], files['routes'], files['topology'])
+
+    with open(args.rules, 'r') as f:
+        rules = json.load(f)
+    rules = rules.get(args.customer, next(iter(rules.values()), [])) if isinstance(rules, dict) else rules
+
+    change, impacts = topology_impact(rules, versions['old'], versions['new'], args.topology)
+    print(format_impact(impacts, change, args.topology, len(rules)))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(impacts, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# Progress and cancelling shared by generate_output and the diagram backends, so the GUI's
+# progress bar moves and its Cancel button works while the diagrams are being drawn.
+
+
+class ProcessingCancelled(Exception):
+    """Raised by generate_output when its cancel_event is set."""
+
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise ProcessingCancelled("Processing cancelled")
+
+
+def run_jobs(function, jobs, executor=None, max_workers=1, progress=None, cancel_event=None):
+    """
+    Call function on each job, in executor if given or else one at a time, and return the results
+    in the order of jobs. progress, if given, is called with (done, total) as each job finishes.
+    Only max_workers jobs are submitted at a time, so once cancel_event is set no more are started,
+    the running ones finish and ProcessingCancelled is raised.
+    """
+    results = [None] * len(jobs)
+    total = len(jobs)
+    done = 0
+    if executor is None:
+        for index, job in enumerate(jobs):
+            check_cancelled(cancel_event)
+            results[index] = function(job)
+            done += 1
+            if progress:
+                progress(done, total)
+        return results
+
+    remaining = iter(enumerate(jobs))
+    pending = {}
+
+    def submit_next():
+        for index, job in remaining:
+            pending[executor.submit(function, job)] = index
+            return
+
+    for _ in range(max_workers):
+        submit_next()
+    while pending:
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            results[pending.pop(future)] = future.result()
+            done += 1
+            if progress:
+                progress(done, total)
+            if cancel_event is None or not cancel_event.is_set():
+                submit_next()
+
+    check_cancelled(cancel_event)
+    return results
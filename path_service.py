@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import time
+from collections import defaultdict
+from functools import lru_cache
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import filter_excluded_flows
+import filter_include_flows
+import generate_xls_diagrams
+from configmanager import ConfigManager
+
+# A local HTTP/JSON service answering "which firewalls and path does src -> dst take" for one customer.
+# The topologies are loaded once, the mappers answer each IP from their prefix index and the
+# shortest path between each pair of firewalls is kept once found, so a query is only a few lookups.
+# The config and topology files are checked every few seconds and the topologies reloaded when they
+# change, a reload that fails keeps the topologies already loaded.
+#
+#   GET  /health                            customer, topologies and when they were loaded
+#   GET  /path?src=10.1.1.10&dst=10.2.1.10  or POST /path {"src": ..., "dst": ..., "topology": optional}
+#   POST /paths {"queries": [{"src": ..., "dst": ...}, ...]}
+#   POST /reload
+#
+# Run with: python path_service.py CUSTOMER [--config config.ini] [--port 8740 | --socket PATH]
+
+DEFAULT_PORT = 8740
+
+# Seconds between checks of the topology files
+RELOAD_INTERVAL = 2.0
+
+# Largest request body accepted
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+class QueryError(ValueError):
+    """A query that can't be answered, sent back to the client with the HTTP status."""
+
+    def __init__(self, message, status=HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+
+def topology_files(config_mgr, cust):
+    """The config file and the subnets, routes and topology files of each of the customer's topologies."""
+    files = [config_mgr.file_path]
+    for topology in config_mgr.get_customer_subsections(cust):
+        topology_dict = config_mgr.get_topology(cust, topology) or {}
+        files.extend(path for key, path in topology_dict.items() if key in ('subnets', 'routes', 'topology'))
+    return files
+
+
+def file_mtimes(files):
+    mtimes = {}
+    for filename in files:
+        try:
+            mtimes[filename] = os.path.getmtime(filename)
+        except OSError:
+            mtimes[filename] = None
+    return mtimes
+
+
+def parse_ip(value, name):
+    # The same addresses as the rules, an IPv4 address with an optional prefix length.
+    # Anything but a string or a number, e.g. a list from a JSON body, is rejected before the cache
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise QueryError(f"Invalid {name} IP {json.dumps(value)}, expected a string")
+    return _parse_ip(str(value).strip(), name)
+
+
+@lru_cache(maxsize=65536)
+def _parse_ip(value, name):
+    # Cached as the same addresses come up again and again in batches of queries
+    try:
+        return ipaddress.IPv4Interface(value)
+    except ValueError:
+        raise QueryError(f"Invalid {name} IP '{value}'")
+
+
+class TopologyState:
+    """A customer's loaded topologies, replaced as a whole when the files change."""
+
+    def __init__(self, config_file, cust):
+        config_mgr = ConfigManager(config_file)
+        if cust not in config_mgr.get_customers():
+            raise ValueError(f"Customer '{cust}' not found in {config_file}")
+
+        # Taken before loading so a file saved during the load is picked up by the next check
+        self.mtimes = file_mtimes(topology_files(config_mgr, cust))
+        self.topologies, self.node_types, _, self.include_flows, self.exclude_flows = \
+            generate_xls_diagrams.load_topologies(config_mgr, cust)
+        self.path_cache = {}
+        self.loaded_at = time.time()
+
+    def query(self, src, dst, topology=None):
+        """
+        The paths from src to dst in each topology, or only the named one, with the firewalls
+        to install the rule on and the IPs missing from each topology.
+        """
+        src_ip = parse_ip(src, 'source')
+        dst_ip = parse_ip(dst, 'destination')
+        if topology:
+            if topology not in self.topologies:
+                raise QueryError(f"Unknown topology '{topology}'", HTTPStatus.NOT_FOUND)
+            topologies = {topology: self.topologies[topology]}
+        else:
+            topologies = self.topologies
+
+        missing_ips = defaultdict(set)
+        flows = generate_xls_diagrams.find_flows(src_ip, dst_ip, topologies, missing_ips, self.path_cache)
+        flows = filter_include_flows.filter_ip_data(flows, self.include_flows)
+        flows = filter_excluded_flows.filter_ip_data(flows, self.exclude_flows)
+
+        return {
+            'src': str(src_ip),
+            'dst': str(dst_ip),
+            'paths': [{
+                'topology': topology_name,
+                'path': list(path),
+                'install_on': [node for node in path
+                               if self.node_types[topology_name].get(node, 'firewall') == 'firewall'],
+            } for _, topology_name, path in flows],
+            'missing': {topology_name: sorted(str(ip) for ip in ips) for topology_name, ips in missing_ips.items()},
+        }
+
+
+class PathService:
+    def __init__(self, config_file, cust, reload_interval=RELOAD_INTERVAL):
+        self.config_file = config_file
+        self.cust = cust
+        self.reload_interval = reload_interval
+        self.state = TopologyState(config_file, cust)
+
+    async def reload(self):
+        # Loaded on a worker thread so queries are answered from the old topologies meanwhile
+        loop = asyncio.get_running_loop()
+        self.state = await loop.run_in_executor(None, TopologyState, self.config_file, self.cust)
+        print(f"Loaded topologies for {self.cust}: {', '.join(self.state.topologies)}")
+
+    async def watch(self):
+        failed_mtimes = None
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            mtimes = file_mtimes(self.state.mtimes)
+            if mtimes == self.state.mtimes or mtimes == failed_mtimes:
+                continue
+            try:
+                await self.reload()
+                failed_mtimes = None
+            except Exception as e:
+                # Tried again once the files are saved again
+                failed_mtimes = mtimes
+                print(f"Error reloading topologies for {self.cust}: {str(e)}")
+
+    def query(self, query):
+        if not isinstance(query, dict):
+            raise QueryError("A query must be an object with src and dst")
+        if 'src' not in query or 'dst' not in query:
+            raise QueryError("A query needs both src and dst")
+        return self.state.query(query['src'], query['dst'], query.get('topology'))
+
+    async def handle(self, method, target, body):
+        """Answer one request, returns (status, response object)."""
+        url = urlsplit(target)
+
+        if url.path == '/health' and method == 'GET':
+            return HTTPStatus.OK, {
+                'customer': self.cust,
+                'topologies': list(self.state.topologies),
+                'loaded_at': self.state.loaded_at,
+            }
+
+        if url.path == '/reload' and method == 'POST':
+            await self.reload()
+            return HTTPStatus.OK, {'topologies': list(self.state.topologies), 'loaded_at': self.state.loaded_at}
+
+        if url.path == '/path' and method == 'GET':
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            return HTTPStatus.OK, self.query(params)
+
+        if url.path in ('/path', '/paths') and method == 'POST':
+            try:
+                request = json.loads(body or b'null')
+            except ValueError as e:
+                raise QueryError(f"Invalid JSON: {str(e)}")
+
+            if url.path == '/path':
+                return HTTPStatus.OK, self.query(request)
+
+            queries = request.get('queries') if isinstance(request, dict) else request
+            if not isinstance(queries, list):
+                raise QueryError("Expected a list of queries")
+            # One bad query is reported in its place rather than failing the batch
+            results = []
+            for query in queries:
+                try:
+                    results.append(self.query(query))
+                except QueryError as e:
+                    results.append({'error': str(e)})
+            return HTTPStatus.OK, {'results': results}
+
+        raise QueryError(f"No {method} {url.path}", HTTPStatus.NOT_FOUND)
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive, so a client can send many queries over one connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0) or 0)
+                if length > MAX_BODY_SIZE:
+                    status, response = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': 'Request body too large'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                    try:
+                        status, response = await self.handle(method.upper(), target, body)
+                    except QueryError as e:
+                        status, response = e.status, {'error': str(e)}
+                    except Exception as e:
+                        status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}
+
+                payload = json.dumps(response).encode('utf-8')
+                writer.write((f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                              f"Content-Type: application/json\r\n"
+                              f"Content-Length: {len(payload)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1')
+                             + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None):
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+            print(f"Serving paths for {self.cust} on {socket_path}")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print(f"Serving paths for {self.cust} on http://{host}:{port}")
+
+        watcher = asyncio.create_task(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve firewall path lookups for a customer's topologies.")
+    parser.add_argument('customer')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', help="Listen on this Unix socket instead of TCP")
+    parser.add_argument('--reload-interval', type=float, default=RELOAD_INTERVAL,
+                        help="Seconds between checks of the topology files")
+    args = parser.parse_args()
+
+    service = PathService(args.config, args.customer, args.reload_interval)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import openpyxl
+from openpyxl.utils import column_index_from_string
+from typing import Iterator, List, Optional
+
+
+def normalize_cell(value) -> str:
+    """Cell value as text, empty cells as '' and with Excel's escaped carriage returns removed."""
+    if value is None:
+        return ''
+    return str(value).replace('_x000D_', '')
+
+
+def iter_excel_rules(file_path: str, sheet_name: Optional[str], start_row: int, source_ips: str, dest_ips: str,
+                     services: str, comments: str) -> Iterator[List[str]]:
+    """
+    Yield [source, destination, services, comments] for each rule in a sheet, starting at
+    start_row and stopping at the first empty row. The workbook is opened read only so the
+    rows are streamed from the file, and the rules can be passed straight to generate_output.
+    Columns are given as letters. The sheet defaults to the active sheet when sheet_name is
+    empty or not in the workbook.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        if sheet_name and sheet_name in workbook.sheetnames:
+            sheet = workbook[sheet_name]
+        else:
+            sheet = workbook.active
+
+        columns = [column_index_from_string(col.strip().upper()) - 1
+                   for col in (source_ips, dest_ips, services, comments)]
+
+        for row in sheet.iter_rows(min_row=start_row, values_only=True):
+            if all(cell is None or cell == "" for cell in row):
+                break
+
+            yield [normalize_cell(row[col]) if col < len(row) else '' for col in columns]
+    finally:
+        workbook.close()
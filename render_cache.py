@@ -0,0 +1,51 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+def cache_key(diagram_source, image_format):
+    """Hash the diagram source together with the output format."""
+    return hashlib.sha256(f"{image_format}\n{diagram_source}".encode('utf-8')).hexdigest()
+
+
+def cached_image_path(cache_dir, diagram_source, image_format):
+    return os.path.join(cache_dir, f"{cache_key(diagram_source, image_format)}.{image_format}")
+
+
+def fetch(cache_dir, diagram_source, image_format, image_file):
+    """
+    Copy a previously rendered image for this source to image_file.
+    Returns True on a cache hit, False if the diagram needs rendering.
+    """
+    if not cache_dir:
+        return False
+
+    cached_image = cached_image_path(cache_dir, diagram_source, image_format)
+    if not os.path.exists(cached_image):
+        return False
+
+    # Copy rather than link so a later render over image_file can't modify the cached copy
+    shutil.copyfile(cached_image, image_file)
+    return True
+
+
+def store(cache_dir, diagram_source, image_format, image_file):
+    """Add a freshly rendered image to the cache."""
+    if not cache_dir or not image_file or not os.path.exists(image_file):
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_image = cached_image_path(cache_dir, diagram_source, image_format)
+
+    # Write to a temporary file and move it into place so concurrent renders
+    # never see a partially written cache entry
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(image_file, tmp_file)
+        os.replace(tmp_file, cached_image)
+    except OSError as e:
+        print(f"Error caching {image_file}: {e}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
@@ -0,0 +1,197 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from path_service import QueryError, TopologyState
+
+# Resolves a list of flows, e.g. a NetFlow export, against all of a customer's topologies to audit the
+# traffic against the topology model. The flows are read as CSV or JSONL with src, dst and an optional
+# service, sent to a pool of processes in chunks, each of which loads the topologies once, and the
+# results are written as they come back in the order of the input. Only a few chunks are in flight at
+# once so the memory used stays the same however long the file is.
+#
+# Run with: python resolve_flows.py CUSTOMER flows.csv -o resolved.csv [--config config.ini]
+
+# Flows sent to a worker at a time
+CHUNK_SIZE = 5000
+
+# Results of the most recent distinct src/dst pairs kept by each worker, flow exports repeat pairs a lot
+PAIR_CACHE_SIZE = 100000
+
+# Names accepted for the columns of a CSV with a header row
+COLUMN_NAMES = {
+    'src': ('src', 'source', 'src_ip', 'source_ip', 'srcaddr'),
+    'dst': ('dst', 'destination', 'dst_ip', 'destination_ip', 'dstaddr'),
+    'service': ('service', 'services', 'port', 'dst_port', 'dstport'),
+}
+
+CSV_FIELDS = ['line', 'src', 'dst', 'service', 'topology', 'src_firewall', 'dst_firewall', 'path', 'install_on',
+              'missing', 'error']
+
+_state = None
+
+
+def _init_worker(config_file, cust):
+    global _state
+    _state = TopologyState(config_file, cust)
+
+
+@lru_cache(maxsize=PAIR_CACHE_SIZE)
+def _resolve_pair(src, dst):
+    try:
+        return _state.query(src, dst)
+    except QueryError as e:
+        return {'src': src, 'dst': dst, 'paths': [], 'missing': {}, 'error': str(e)}
+
+
+def _resolve_chunk(chunk):
+    results = []
+    for line, src, dst, service in chunk:
+        pair = _resolve_pair(src, dst)
+        results.append({'line': line, 'src': pair['src'], 'dst': pair['dst'], 'service': service, **pair})
+    return results
+
+
+def column_index(header, field):
+    names = [name.strip().lower() for name in header]
+    for alias in COLUMN_NAMES[field]:
+        if alias in names:
+            return names.index(alias)
+    return None
+
+
+def read_csv_flows(f):
+    """
+    Yield (line, src, dst, service) from a CSV. A header row naming the src and dst columns is used if
+    there is one, otherwise the first three columns are src, dst and service.
+    """
+    reader = csv.reader(f)
+    columns = (0, 1, 2)
+    for line, row in enumerate(reader, start=1):
+        if not row:
+            continue
+        if line == 1:
+            src_column, dst_column = column_index(row, 'src'), column_index(row, 'dst')
+            if src_column is not None and dst_column is not None:
+                columns = (src_column, dst_column, column_index(row, 'service'))
+                continue
+        src_column, dst_column, service_column = columns
+        service = row[service_column] if service_column is not None and service_column < len(row) else ''
+        yield (line, row[src_column] if src_column < len(row) else '',
+               row[dst_column] if dst_column < len(row) else '', service)
+
+
+def read_jsonl_flows(f):
+    """Yield (line, src, dst, service) from JSON objects, one per line."""
+    for line, text in enumerate(f, start=1):
+        if not text.strip():
+            continue
+        try:
+            flow = json.loads(text)
+        except ValueError:
+            yield line, '', '', ''
+            continue
+        values = {}
+        for field, aliases in COLUMN_NAMES.items():
+            values[field] = next((flow[alias] for alias in aliases if alias in flow), '')
+        yield line, str(values['src']), str(values['dst']), str(values['service'])
+
+
+def chunked(flows, chunk_size):
+    chunk = []
+    for flow in flows:
+        chunk.append(flow)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def resolve_chunks(chunks, config_file, cust, max_workers=None):
+    """
+    Resolve the chunks of flows in a process pool, yielding the results of each chunk in order.
+    At most two chunks per worker are queued at a time.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(config_file, cust)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_resolve_chunk, chunk))
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def csv_rows(result):
+    """One row per path, or a single row without a topology when the flow has no path."""
+    missing = '; '.join(f"{topology}: {', '.join(ips)}" for topology, ips in sorted(result['missing'].items()))
+    base = {'line': result['line'], 'src': result['src'], 'dst': result['dst'], 'service': result['service'],
+            'missing': missing, 'error': result.get('error', '')}
+    if not result['paths']:
+        return [base]
+    return [dict(base, topology=path['topology'], src_firewall=path['path'][0], dst_firewall=path['path'][-1],
+                 path=' --> '.join(path['path']), install_on='; '.join(path['install_on']))
+            for path in result['paths']]
+
+
+def file_format(filename, given):
+    if given:
+        return given
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resolve a CSV or JSONL list of flows against a customer's "
+                                                 "topologies.")
+    parser.add_argument('customer')
+    parser.add_argument('input', help="CSV or JSONL file of flows, - for stdin")
+    parser.add_argument('-o', '--output', default='-', help="Output file, - for stdout (the default)")
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--input-format', choices=('csv', 'jsonl'))
+    parser.add_argument('--output-format', choices=('csv', 'jsonl'))
+    parser.add_argument('--workers', type=int, help="Worker processes, defaults to the number of CPUs")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    input_format = file_format(args.input, args.input_format)
+    output_format = file_format(args.output, args.output_format)
+
+    infile = sys.stdin if args.input == '-' else open(args.input, 'r', newline='', encoding='utf-8')
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    start = time.perf_counter()
+    flow_count = 0
+    try:
+        flows = read_jsonl_flows(infile) if input_format == 'jsonl' else read_csv_flows(infile)
+        writer = None
+        if output_format == 'csv':
+            writer = csv.DictWriter(outfile, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+
+        for results in resolve_chunks(chunked(flows, args.chunk_size), args.config, args.customer, args.workers):
+            for result in results:
+                if writer:
+                    writer.writerows(csv_rows(result))
+                else:
+                    outfile.write(json.dumps(result))
+                    outfile.write('\n')
+            flow_count += len(results)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    print(f"Resolved {flow_count} flows in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import bisect
+import ipaddress
+import re
+from collections import defaultdict
+
+# Finds the requested rules that are duplicates of, shadowed by or overlap earlier rules on the same
+# install on gateway, before they get to the firewall. Each rule is the set of its source and
+# destination address pairs on the gateway, each pair a box of two integer intervals.
+#
+# The addresses are CIDR networks, so two of them either don't overlap or one contains the other.
+# The networks containing an address are found by masking it to each prefix length used on the
+# gateway, like subnetfirewallmapper's prefix index, and the networks inside it are a range of the
+# networks sorted by first address. Only the pairs found that way are compared, rather than
+# every pair of rules.
+#
+# A rule is
+#   Duplicate   when an earlier rule has the same address pairs and services,
+#   Shadowed    when nothing is left of its address pairs once the address pairs of earlier rules
+#               whose services include all of its services are taken out, by one rule or several,
+#   Overlap     when it shares addresses and services with earlier rules without being covered.
+
+# Service names that allow everything
+ANY_SERVICES = {'any', 'ip any', 'ip', 'all'}
+
+# Address pairs listed for each finding
+MAX_EXAMPLES = 3
+
+SHEET_TITLE = "Overlaps"
+HEADERS = ['Topology', 'Gateway', 'Rule', 'Comment', 'Finding', 'Earlier Rules', 'Addresses']
+
+
+def parse_services(text):
+    """The set of service names in a rule's services, or None if they allow any service."""
+    services = {service.strip().lower() for service in re.split(r'[\n\r;,]', text or '') if service.strip()}
+    if not services or services & ANY_SERVICES:
+        return None
+    return frozenset(services)
+
+
+def services_cover(outer, inner):
+    return outer is None or (inner is not None and inner <= outer)
+
+
+def services_overlap(a, b):
+    return a is None or b is None or bool(a & b)
+
+
+def network_interval(ip):
+    network = ip.network if hasattr(ip, 'network') else ipaddress.ip_network(ip, strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
+def interval_text(first, last):
+    network = next(ipaddress.summarize_address_range(ipaddress.IPv4Address(first), ipaddress.IPv4Address(last)))
+    return str(network)
+
+
+def box_text(box):
+    return f"{interval_text(box[0], box[1])} -> {interval_text(box[2], box[3])}"
+
+
+def box_difference(box, other):
+    """The parts of a box outside another box, at most four boxes."""
+    source_first, source_last, destination_first, destination_last = box
+    if other[1] < source_first or source_last < other[0] or other[3] < destination_first or destination_last < other[2]:
+        return [box]
+    pieces = []
+    if source_first < other[0]:
+        pieces.append((source_first, other[0] - 1, destination_first, destination_last))
+    if other[1] < source_last:
+        pieces.append((other[1] + 1, source_last, destination_first, destination_last))
+    # The source addresses inside the other box, above and below its destinations
+    source_first, source_last = max(source_first, other[0]), min(source_last, other[1])
+    if destination_first < other[2]:
+        pieces.append((source_first, source_last, destination_first, other[2] - 1))
+    if other[3] < destination_last:
+        pieces.append((source_first, source_last, other[3] + 1, destination_last))
+    return pieces
+
+
+def subtract(box, others):
+    """The parts of a box outside all the other boxes."""
+    remaining = [box]
+    for other in others:
+        remaining = [piece for part in remaining for piece in box_difference(part, other)]
+        if not remaining:
+            break
+    return remaining
+
+
+class RuleEntry:
+    """One rule on one gateway: where it sorts, how it is shown and its services and address pairs."""
+
+    __slots__ = ('order', 'label', 'comment', 'services', 'boxes')
+
+    def __init__(self, order, label, comment, services):
+        self.order = order
+        self.label = label
+        self.comment = comment
+        self.services = services
+        self.boxes = set()
+
+
+class AddressIndex:
+    """The address pairs of the rules on one gateway, indexed on their source and destination networks."""
+
+    def __init__(self, boxes):
+        # boxes is [(box, entry)]
+        self.boxes = boxes
+        by_pair = defaultdict(list)
+        by_source = defaultdict(list)
+        by_destination = defaultdict(list)
+        source_sizes = set()
+        destination_sizes = set()
+        for box_id, (box, _) in enumerate(boxes):
+            source_size = box[1] - box[0] + 1
+            destination_size = box[3] - box[2] + 1
+            by_pair[(box[0], source_size, box[2], destination_size)].append(box_id)
+            by_source[(box[0], source_size)].append((box[2], box_id))
+            by_destination[(box[2], destination_size)].append((box[0], box_id))
+            source_sizes.add(source_size)
+            destination_sizes.add(destination_size)
+
+        self.by_pair = by_pair
+        self.by_source = {key: sorted_starts(values) for key, values in by_source.items()}
+        self.by_destination = {key: sorted_starts(values) for key, values in by_destination.items()}
+        self.source_sizes = sorted(source_sizes)
+        self.destination_sizes = sorted(destination_sizes)
+        self.sources = sorted_starts([(box[0], box_id) for box_id, (box, _) in enumerate(boxes)])
+        self.destinations = sorted_starts([(box[2], box_id) for box_id, (box, _) in enumerate(boxes)])
+
+    def overlapping(self, box):
+        """
+        The ids of the address pairs overlapping a box. Each network of an overlapping pair either contains
+        the box's network, found by masking it to each larger prefix length, or is inside it, a range of
+        networks sorted by their first address.
+        """
+        source_first, source_last, destination_first, destination_last = box
+        source_containing = containing_keys(source_first, source_last, self.source_sizes)
+        destination_containing = containing_keys(destination_first, destination_last, self.destination_sizes)
+
+        candidates = set()
+        # Both networks contained
+        for source_key in source_containing:
+            for destination_key in destination_containing:
+                candidates.update(self.by_pair.get(source_key + destination_key, ()))
+        # Source contained, destination inside
+        for source_key in source_containing:
+            if source_key in self.by_source:
+                candidates.update(starts_between(self.by_source[source_key], destination_first, destination_last))
+        # Destination contained, source inside
+        for destination_key in destination_containing:
+            if destination_key in self.by_destination:
+                candidates.update(starts_between(self.by_destination[destination_key], source_first, source_last))
+        # Both inside, scanning whichever of the two ranges has fewer networks
+        sources = between(self.sources, source_first, source_last)
+        destinations = between(self.destinations, destination_first, destination_last)
+        if sources[1] - sources[0] <= destinations[1] - destinations[0]:
+            inside = [box_id for box_id in self.sources[1][sources[0]:sources[1]]
+                      if destination_first <= self.boxes[box_id][0][2] <= destination_last]
+        else:
+            inside = [box_id for box_id in self.destinations[1][destinations[0]:destinations[1]]
+                      if source_first <= self.boxes[box_id][0][0] <= source_last]
+        candidates.update(inside)
+        return candidates
+
+
+def sorted_starts(values):
+    """([first addresses], [box ids]) sorted on the first address."""
+    values.sort()
+    return [start for start, _ in values], [box_id for _, box_id in values]
+
+
+def between(starts, first, last):
+    return bisect.bisect_left(starts[0], first), bisect.bisect_right(starts[0], last)
+
+
+def starts_between(starts, first, last):
+    low, high = between(starts, first, last)
+    return starts[1][low:high]
+
+
+def containing_keys(first, last, sizes):
+    """(first address, size) of the network and each larger network containing it."""
+    size = last - first + 1
+    return [(first - first % other_size, other_size) for other_size in sizes[bisect.bisect_left(sizes, size):]]
+
+
+class RuleOverlaps:
+    """Collects the rules of a run, and optionally earlier runs, per install on gateway and reports their overlaps."""
+
+    def __init__(self, node_types=None):
+        self.node_types = node_types or {}
+        # {(topology, gateway): {(run, rule number): RuleEntry}}
+        self.gateways = defaultdict(dict)
+
+    def entry(self, topology, gateway, order, label, comment, services):
+        entries = self.gateways[(topology, gateway)]
+        if order not in entries:
+            entries[order] = RuleEntry(order, label, comment, services)
+        return entries[order]
+
+    def add_rule(self, rule_number, rule, flows):
+        """Add a rule [source, destination, services, comments] of this run with its flows [((src_ip, dst_ip), topology, path)]."""
+        services = parse_services(rule[2])
+        comment = rule[3].replace('; ', '\n').split('\n')[0]
+        for (src_ip, dst_ip), topology, path in flows:
+            box = network_interval(src_ip) + network_interval(dst_ip)
+            types = self.node_types.get(topology, {})
+            for gateway in path:
+                if types.get(gateway, 'firewall') == 'firewall':
+                    self.entry(topology, gateway, (1, 0, rule_number), str(rule_number), comment,
+                               services).boxes.add(box)
+
+    def add_stored_flows(self, stored_flows):
+        """Add the flows of earlier runs from RunStore.install_on_flows, they come before the rules of this run."""
+        for flow in stored_flows:
+            order = (0, flow['run_id'], flow['rule_number'])
+            comment = (flow['comment'] or '').replace('; ', '\n').split('\n')[0]
+            self.entry(flow['topology'], flow['node'], order, f"Run {flow['run_id']} rule {flow['rule_number']}",
+                       comment, parse_services(flow['services'])).boxes.add(
+                (flow['src_first'], flow['src_last'], flow['dst_first'], flow['dst_last']))
+
+    def gateway_findings(self, topology, gateway, entries):
+        entries = sorted(entries.values(), key=lambda entry: entry.order)
+        index = AddressIndex([(box, entry) for entry in entries for box in entry.boxes])
+        identical = {}
+        findings = []
+
+        for entry in entries:
+            key = (frozenset(entry.boxes), entry.services)
+            duplicate_of = identical.setdefault(key, entry)
+            if entry.order[0] == 0:
+                # Earlier runs are only compared against
+                continue
+
+            covered = set()
+            covering = set()
+            overlapping = set()
+            examples = []
+            for box in sorted(entry.boxes):
+                covering_boxes = []
+                for box_id in index.overlapping(box):
+                    other_box, other = index.boxes[box_id]
+                    if other.order >= entry.order or not services_overlap(other.services, entry.services):
+                        continue
+                    overlapping.add(other)
+                    if services_cover(other.services, entry.services):
+                        covering_boxes.append((other_box, other))
+                    if len(examples) < MAX_EXAMPLES and box not in examples:
+                        examples.append(box)
+                # Covered by one earlier rule or by several together
+                if covering_boxes and not subtract(box, [other_box for other_box, _ in covering_boxes]):
+                    covered.add(box)
+                    covering.update(other for _, other in covering_boxes)
+
+            if duplicate_of is not entry:
+                finding, others = 'Duplicate', [duplicate_of]
+            elif covered and len(covered) == len(entry.boxes):
+                finding, others = 'Shadowed', covering
+            elif overlapping:
+                finding, others = 'Overlap', overlapping
+            else:
+                continue
+            findings.append((topology, gateway, entry.label, entry.comment, finding,
+                             '\n'.join(other.label for other in sorted(others, key=lambda other: other.order)),
+                             '\n'.join(box_text(box) for box in examples)))
+        return findings
+
+    def findings(self):
+        """Rows of HEADERS, one per rule and gateway with a finding."""
+        findings = []
+        for (topology, gateway), entries in sorted(self.gateways.items()):
+            findings.extend(self.gateway_findings(topology, gateway, entries))
+        return findings
@@ -0,0 +1,68 @@
+import time
+from collections import defaultdict
+
+import generate_xls_diagrams
+
+# Resolves single rules against a customer's topologies that are loaded once and kept,
+# for the preview pane of the manual input form. The rules go through the same
+# generate_xls_diagrams.resolve_rule as generate_output, with the shortest path between
+# each pair of firewalls kept between rules, so each preview only costs the IP lookups.
+
+
+class RulePreview:
+    def __init__(self, config_mgr, cust):
+        self.cust = cust
+        self.topologies, self.node_types, _, self.include_flows, self.exclude_flows = \
+            generate_xls_diagrams.load_topologies(config_mgr, cust)
+
+        inc_flow_count = config_mgr.get_excel_config(cust).get('include_flow_count', 'no')
+        self.inc_flow_count = inc_flow_count.lower() != 'no'
+
+        self.path_cache = {}
+
+    def resolve(self, rule):
+        """
+        Resolve one rule [source, destination, services, comments].
+        Returns a dict with the output rows, the rows skipped as their gateway is not a firewall,
+        the IPs missing from each topology and the time taken in milliseconds.
+        """
+        start = time.perf_counter()
+        missing_ips = defaultdict(set)
+        rows, skipped_rows = generate_xls_diagrams.resolve_rule(
+            1, rule, self.topologies, self.node_types, self.include_flows, self.exclude_flows,
+            self.inc_flow_count, missing_ips, path_cache=self.path_cache)
+        return {
+            'rows': rows,
+            'skipped_rows': skipped_rows,
+            'missing_ips': missing_ips,
+            'elapsed_ms': (time.perf_counter() - start) * 1000,
+        }
+
+
+def format_preview(result):
+    """Text for the preview pane: the install on gateways and paths per topology and the missing IPs."""
+    install_on = defaultdict(list)
+    paths = defaultdict(dict)
+    for row in result['rows']:
+        topology = row[4].split(':')[1]
+        install_on[topology].append(row[6])
+        # Each gateway's row lists the paths through it, show each path once per topology
+        for path in row[5].split('\n'):
+            paths[topology][path.split(': ', 1)[-1]] = None
+
+    lines = []
+    for topology in install_on:
+        lines.append(f"{topology}: install on {', '.join(install_on[topology])}")
+        lines.extend(f"    {path}" for path in paths[topology])
+
+    skipped = sorted({(row[4].split(':')[1], row[6]) for row in result['skipped_rows']})
+    if skipped:
+        lines.append("Not firewalls: " + ', '.join(f"{gateway} ({topology})" for topology, gateway in skipped))
+
+    for topology, ips in sorted(result['missing_ips'].items()):
+        lines.append(f"Missing in {topology}: {', '.join(sorted(str(ip) for ip in ips))}")
+
+    if not lines:
+        lines.append("No firewalls found")
+    lines.append(f"({result['elapsed_ms']:.0f} ms)")
+    return '\n'.join(lines)
@@ -0,0 +1,108 @@
+from typing import Dict, Iterable, List, Optional, Sequence
+
+# Backing store for the rules shown in the GUI's rule table.
+# Each rule is [source, destination, services, comments] and is kept under an id that stays
+# the same across edits and deletes, the table only shows a window of rows at a time and
+# refers to the rules by id. The filtered view is a list of ids, rebuilt when the filter
+# changes, with the lower case text of each rule cached so filtering 10,000s of rules is fast.
+
+FIELDS = ("Source IPs", "Destination IPs", "Services", "Comments")
+
+
+def rule_text(values: Sequence) -> List[str]:
+    return ['' if value is None else str(value) for value in values]
+
+
+class RuleStore:
+    def __init__(self, rules: Optional[Iterable[Sequence]] = None):
+        self.rules: Dict[int, List[str]] = {}
+        self.order: List[int] = []
+        self.next_id = 0
+        self._search_text: Dict[int, List[str]] = {}
+        self.filter_text = ''
+        self.filter_field: Optional[str] = None
+        self._view: Optional[List[int]] = None
+        for values in rules or []:
+            self.add(values)
+
+    def __len__(self):
+        return len(self.view())
+
+    def _index_rule(self, rule_id):
+        self._search_text[rule_id] = [value.lower() for value in self.rules[rule_id]]
+
+    def add(self, values: Sequence) -> int:
+        rule_id = self.next_id
+        self.next_id += 1
+        self.rules[rule_id] = rule_text(values)
+        self.order.append(rule_id)
+        self._index_rule(rule_id)
+        if self._view is not None and self.matches(rule_id):
+            self._view.append(rule_id)
+        return rule_id
+
+    def update(self, rule_id: int, values: Sequence):
+        self.rules[rule_id] = rule_text(values)
+        self._index_rule(rule_id)
+        # The rule stays in the view while it is being edited even if it no longer matches the filter
+
+    def delete(self, rule_id: int):
+        del self.rules[rule_id]
+        del self._search_text[rule_id]
+        self.order.remove(rule_id)
+        if self._view is not None and rule_id in self._view:
+            self._view.remove(rule_id)
+
+    def get(self, rule_id: int) -> List[str]:
+        return self.rules[rule_id]
+
+    def all_rules(self) -> List[List[str]]:
+        """Every rule in the order it was added, ignoring the filter."""
+        return [self.rules[rule_id] for rule_id in self.order]
+
+    def matches(self, rule_id: int) -> bool:
+        if not self.filter_text:
+            return True
+        text = self._search_text[rule_id]
+        if self.filter_field:
+            return self.filter_text in text[FIELDS.index(self.filter_field)]
+        return any(self.filter_text in value for value in text)
+
+    def set_filter(self, text: str, field: Optional[str] = None):
+        """Only show rules containing text, in field or any field, case insensitive."""
+        self.filter_text = text.strip().lower()
+        self.filter_field = field if field in FIELDS else None
+        self._view = None
+
+    def view(self) -> List[int]:
+        """Ids of the rules matching the filter, in order."""
+        if self._view is None:
+            if self.filter_text:
+                self._view = [rule_id for rule_id in self.order if self.matches(rule_id)]
+            else:
+                self._view = list(self.order)
+        return self._view
+
+    def window(self, start: int, count: int) -> List[int]:
+        return self.view()[start:start + count]
+
+    def position(self, rule_id: int) -> Optional[int]:
+        try:
+            return self.view().index(rule_id)
+        except ValueError:
+            return None
+
+    def find(self, text: str, start: int = 0) -> Optional[int]:
+        """
+        Position in the view of the next rule containing text at or after start,
+        wrapping round to the top, or None if no rule in the view contains it.
+        """
+        text = text.strip().lower()
+        view = self.view()
+        if not text or not view:
+            return None
+        for offset in range(len(view)):
+            position = (start + offset) % len(view)
+            if any(text in value for value in self._search_text[view[position]]):
+                return position
+        return None
@@ -0,0 +1,184 @@
+import tkinter as tk
+from tkinter import ttk
+from rule_store import FIELDS
+
+# A rule table for the GUI that only puts the rows on screen into the Treeview.
+# The rules are held in a rule_store.RuleStore and the scrollbar is driven from the
+# position in the store, so loading and scrolling cost the same for 100 or 100,000 rules.
+# Multi-line values are shown on one line, the full values are kept in the store.
+
+# Longest text shown in a cell
+MAX_CELL_LENGTH = 200
+
+# Rows scrolled per mouse wheel notch
+WHEEL_ROWS = 3
+
+
+def display_value(value):
+    value = value.replace('\n', ', ')
+    if len(value) > MAX_CELL_LENGTH:
+        value = value[:MAX_CELL_LENGTH] + '...'
+    return value
+
+
+class VirtualRuleTable:
+    def __init__(self, parent, store):
+        self.store = store
+        self.top = 0
+        self.page_size = 20
+        self.selected = None
+
+        self.frame = tk.Frame(parent)
+
+        self.tree = ttk.Treeview(self.frame, columns=FIELDS, show="headings", selectmode="browse")
+        self.tree.heading("Source IPs", text="Source IPs")
+        self.tree.column("Source IPs", width=0, stretch=tk.NO)
+        self.tree.heading("Destination IPs", text="Destination IPs")
+        self.tree.column("Destination IPs", width=0, stretch=tk.NO)
+        self.tree.heading("Services", text="Services")
+        self.tree.column("Services", width=0, stretch=tk.NO)
+        self.tree.heading("Comments", text="Comments")
+        self.tree.column("Comments", width=200)
+
+        # The scrollbar scrolls through the store rather than the rows in the Treeview
+        self.vsb = ttk.Scrollbar(self.frame, orient="vertical", command=self.yview)
+
+        self.tree.grid(column=0, row=0, sticky='nsew')
+        self.vsb.grid(column=1, row=0, sticky='ns')
+        self.frame.grid_columnconfigure(0, weight=1)
+        self.frame.grid_rowconfigure(0, weight=1)
+
+        self.tree.bind("<Configure>", lambda event: self.measure_page())
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<MouseWheel>", self.on_mousewheel)
+        self.tree.bind("<Button-4>", lambda event: self.scroll(-WHEEL_ROWS))
+        self.tree.bind("<Button-5>", lambda event: self.scroll(WHEEL_ROWS))
+        self.tree.bind("<Up>", lambda event: self.move_selection(-1))
+        self.tree.bind("<Down>", lambda event: self.move_selection(1))
+        self.tree.bind("<Prior>", lambda event: self.move_selection(-self.page_size))
+        self.tree.bind("<Next>", lambda event: self.move_selection(self.page_size))
+
+        self.refresh()
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def measure_page(self):
+        """Work out how many rows fit in the Treeview from the position of the first row."""
+        children = self.tree.get_children()
+        bbox = self.tree.bbox(children[0]) if children else None
+        if not bbox:
+            return
+        _, header_height, _, row_height = bbox
+        page_size = max(1, (self.tree.winfo_height() - header_height) // max(1, row_height))
+        if page_size != self.page_size:
+            self.page_size = page_size
+            self.refresh()
+
+    def refresh(self):
+        """Show the rows of the store from self.top that fit in the Treeview."""
+        total = len(self.store)
+        self.top = max(0, min(self.top, total - self.page_size))
+
+        self.tree.delete(*self.tree.get_children())
+        for rule_id in self.store.window(self.top, self.page_size):
+            self.tree.insert("", "end", iid=str(rule_id),
+                             values=[display_value(value) for value in self.store.get(rule_id)])
+
+        if self.selected is not None and self.tree.exists(str(self.selected)):
+            self.tree.selection_set(str(self.selected))
+            self.tree.focus(str(self.selected))
+
+        if total:
+            self.vsb.set(self.top / total, min(1.0, (self.top + self.page_size) / total))
+        else:
+            self.vsb.set(0.0, 1.0)
+
+    def yview(self, *args):
+        total = len(self.store)
+        if args[0] == "moveto":
+            self.top = int(float(args[1]) * total)
+        elif args[0] == "scroll":
+            amount = int(args[1])
+            self.top += amount * self.page_size if args[2] == "pages" else amount
+        self.refresh()
+
+    def scroll(self, rows):
+        self.top += rows
+        self.refresh()
+        return "break"
+
+    def on_mousewheel(self, event):
+        return self.scroll(-WHEEL_ROWS if event.delta > 0 else WHEEL_ROWS)
+
+    def on_select(self, event):
+        # Rows scrolled out of the window drop out of the Treeview selection, so the
+        # selected rule is only replaced when another row is picked
+        selection = self.tree.selection()
+        if selection:
+            self.selected = int(selection[0])
+
+    def see(self, position):
+        if position < self.top:
+            self.top = position
+        elif position >= self.top + self.page_size:
+            self.top = position - self.page_size + 1
+
+    def select_position(self, position):
+        view = self.store.view()
+        if not view:
+            return
+        position = max(0, min(position, len(view) - 1))
+        self.selected = view[position]
+        self.see(position)
+        self.refresh()
+
+    def move_selection(self, rows):
+        position = self.store.position(self.selected) if self.selected is not None else None
+        self.select_position(self.top if position is None else position + rows)
+        return "break"
+
+    def selected_rule(self):
+        """Id of the selected rule, or None."""
+        if self.selected is not None and self.selected in self.store.rules:
+            return self.selected
+        return None
+
+    def clear_selection(self):
+        self.selected = None
+        self.tree.selection_set(())
+
+    def set_filter(self, text, field=None):
+        self.store.set_filter(text, field)
+        self.top = 0
+        position = self.store.position(self.selected) if self.selected is not None else None
+        if position is not None:
+            self.see(position)
+        self.refresh()
+
+    def find_next(self, text):
+        """Select the next rule after the selected one containing text. Returns False if there is none."""
+        position = self.store.position(self.selected) if self.selected is not None else None
+        found = self.store.find(text, 0 if position is None else position + 1)
+        if found is None:
+            return False
+        self.select_position(found)
+        return True
+
+    def add(self, values):
+        rule_id = self.store.add(values)
+        position = self.store.position(rule_id)
+        if position is not None:
+            self.see(position)
+        self.refresh()
+        return rule_id
+
+    def update(self, rule_id, values):
+        self.store.update(rule_id, values)
+        self.refresh()
+
+    def delete(self, rule_id):
+        self.store.delete(rule_id)
+        if self.selected == rule_id:
+            self.selected = None
+        self.refresh()
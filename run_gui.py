@@ -1,12 +1,15 @@
 import os
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox, Text, filedialog, simpledialog
 import json
-import generate_xls_diagrams
+# The processing modules pull in networkx, openpyxl and the diagram libraries,
+# they are imported when first used so the window opens straight away
 from configmanager import ConfigManager
 import configparser
-import openpyxl
-import find_rules_excel
+import rule_store
+import rule_table
 
 # Global variable for config file
 CONFIG_FILE = 'config.ini'
@@ -20,6 +23,7 @@ class NetworkInfoGUI:
 
         self.stored_file_path = tk.StringVar()
         self.stored_diagram_dir_path = tk.StringVar()
+        self.watch_stop_event = None
 
         self.topology = ConfigManager(CONFIG_FILE)
         self.customers = self.topology.get_customers()
@@ -32,28 +36,13 @@ class NetworkInfoGUI:
         self.create_initial_form()
 
     def read_excel_data(self, file_path, customer, sheet_name, start_row, source_ips, dest_ips, services, comments):
-        workbook = openpyxl.load_workbook(file_path)
+        import read_rules_excel
 
-        if sheet_name and sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-        else:
-            sheet = workbook.active
-
-        data = {customer: []}
-
-        for row in sheet.iter_rows(min_row=start_row, values_only=True):
-            if all(cell is None or cell == "" for cell in row):
-                break
-
-            row_data = [
-                row[ord(source_ips.upper()) - 65],
-                row[ord(dest_ips.upper()) - 65],
-                row[ord(services.upper()) - 65],
-                row[ord(comments.upper()) - 65]
-            ]
-            data[customer].append(row_data)
-
-        return data
+        # The rules are streamed from the sheet straight into the manual form's store,
+        # submit_results puts them in self.results from there
+        rules = read_rules_excel.iter_excel_rules(file_path, sheet_name, start_row, source_ips, dest_ips, services,
+                                                  comments)
+        return rule_store.RuleStore(rules)
 
     def read_excel_auto_form(self):
         excel_window = tk.Toplevel(self.master)
@@ -74,6 +63,7 @@ class NetworkInfoGUI:
             if not file_path:
                 return
 
+            import find_rules_excel
             sheets_rule_spec = find_rules_excel.analyze_excel_workbook(file_path)
             if not sheets_rule_spec:
                 messagebox.showerror("Error", "No valid sheets found.")
@@ -92,11 +82,12 @@ class NetworkInfoGUI:
             comments = rule_spec['comments']
 
             try:
-                self.results = self.read_excel_data(file_path, customer, sheet_name, int(start_row), source_ips,
-                                                    dest_ips, services, comments)
+                store = self.read_excel_data(file_path, customer, sheet_name, int(start_row), source_ips,
+                                             dest_ips, services, comments)
+                self.results = {customer: []}
                 messagebox.showinfo("Success", "Data processed successfully!")
                 excel_window.destroy()
-                self.load_excel_to_manual_form()  # Load the manual form instead of processing directly
+                self.load_excel_to_manual_form(store)  # Load the manual form instead of processing directly
             except Exception as e:
                 messagebox.showerror("Error", f"An error occurred: {str(e)}")
 
@@ -158,9 +149,10 @@ class NetworkInfoGUI:
             comments = comments_entry.get()
 
             try:
-                self.results = self.read_excel_data(file_path, customer, sheet_name, start_row, source_ips, dest_ips, services, comments)
+                store = self.read_excel_data(file_path, customer, sheet_name, start_row, source_ips, dest_ips, services, comments)
+                self.results = {customer: []}
                 messagebox.showinfo("Success", "Data processed successfully!")
-                self.load_excel_to_manual_form()
+                self.load_excel_to_manual_form(store)
             except Exception as e:
                 messagebox.showerror("Error", f"An error occurred: {str(e)}")
 
@@ -229,8 +221,31 @@ class NetworkInfoGUI:
             return
 
         from diagram_renderer import render_diagrams_in_directory
-        render_diagrams_in_directory(self.stored_diagram_dir_path.get())
-        messagebox.showinfo("Rendering Complete", "Diagrams have been rendered successfully.")
+        rendered = render_diagrams_in_directory(self.stored_diagram_dir_path.get())
+        if rendered:
+            messagebox.showinfo("Rendering Complete", f"{len(rendered)} changed diagram(s) have been rendered.")
+        else:
+            messagebox.showinfo("Rendering Complete", "All diagrams are already up to date.")
+
+    def toggle_watch_diagrams(self):
+        # Stop a running watch
+        if self.watch_stop_event:
+            self.watch_stop_event.set()
+            self.watch_stop_event = None
+            self.watch_button.config(text="Watch Directory")
+            return
+
+        if not self.stored_diagram_dir_path.get():
+            messagebox.showwarning("Warning", "Please select a directory.")
+            return
+
+        # Re-render each diagram source in the background as soon as it is saved
+        from diagram_renderer import watch_directory
+        self.watch_stop_event = threading.Event()
+        threading.Thread(target=watch_directory,
+                         args=(self.stored_diagram_dir_path.get(), self.watch_stop_event),
+                         daemon=True).start()
+        self.watch_button.config(text="Stop Watching")
 
     def create_initial_form(self):
         self.master.geometry("600x400")
@@ -286,7 +301,12 @@ class NetworkInfoGUI:
         self.browse_dir_button.grid(row=0, column=1, padx=5, pady=5)
 
         self.render_button = tk.Button(diagram_frame, text="Render Diagrams", command=self.render_diagrams)
-        self.render_button.grid(row=1, column=0, columnspan=2, pady=5)
+        self.render_button.grid(row=1, column=0, pady=5)
+
+        self.watch_button = tk.Button(diagram_frame,
+                                      text="Stop Watching" if self.watch_stop_event else "Watch Directory",
+                                      command=self.toggle_watch_diagrams)
+        self.watch_button.grid(row=1, column=1, pady=5)
 
         # Additional Buttons
         button_frame = tk.Frame(self.master)
@@ -300,11 +320,11 @@ class NetworkInfoGUI:
                                             command=self.edit_config_file)
         self.edit_config_button.pack(side=tk.LEFT, padx=5)
 
-    def create_manual_input_form(self):
+    def create_manual_input_form(self, store=None):
         #  Reset self.results to an empty dictionary
         # self.results = {}
 
-        self.master.geometry("700x600")
+        self.master.geometry("700x750")
 
         self.manual_input_frame = ttk.Frame(self.master)
         self.manual_input_frame.pack(padx=10, pady=10, fill="both", expand=True)
@@ -360,34 +380,41 @@ class NetworkInfoGUI:
         self.submit_button = ttk.Button(button_frame, text="Submit", command=self.submit_results)
         self.submit_button.pack(side=tk.RIGHT, padx=5)
 
-        # Assuming this is part of a class, and self.manual_input_frame already exists
-        # Create a frame to hold the Treeview and scrollbar
-        tree_frame = tk.Frame(self.manual_input_frame)
-        tree_frame.pack(padx=10, pady=10, fill="both", expand=True)
-
-        # Create the Treeview widget
-        self.tree = ttk.Treeview(tree_frame,
-                                 columns=("Source IPs", "Destination IPs", "Services", "Comments"), show="headings")
-        self.tree.heading("Source IPs", text="Source IPs")
-        self.tree.column("Source IPs", width=0, stretch=tk.NO)
-        self.tree.heading("Destination IPs", text="Destination IPs")
-        self.tree.column("Destination IPs", width=0, stretch=tk.NO)
-        self.tree.heading("Services", text="Services")
-        self.tree.column("Services", width=0, stretch=tk.NO)
-        self.tree.heading("Comments", text="Comments")
-        self.tree.column("Comments", width=200)
-
-        # Create vertical scrollbar
-        vsb = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=vsb.set)
-
-        # Grid layout for Treeview and scrollbar
-        self.tree.grid(column=0, row=0, sticky='nsew')
-        vsb.grid(column=1, row=0, sticky='ns')
-
-        # Configure the tree_frame grid
-        tree_frame.grid_columnconfigure(0, weight=1)
-        tree_frame.grid_rowconfigure(0, weight=1)
+        # Preview of the firewalls and paths for the rule being edited
+        preview_frame = ttk.LabelFrame(self.manual_input_frame, text="Preview")
+        preview_frame.pack(padx=10, fill="x")
+        self.preview_text = Text(preview_frame, height=6, width=40, state="disabled", wrap="none")
+        self.preview_text.pack(fill="x", padx=5, pady=5)
+        for text in self.input_fields.values():
+            text.bind("<KeyRelease>", lambda event: self.schedule_preview(), add="+")
+        self.preview_job = None
+        self.load_rule_preview()
+
+        # Filter and search the rules
+        filter_frame = ttk.Frame(self.manual_input_frame)
+        filter_frame.pack(fill="x", padx=10)
+        ttk.Label(filter_frame, text="Filter:").pack(side=tk.LEFT, padx=5)
+        self.filter_var = tk.StringVar()
+        filter_entry = ttk.Entry(filter_frame, textvariable=self.filter_var, width=25)
+        filter_entry.pack(side=tk.LEFT, padx=5)
+        self.filter_field_var = tk.StringVar(value="All")
+        filter_field = ttk.Combobox(filter_frame, textvariable=self.filter_field_var,
+                                    values=("All",) + rule_store.FIELDS, state="readonly", width=15)
+        filter_field.pack(side=tk.LEFT, padx=5)
+        ttk.Button(filter_frame, text="Find Next", command=self.find_next_rule).pack(side=tk.LEFT, padx=5)
+        self.filter_var.trace_add("write", lambda *args: self.schedule_filter())
+        filter_field.bind("<<ComboboxSelected>>", lambda event: self.apply_filter())
+        filter_entry.bind("<Return>", lambda event: self.find_next_rule())
+        self.filter_job = None
+
+        # Only the rows on screen are put in the Treeview, the rules are kept in the store
+        if store is None:
+            data = self.results.get(self.selected_customer.get(), []) if self.results else []
+            store = rule_store.RuleStore(data)
+        self.rule_store = store
+        self.rule_table = rule_table.VirtualRuleTable(self.manual_input_frame, self.rule_store)
+        self.rule_table.pack(padx=10, pady=10, fill="both", expand=True)
+        self.tree = self.rule_table.tree
 
         # Bind double-click event
         self.tree.bind("<Double-1>", self.on_tree_double_click)
@@ -395,12 +422,6 @@ class NetworkInfoGUI:
         # Set tab order
         self.bind_tab_navigation()
 
-        # Load data into Treeview if provided
-        if self.results:
-            data = self.results.get(self.selected_customer.get(), [])
-            for entry in data:
-                self.tree.insert("", "end", values=entry)
-
         # Set focus to the first field
         if first_field:
             self.master.after(100, lambda: first_field.focus_set())
@@ -456,7 +477,7 @@ class NetworkInfoGUI:
             messagebox.showerror("Error",
                                  "Could not read the file. Please check if the file exists and you have permission to read it.")
 
-    def load_excel_to_manual_form(self):
+    def load_excel_to_manual_form(self, store=None):
         # Extract the customer key from the JSON data
         customer_key = list(self.results.keys())[0]
         self.selected_customer.set(customer_key)
@@ -466,12 +487,96 @@ class NetworkInfoGUI:
             widget.destroy()
 
         # Create and show manual input form
-        self.create_manual_input_form()
+        self.create_manual_input_form(store)
 
     def process_results(self):
         config_mgr = ConfigManager(CONFIG_FILE)
-        user_msg = generate_xls_diagrams.generate_output(self.results, config_mgr)
+        progress_queue = queue.Queue()
+        cancel_event = threading.Event()
 
+        # Run the processing on a worker thread so the window stays responsive,
+        # the worker only talks to the GUI through the queue
+        def worker():
+            # A failed import is reported like any other error rather than leaving the progress window waiting
+            try:
+                import generate_xls_diagrams
+            except Exception as e:
+                progress_queue.put(('error', f"Could not load the processing modules: {str(e)}"))
+                return
+            try:
+                user_msg = generate_xls_diagrams.generate_output(
+                    self.results, config_mgr,
+                    progress=lambda stage, done, total: progress_queue.put(('progress', (stage, done, total))),
+                    cancel_event=cancel_event)
+                progress_queue.put(('done', user_msg))
+            except generate_xls_diagrams.ProcessingCancelled:
+                progress_queue.put(('cancelled', None))
+            except Exception as e:
+                progress_queue.put(('error', str(e)))
+
+        self.submit_button.config(state="disabled")
+        self.show_progress_window(progress_queue, cancel_event, config_mgr)
+        threading.Thread(target=worker, daemon=True).start()
+
+    def show_progress_window(self, progress_queue, cancel_event, config_mgr):
+        progress_window = tk.Toplevel(self.master)
+        progress_window.title("Processing")
+        progress_window.geometry("400x150")
+        progress_window.transient(self.master)
+
+        stage_names = {'rules': "Processing rules", 'diagrams': "Rendering diagrams",
+                       'exports': "Writing exports", 'workbook': "Saving workbook"}
+        status_var = tk.StringVar(value="Starting...")
+        tk.Label(progress_window, textvariable=status_var).pack(pady=10)
+        progress_bar = ttk.Progressbar(progress_window, length=350, mode="determinate")
+        progress_bar.pack(pady=5)
+
+        def cancel():
+            cancel_event.set()
+            status_var.set("Cancelling after the current step...")
+            cancel_button.config(state="disabled")
+
+        cancel_button = tk.Button(progress_window, text="Cancel", command=cancel)
+        cancel_button.pack(pady=10)
+        progress_window.protocol("WM_DELETE_WINDOW", cancel)
+
+        def finish():
+            progress_window.destroy()
+            if self.submit_button.winfo_exists():
+                self.submit_button.config(state="normal")
+
+        def poll():
+            try:
+                while True:
+                    kind, payload = progress_queue.get_nowait()
+                    if kind == 'progress':
+                        stage, done, total = payload
+                        if not cancel_event.is_set():
+                            status_var.set(f"{stage_names.get(stage, stage)}: {done}" + (f" of {total}" if total else ""))
+                        if total:
+                            progress_bar.config(mode="determinate", maximum=total, value=done)
+                        else:
+                            progress_bar.config(mode="indeterminate")
+                            progress_bar.step()
+                    elif kind == 'done':
+                        finish()
+                        self.show_results(payload, config_mgr)
+                        return
+                    elif kind == 'cancelled':
+                        finish()
+                        messagebox.showinfo("Cancelled", "Processing was cancelled.")
+                        return
+                    else:
+                        finish()
+                        messagebox.showerror("Error", f"An error occurred: {payload}")
+                        return
+            except queue.Empty:
+                pass
+            progress_window.after(100, poll)
+
+        progress_window.after(100, poll)
+
+    def show_results(self, user_msg, config_mgr):
         if not user_msg:
             user_msg = "No IPs unmatched to a topology."
 
@@ -509,8 +614,7 @@ class NetworkInfoGUI:
         result_window.focus_set()
 
     def submit_results(self):
-        self.results[self.selected_customer.get()] = [self.tree.item(item)["values"] for item in
-                                                      self.tree.get_children()]
+        self.results[self.selected_customer.get()] = self.rule_store.all_rules()
         self.process_results()
 
     def start_manual_input(self):
@@ -534,38 +638,120 @@ class NetworkInfoGUI:
 
     def add_entry(self):
         entry = {field: self.input_fields[field].get("1.0", tk.END).strip() for field in self.input_fields}
-        self.tree.insert("", "end", values=(entry["Source IPs"], entry["Destination IPs"], entry["Services"], entry["Comments"].replace('\n', '; ')))
+        self.rule_table.add((entry["Source IPs"], entry["Destination IPs"], entry["Services"], entry["Comments"].replace('\n', '; ')))
         self.clear_input_fields()
 
     def update_entry(self):
-        selected_item = self.tree.selection()
-        if not selected_item:
+        rule_id = self.rule_table.selected_rule()
+        if rule_id is None:
             messagebox.showwarning("Warning", "Please select an entry to update.")
             return
 
         entry = {field: self.input_fields[field].get("1.0", tk.END).strip() for field in self.input_fields}
-        self.tree.item(selected_item, values=(entry["Source IPs"], entry["Destination IPs"], entry["Services"], entry["Comments"].replace('\n', '; ')))
+        self.rule_table.update(rule_id, (entry["Source IPs"], entry["Destination IPs"], entry["Services"], entry["Comments"].replace('\n', '; ')))
         self.clear_input_fields()
 
     def delete_entry(self):
-        selected_item = self.tree.selection()
-        if not selected_item:
+        rule_id = self.rule_table.selected_rule()
+        if rule_id is None:
             messagebox.showwarning("Warning", "Please select an entry to delete.")
             return
-        self.tree.delete(selected_item)
+        self.rule_table.delete(rule_id)
 
     def on_tree_double_click(self, event):
-        item = self.tree.selection()[0]
-        values = self.tree.item(item, "values")
+        rule_id = self.rule_table.selected_rule()
+        if rule_id is None:
+            return
+        values = self.rule_store.get(rule_id)
         for field, value in zip(self.input_fields.keys(), values):
             self.input_fields[field].delete("1.0", tk.END)
             if field == "Comments":
                 value = value.replace('; ', '\n')
             self.input_fields[field].insert("1.0", value)
+        self.schedule_preview()
+
+    def load_rule_preview(self):
+        # The topologies are loaded once on a worker thread and kept for every preview of this customer
+        self.rule_preview = None
+        self.set_preview_text("Loading topologies...")
+        result_queue = queue.Queue()
+        customer = self.selected_customer.get()
+
+        def worker():
+            try:
+                import rule_preview
+                result_queue.put(rule_preview.RulePreview(ConfigManager(CONFIG_FILE), customer))
+            except Exception as e:
+                result_queue.put(e)
+
+        def poll():
+            if not self.preview_text.winfo_exists():
+                return
+            try:
+                result = result_queue.get_nowait()
+            except queue.Empty:
+                self.master.after(100, poll)
+                return
+            if isinstance(result, Exception):
+                self.set_preview_text(f"Could not load the topologies: {str(result)}")
+            else:
+                self.rule_preview = result
+                self.update_preview()
+
+        threading.Thread(target=worker, daemon=True).start()
+        self.master.after(100, poll)
+
+    def set_preview_text(self, text):
+        self.preview_text.config(state="normal")
+        self.preview_text.delete("1.0", tk.END)
+        self.preview_text.insert("1.0", text)
+        self.preview_text.config(state="disabled")
+
+    def schedule_preview(self):
+        # Resolve the rule once typing pauses rather than on every key
+        if self.preview_job:
+            self.master.after_cancel(self.preview_job)
+        self.preview_job = self.master.after(150, self.update_preview)
+
+    def update_preview(self):
+        import rule_preview
+
+        self.preview_job = None
+        if self.rule_preview is None or not self.preview_text.winfo_exists():
+            return
+        entry = {field: self.input_fields[field].get("1.0", tk.END).strip() for field in self.input_fields}
+        if not entry["Source IPs"] or not entry["Destination IPs"]:
+            self.set_preview_text("Enter source and destination IPs to preview the rule.")
+            return
+        rule = (entry["Source IPs"], entry["Destination IPs"], entry["Services"], entry["Comments"].replace('\n', '; '))
+        try:
+            self.set_preview_text(rule_preview.format_preview(self.rule_preview.resolve(rule)))
+        except Exception as e:
+            self.set_preview_text(f"Error: {str(e)}")
+
+    def schedule_filter(self):
+        # Filter once typing pauses rather than on every key
+        if self.filter_job:
+            self.master.after_cancel(self.filter_job)
+        self.filter_job = self.master.after(200, self.apply_filter)
+
+    def apply_filter(self):
+        self.filter_job = None
+        if not self.tree.winfo_exists():
+            return
+        field = self.filter_field_var.get()
+        self.rule_table.set_filter(self.filter_var.get(), None if field == "All" else field)
+
+    def find_next_rule(self):
+        if not self.filter_var.get().strip():
+            return
+        if not self.rule_table.find_next(self.filter_var.get()):
+            messagebox.showinfo("Find", "No matching entries.")
 
     def clear_input_fields(self):
         for text in self.input_fields.values():
             text.delete("1.0", tk.END)
+        self.schedule_preview()
 
     def edit_excel_form(self, section, config_file):
         config = configparser.ConfigParser()
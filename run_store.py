@@ -0,0 +1,277 @@
+import argparse
+import ipaddress
+import sqlite3
+from datetime import datetime
+
+# A SQLite store of every processed rule, its rows (one per topology and install on gateway), its
+# expanded flows and the nodes on each flow's path, kept across runs so they can be queried later
+# without running the pipeline again. Enabled with the run_store Excel option, the store is
+# run_store.sqlite in the customer's output directory.
+#
+# IPs are stored as the first and last address of their network as integers, so the flows touching
+# a network are found on the indexed columns, with a range for the networks inside it and exact
+# lookups for the networks containing it.
+#
+# Query with: python run_store.py STORE runs | through FW3 | touching 10.1.1.0/24 | changes RUN [--to RUN]
+
+STORE_FILE = "run_store.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    customer TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    file_prefix TEXT,
+    json_dump TEXT,
+    rule_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_customer ON runs (customer, id);
+
+CREATE TABLE IF NOT EXISTS rules (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    rule_number INTEGER NOT NULL,
+    src TEXT,
+    dst TEXT,
+    services TEXT,
+    comment TEXT
+);
+CREATE INDEX IF NOT EXISTS rules_run ON rules (run_id, rule_number);
+
+CREATE TABLE IF NOT EXISTS rule_rows (
+    id INTEGER PRIMARY KEY,
+    rule_id INTEGER NOT NULL REFERENCES rules (id),
+    new_rule_id TEXT,
+    topology TEXT,
+    install_on TEXT,
+    src TEXT,
+    dst TEXT,
+    paths TEXT
+);
+CREATE INDEX IF NOT EXISTS rule_rows_rule ON rule_rows (rule_id);
+CREATE INDEX IF NOT EXISTS rule_rows_install_on ON rule_rows (install_on);
+
+CREATE TABLE IF NOT EXISTS flows (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    rule_id INTEGER NOT NULL REFERENCES rules (id),
+    topology TEXT,
+    src_ip TEXT,
+    dst_ip TEXT,
+    src_first INTEGER,
+    src_last INTEGER,
+    dst_first INTEGER,
+    dst_last INTEGER,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS flows_run ON flows (run_id);
+CREATE INDEX IF NOT EXISTS flows_rule ON flows (rule_id);
+CREATE INDEX IF NOT EXISTS flows_src ON flows (src_first, src_last);
+CREATE INDEX IF NOT EXISTS flows_dst ON flows (dst_first, dst_last);
+
+CREATE TABLE IF NOT EXISTS flow_nodes (
+    flow_id INTEGER NOT NULL REFERENCES flows (id),
+    node TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    install_on INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flow_nodes_node ON flow_nodes (node, flow_id);
+CREATE INDEX IF NOT EXISTS flow_nodes_flow ON flow_nodes (flow_id);
+"""
+
+
+def network_range(ip):
+    """First and last address of an IP's network as integers."""
+    network = ip.network if hasattr(ip, 'network') else ipaddress.ip_network(ip, strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
+class RunStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def start_run(self, customer, json_dump=None, file_prefix=None):
+        """Add a run, it is only saved once finish_run is called so a failed run leaves nothing behind."""
+        cursor = self.connection.execute(
+            "INSERT INTO runs (customer, started_at, file_prefix, json_dump) VALUES (?, ?, ?, ?)",
+            (customer, datetime.now().isoformat(timespec='seconds'), file_prefix, json_dump))
+        return cursor.lastrowid
+
+    def add_rule(self, run_id, rule_number, rule, rows, flows, node_types):
+        """
+        Add a rule [source, destination, services, comments] with its output rows from resolve_rule
+        and its flows [((src_ip, dst_ip), topology, path)]. node_types is {topology: {node: type}}
+        and marks the nodes of each path the rule is installed on.
+        """
+        src, dst, services, comment = rule
+        rule_id = self.connection.execute(
+            "INSERT INTO rules (run_id, rule_number, src, dst, services, comment) VALUES (?, ?, ?, ?, ?, ?)",
+            (run_id, rule_number, src, dst, services, comment)).lastrowid
+
+        self.connection.executemany(
+            "INSERT INTO rule_rows (rule_id, new_rule_id, topology, install_on, src, dst, paths) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(rule_id, new_rule_id, new_rule_id.split(':')[1], install_on, row_src, row_dst, paths)
+             for row_src, row_dst, _, _, new_rule_id, paths, install_on in rows])
+
+        for (src_ip, dst_ip), topology, path in flows:
+            flow_id = self.connection.execute(
+                "INSERT INTO flows (run_id, rule_id, topology, src_ip, dst_ip, src_first, src_last, "
+                "dst_first, dst_last, path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, rule_id, topology, str(src_ip), str(dst_ip), *network_range(src_ip),
+                 *network_range(dst_ip), ' --> '.join(path))).lastrowid
+            types = node_types.get(topology, {})
+            self.connection.executemany(
+                "INSERT INTO flow_nodes (flow_id, node, position, install_on) VALUES (?, ?, ?, ?)",
+                [(flow_id, node, position, types.get(node, 'firewall') == 'firewall')
+                 for position, node in enumerate(path)])
+        return rule_id
+
+    def finish_run(self, run_id, rule_count):
+        self.connection.execute("UPDATE runs SET finished_at = ?, rule_count = ? WHERE id = ?",
+                                (datetime.now().isoformat(timespec='seconds'), rule_count, run_id))
+        self.connection.commit()
+
+    def runs(self, customer=None):
+        query = "SELECT * FROM runs"
+        params = ()
+        if customer:
+            query += " WHERE customer = ?"
+            params = (customer,)
+        return self.connection.execute(query + " ORDER BY id", params).fetchall()
+
+    def latest_run(self, customer):
+        row = self.connection.execute("SELECT id FROM runs WHERE customer = ? ORDER BY id DESC LIMIT 1",
+                                      (customer,)).fetchone()
+        return row['id'] if row else None
+
+    def previous_runs(self, customer, run_id, count):
+        """The ids of up to count runs of a customer before run_id, oldest first."""
+        rows = self.connection.execute("SELECT id FROM runs WHERE customer = ? AND id < ? AND finished_at IS NOT NULL "
+                                       "ORDER BY id DESC LIMIT ?", (customer, run_id, count)).fetchall()
+        return [row['id'] for row in reversed(rows)]
+
+    def install_on_flows(self, run_ids):
+        """The flows of some runs once for each gateway they are installed on, with their rule's services."""
+        placeholders = ', '.join('?' * len(run_ids))
+        return self.connection.execute(
+            f"SELECT flows.run_id, flows.topology, flows.src_first, flows.src_last, flows.dst_first, "
+            f"flows.dst_last, flow_nodes.node, rules.rule_number, rules.services, rules.comment FROM flows "
+            f"JOIN flow_nodes ON flow_nodes.flow_id = flows.id JOIN rules ON rules.id = flows.rule_id "
+            f"WHERE flows.run_id IN ({placeholders}) AND flow_nodes.install_on = 1", list(run_ids)).fetchall()
+
+    def flows_through(self, node, run_id=None, install_on_only=False):
+        """The flows whose path goes through a node, or only those installed on it."""
+        query = ("SELECT flows.*, rules.rule_number, rules.comment FROM flow_nodes "
+                 "JOIN flows ON flows.id = flow_nodes.flow_id JOIN rules ON rules.id = flows.rule_id "
+                 "WHERE flow_nodes.node = ?")
+        params = [node]
+        if install_on_only:
+            query += " AND flow_nodes.install_on = 1"
+        if run_id is not None:
+            query += " AND flows.run_id = ?"
+            params.append(run_id)
+        return self.connection.execute(query + " ORDER BY flows.id", params).fetchall()
+
+    def rules_touching(self, network, run_id=None):
+        """
+        The rules with a flow whose source or destination overlaps a network, e.g. '10.1.1.0/24'.
+        The stored networks are CIDR networks, so a network overlapping this one either starts inside
+        it, a range of the index, or is one of the networks containing it, an exact lookup of each.
+        """
+        network = ipaddress.ip_network(network, strict=False)
+        first, last = network_range(network)
+        containing = [network_range(network.supernet(new_prefix=prefixlen))
+                      for prefixlen in range(network.prefixlen)]
+        run_filter = " AND run_id = ?" if run_id is not None else ""
+        run_params = [run_id] if run_id is not None else []
+
+        selects = []
+        params = []
+        for column in ('src', 'dst'):
+            selects.append(f"SELECT rule_id FROM flows WHERE {column}_first BETWEEN ? AND ?{run_filter}")
+            params += [first, last] + run_params
+            if containing:
+                # An OR of the pairs rather than a row value IN, which SQLite answers with a scan
+                exact = ' OR '.join(f"({column}_first = ? AND {column}_last = ?)" for _ in containing)
+                selects.append(f"SELECT rule_id FROM flows WHERE ({exact}){run_filter}")
+                params += [value for bounds in containing for value in bounds] + run_params
+        query = (f"SELECT * FROM rules WHERE id IN ({' UNION '.join(selects)}) "
+                 f"ORDER BY run_id, rule_number")
+        return self.connection.execute(query, params).fetchall()
+
+    def run_flows(self, run_id):
+        return {(row['topology'], row['src_ip'], row['dst_ip'], row['path'])
+                for row in self.connection.execute("SELECT topology, src_ip, dst_ip, path FROM flows "
+                                                   "WHERE run_id = ?", (run_id,))}
+
+    def changes(self, since_run_id, to_run_id=None):
+        """
+        The flows added and removed between two runs, by default since_run_id and the latest
+        run of the same customer. Returns (added, removed), each a sorted list of
+        (topology, src_ip, dst_ip, path).
+        """
+        if to_run_id is None:
+            row = self.connection.execute("SELECT customer FROM runs WHERE id = ?", (since_run_id,)).fetchone()
+            if row is None:
+                raise ValueError(f"Run {since_run_id} not found")
+            to_run_id = self.latest_run(row['customer'])
+        old_flows = self.run_flows(since_run_id)
+        new_flows = self.run_flows(to_run_id)
+        return sorted(new_flows - old_flows), sorted(old_flows - new_flows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the store of processed rules and flows.")
+    parser.add_argument('store', help=f"The {STORE_FILE} file in the customer's output directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    runs_parser = commands.add_parser('runs', help="List the runs")
+    runs_parser.add_argument('--customer')
+
+    through_parser = commands.add_parser('through', help="Flows through a node")
+    through_parser.add_argument('node')
+    through_parser.add_argument('--run', type=int)
+    through_parser.add_argument('--install-on', action='store_true', help="Only flows installed on the node")
+
+    touching_parser = commands.add_parser('touching', help="Rules with a source or destination in a network")
+    touching_parser.add_argument('network')
+    touching_parser.add_argument('--run', type=int)
+
+    changes_parser = commands.add_parser('changes', help="Flows added and removed since a run")
+    changes_parser.add_argument('since', type=int)
+    changes_parser.add_argument('--to', type=int, help="Compare with this run rather than the latest")
+
+    args = parser.parse_args()
+    store = RunStore(args.store)
+    try:
+        if args.command == 'runs':
+            for run in store.runs(args.customer):
+                print(f"{run['id']}\t{run['customer']}\t{run['started_at']}\t{run['rule_count']} rules\t"
+                      f"{run['json_dump'] or ''}")
+        elif args.command == 'through':
+            for flow in store.flows_through(args.node, args.run, args.install_on):
+                print(f"run {flow['run_id']} rule {flow['rule_number']}\t{flow['topology']}\t"
+                      f"{flow['src_ip']} -> {flow['dst_ip']}\t{flow['path']}")
+        elif args.command == 'touching':
+            for rule in store.rules_touching(args.network, args.run):
+                print(f"run {rule['run_id']} rule {rule['rule_number']}\t{rule['comment']!r}\t"
+                      f"{rule['src']!r} -> {rule['dst']!r}")
+        elif args.command == 'changes':
+            added, removed = store.changes(args.since, args.to)
+            for sign, flows in (('+', added), ('-', removed)):
+                for topology, src_ip, dst_ip, path in flows:
+                    print(f"{sign} {topology}\t{src_ip} -> {dst_ip}\t{path}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
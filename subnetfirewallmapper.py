@@ -11,6 +11,7 @@ class SubnetFirewallMapper:
         self.yaml_file_path = yaml_file_path
         self.route_dump_path = route_dump_path
         self.subnet_firewall_map = self._create_subnet_firewall_map()
+        self._prefix_index = None
 
 
     def _load_yaml_data(self) -> Optional[Dict]:
@@ -63,18 +64,37 @@ class SubnetFirewallMapper:
 
         return subnet_firewall_map
 
-    def find_matching_firewall(self, ip_obj: Union[ipaddress.IPv4Interface, ipaddress.IPv4Network]) -> Optional[str]:
-        matches: List[Tuple[ipaddress.IPv4Network, str]] = []
+    def _build_prefix_index(self) -> List[Tuple[int, int, Dict[int, str]]]:
+        """
+        Index the subnets by IP version and prefix length, most specific first, as
+        (version, prefix length, {network address as an integer: firewall}).
+        """
+        tables: Dict[Tuple[int, int], Dict[int, str]] = {}
         for subnet, firewall in self.subnet_firewall_map.items():
-            if (ip_obj.network.subnet_of(subnet) or
-                    ip_obj.network.network_address == subnet.network_address):
-                matches.append((subnet, firewall))
-
-        if not matches:
-            return None
+            tables.setdefault((subnet.version, subnet.prefixlen), {})[int(subnet.network_address)] = firewall
+        return [(version, prefixlen, tables[(version, prefixlen)])
+                for version, prefixlen in sorted(tables, key=lambda key: key[1], reverse=True)]
 
-        # Sort matches by prefix length in descending order (most specific first)
-        matches.sort(key=lambda x: x[0].prefixlen, reverse=True)
-
-        # Return the firewall associated with the most specific match
-        return matches[0][1]
+    def find_matching_firewall(self, ip_obj: Union[ipaddress.IPv4Interface, ipaddress.IPv4Network]) -> Optional[str]:
+        """
+        Return the firewall of the most specific subnet that contains the IP's network, or that
+        has the same network address, or None. Each prefix length is a single dictionary lookup,
+        so the cost doesn't grow with the number of subnets and routes.
+        """
+        if self._prefix_index is None:
+            self._prefix_index = self._build_prefix_index()
+
+        network = ip_obj.network
+        address = int(network.network_address)
+        max_bits = network.max_prefixlen
+        for version, prefixlen, table in self._prefix_index:
+            if version != network.version:
+                continue
+            if prefixlen > network.prefixlen:
+                # A more specific subnet only matches if it starts at the same address
+                firewall = table.get(address)
+            else:
+                firewall = table.get(address >> (max_bits - prefixlen) << (max_bits - prefixlen))
+            if firewall is not None:
+                return firewall
+        return None
@@ -1,79 +1,284 @@
 import openpyxl
-from openpyxl.styles import Alignment
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font, NamedStyle
 from openpyxl.drawing.image import Image
-import shutil
+from openpyxl.utils import column_index_from_string, get_column_letter
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import os
+import re
 
+# One named style is registered per workbook and shared by every cell written,
+# rather than creating an Alignment for each cell
+WRAP_STYLE_NAME = "fw_form_wrap"
 
-def write_to_excel(data, headers, field_mapping, filename="output.xlsx",
-                   image_files=None, template=None):
-    #  Extract the sheet to output to
-    acl_sheet = headers.pop('acl_sheet', None)
-    output_headers = headers.pop('output_headers', 'no')
-    if output_headers.lower() == 'no':
-        output_headers = False
+
+def add_wrap_style(workbook):
+    if WRAP_STYLE_NAME not in workbook.named_styles:
+        workbook.add_named_style(NamedStyle(name=WRAP_STYLE_NAME, alignment=Alignment(wrap_text=True)))
+    return WRAP_STYLE_NAME
+
+
+def value_width(value):
+    """Length of the longest line of a cell value."""
+    if not value:
+        return 0
+    return max(len(line) for line in str(value).split('\n'))
+
+
+def column_width(max_length):
+    return (max_length + 2) * 1.2
+
+
+def add_diagram_images(workbook, image_files):
+    # Add images to a new sheet called "Diagrams"
+    if "Diagrams" not in workbook.sheetnames:
+        diagram_sheet = workbook.create_sheet("Diagrams")
     else:
-        output_headers = True
+        diagram_sheet = workbook["Diagrams"]
+    for i, image_file in enumerate(image_files, start=1):
+        img = Image(image_file)
+        diagram_sheet.add_image(img, f'A{i * 15}')
 
-    if template:
-        # Make a copy of the template
-        shutil.copy(template, filename)
-        workbook = openpyxl.load_workbook(filename)
-        sheet = workbook[acl_sheet] if acl_sheet else workbook.active
+    # Set zoom level for Diagrams sheet to 50%
+    diagram_sheet.sheet_view.zoomScale = 50
+
+
+def add_table_sheet(workbook, title, headers, rows):
+    """Add a sheet with a bold header row and wrapped rows, e.g. the rule overlap findings."""
+    style = add_wrap_style(workbook)
+    sheet = workbook.create_sheet(title)
+
+    # Column widths go ahead of the rows for write-only workbooks
+    for column, header in enumerate(headers, start=1):
+        max_length = max([value_width(header)] + [value_width(row[column - 1]) for row in rows])
+        sheet.column_dimensions[get_column_letter(column)].width = column_width(min(max_length, 80))
+
+    bold = Font(bold=True)
+    if workbook.write_only:
+        header_cells = []
+        for header in headers:
+            cell = WriteOnlyCell(sheet, value=header)
+            cell.font = bold
+            header_cells.append(cell)
+        sheet.append(header_cells)
     else:
-        # Create a new workbook if no template is provided
-        workbook = openpyxl.Workbook()
-        sheet = workbook.active
-        sheet.title = acl_sheet if acl_sheet else "ACL"
+        sheet.append(headers)
+        for cell in sheet[1]:
+            cell.font = bold
+
+    for row in rows:
+        if workbook.write_only:
+            cells = []
+            for value in row:
+                cell = WriteOnlyCell(sheet, value=value)
+                cell.style = style
+                cells.append(cell)
+            sheet.append(cells)
+        else:
+            sheet.append(list(row))
+            for cell in sheet[sheet.max_row]:
+                cell.style = style
+    return sheet
+
+
+def write_rows_streaming(data, headers, field_mapping, output_headers, start_row, sheet_title):
+    """
+    Write the rows to a new write-only workbook, streaming each row straight to the file.
+    Write-only sheets have their column widths written ahead of the rows, so the widths
+    are measured from the values first and the cells are created in a second pass.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    style = add_wrap_style(workbook)
+    sheet = workbook.create_sheet(sheet_title)
 
     # Set zoom level for the main sheet to 50%
     sheet.sheet_view.zoomScale = 50
 
-    # Extract start_row and remove it from headers
-    start_row = int(headers.pop('start_row', 2))
+    columns = {header: column_index_from_string(col_letter) for header, col_letter in headers.items()}
+    row_length = max(columns.values(), default=0)
+    output_fields = [(columns[header], field_index) for header, field_index in field_mapping.items()
+                     if header in columns]
+
+    # Auto-adjust column widths based on max length of values split by '\n'
+    max_lengths = {col_letter: value_width(header) if output_headers else 0
+                   for header, col_letter in headers.items()}
+    column_letters = {columns[header]: col_letter for header, col_letter in headers.items()}
+    for row_data in data:
+        for column, field_index in output_fields:
+            col_letter = column_letters[column]
+            max_lengths[col_letter] = max(max_lengths[col_letter], value_width(row_data[field_index]))
+    for col_letter, max_length in max_lengths.items():
+        sheet.column_dimensions[col_letter].width = column_width(max_length)
+
+    def styled_row(values):
+        row = [None] * row_length
+        for column, value in values:
+            cell = WriteOnlyCell(sheet, value=value)
+            cell.style = style
+            row[column - 1] = cell
+        return row
+
+    current_row = 1
+    if output_headers:
+        sheet.append(styled_row((columns[header], header) for header in headers))
+        current_row += 1
+
+    # Pad out to start_row as the rows can only be appended in order
+    for _ in range(current_row, start_row):
+        sheet.append([])
+
+    for row_data in data:
+        sheet.append(styled_row((column, row_data[field_index]) for column, field_index in output_fields))
+
+    return workbook
+
+
+def write_rows_template(data, headers, field_mapping, output_headers, start_row, workbook, sheet):
+    """Write the rows into a sheet of a template workbook, measuring the column widths as each cell is written."""
+    style = add_wrap_style(workbook)
+
+    # Set zoom level for the main sheet to 50%
+    sheet.sheet_view.zoomScale = 50
+
+    columns = {header: column_index_from_string(col_letter) for header, col_letter in headers.items()}
+    output_fields = [(columns[header], headers[header], field_index) for header, field_index in field_mapping.items()
+                     if header in columns]
+
+    # Start from whatever the template has above the rows being written in the output columns
+    max_lengths = {col_letter: 0 for col_letter in headers.values()}
+    first_template_row = 2 if output_headers else 1
+    if start_row > first_template_row:
+        for col_letter in max_lengths:
+            column = column_index_from_string(col_letter)
+            for (value,) in sheet.iter_rows(min_row=first_template_row, max_row=start_row - 1,
+                                            min_col=column, max_col=column, values_only=True):
+                max_lengths[col_letter] = max(max_lengths[col_letter], value_width(value))
 
     # Add headers if output_headers is True
     if output_headers:
         for header, col_letter in headers.items():
-            cell = sheet[f"{col_letter}1"]
-            cell.value = header
-            cell.alignment = Alignment(wrap_text=True)
-    else:
-        # If headers are not output, adjust start_row
-        start_row -= 1
+            cell = sheet.cell(row=1, column=columns[header], value=header)
+            cell.style = style
+            max_lengths[col_letter] = max(max_lengths[col_letter], value_width(header))
 
     # Write data to cells
     for row_index, row_data in enumerate(data, start=start_row):
-        for header, field_index in field_mapping.items():
-            if header in headers:
-                col_letter = headers[header]
-                cell = sheet[f"{col_letter}{row_index}"]
-                cell.value = row_data[field_index]
-                cell.alignment = Alignment(wrap_text=True)
+        for column, col_letter, field_index in output_fields:
+            value = row_data[field_index]
+            cell = sheet.cell(row=row_index, column=column, value=value)
+            cell.style = style
+            max_lengths[col_letter] = max(max_lengths[col_letter], value_width(value))
 
     # Auto-adjust column widths based on max length of values split by '\n'
-    for col_letter in headers.values():
-        max_length = 0
-        for cell in sheet[col_letter]:
-            if cell.value:
-                lines = str(cell.value).split('\n')
-                for line in lines:
-                    if len(line) > max_length:
-                        max_length = len(line)
-        adjusted_width = (max_length + 2) * 1.2
-        sheet.column_dimensions[col_letter].width = adjusted_width
+    for col_letter, max_length in max_lengths.items():
+        sheet.column_dimensions[col_letter].width = column_width(max_length)
+
+
+def write_to_excel(data, headers, field_mapping, filename="output.xlsx",
+                   image_files=None, template=None, template_data=None, table_sheets=None):
+    #  Extract the sheet to output to
+    acl_sheet = headers.pop('acl_sheet', None)
+    output_headers = headers.pop('output_headers', 'no')
+    if output_headers.lower() == 'no':
+        output_headers = False
+    else:
+        output_headers = True
+
+    # Extract start_row and remove it from headers
+    start_row = int(headers.pop('start_row', 2))
+
+    # If headers are not output, adjust start_row
+    if not output_headers:
+        start_row -= 1
+
+    if template or template_data:
+        # Load the template, from the bytes already read if given, and save it under the new filename
+        workbook = openpyxl.load_workbook(BytesIO(template_data) if template_data else template)
+        sheet = workbook[acl_sheet] if acl_sheet else workbook.active
+        write_rows_template(data, headers, field_mapping, output_headers, start_row, workbook, sheet)
+    else:
+        # Stream to a new workbook if no template is provided
+        workbook = write_rows_streaming(data, headers, field_mapping, output_headers, start_row,
+                                        acl_sheet if acl_sheet else "ACL")
 
-    # Add images to a new sheet called "Diagrams"
     if image_files:
-        if "Diagrams" not in workbook.sheetnames:
-            diagram_sheet = workbook.create_sheet("Diagrams")
-        else:
-            diagram_sheet = workbook["Diagrams"]
-        for i, image_file in enumerate(image_files, start=1):
-            img = Image(image_file)
-            diagram_sheet.add_image(img, f'A{i * 15}')
+        add_diagram_images(workbook, image_files)
 
-        # Set zoom level for Diagrams sheet to 50%
-        diagram_sheet.sheet_view.zoomScale = 50
+    # Further sheets, {title: (headers, rows)}
+    for title, (table_headers, table_rows) in (table_sheets or {}).items():
+        add_table_sheet(workbook, title, table_headers, table_rows)
 
     # Save the workbook
-    workbook.save(filename)
\ No newline at end of file
+    workbook.save(filename)
+
+
+def shard_filename(filename, shard):
+    base, ext = os.path.splitext(filename)
+    return f"{base}_{re.sub(r'[^A-Za-z0-9_.-]+', '_', str(shard))}{ext}"
+
+
+def _write_shard(args):
+    data, headers, field_mapping, filename, image_files, template_data = args
+    write_to_excel(data, headers, field_mapping, filename=filename,
+                   image_files=image_files, template_data=template_data)
+    return filename
+
+
+def write_index(shard_files, shard_by, filename, table_sheets=None):
+    """Write a workbook listing each shard with its rule count and a link to its workbook, and any table_sheets."""
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "Index"
+
+    sheet.append([shard_by.capitalize(), "Rules", "Workbook"])
+    for cell in sheet[1]:
+        cell.font = Font(bold=True)
+
+    link_font = Font(color="0563C1", underline="single")
+    for row_index, (shard, row_count, shard_file) in enumerate(shard_files, start=2):
+        sheet.cell(row=row_index, column=1, value=shard)
+        sheet.cell(row=row_index, column=2, value=row_count)
+        # Link relative to the index so the files can be moved together
+        link = sheet.cell(row=row_index, column=3, value=os.path.basename(shard_file))
+        link.hyperlink = os.path.basename(shard_file)
+        link.font = link_font
+
+    for col_letter, index in (('A', 0), ('C', 2)):
+        max_length = max([len(shard_by)] + [len(str(entry[index])) for entry in shard_files])
+        sheet.column_dimensions[col_letter].width = column_width(max_length)
+
+    for title, (table_headers, table_rows) in (table_sheets or {}).items():
+        add_table_sheet(workbook, title, table_headers, table_rows)
+
+    workbook.save(filename)
+
+
+def write_sharded_excel(shards, headers, field_mapping, shard_by, filename="output.xlsx",
+                        shard_images=None, template=None, max_workers=None, table_sheets=None):
+    """
+    Write each shard of rows to its own workbook next to filename, in parallel processes,
+    with an index workbook at filename linking to them. The template is read once and
+    each worker builds its workbook from those bytes.
+
+    shards is {shard: rows} from group_rules.shard_rows and shard_images {shard: image files}.
+    table_sheets, {title: (headers, rows)}, are added to the index workbook.
+    Returns the list of shard workbooks written.
+    """
+    template_data = None
+    if template:
+        with open(template, 'rb') as f:
+            template_data = f.read()
+
+    shard_images = shard_images or {}
+    jobs = [(rows, dict(headers), field_mapping, shard_filename(filename, shard),
+             shard_images.get(shard), template_data)
+            for shard, rows in shards.items()]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        shard_files = list(executor.map(_write_shard, jobs))
+
+    write_index([(shard, len(rows), shard_file)
+                 for (shard, rows), shard_file in zip(shards.items(), shard_files)],
+                shard_by, filename, table_sheets)
+    return shard_files